@@ -13,47 +13,148 @@ Usage::
 
 """
 
-from importlib.metadata import version
-
-__version__ = version("k3fs")
 from .fs import (
+    Appender,
     FSUtilError,
+    FileLock,
+    InsufficientSpace,
+    ListingCache,
+    LockTimeout,
     NotMountPoint,
+    ReadCache,
+    StatColumns,
+    TreeDigestCache,
     assert_mountpoint,
     calc_checksums,
+    calc_range_checksums,
+    compare_files,
+    fappend,
     get_all_mountpoint,
     get_device,
     get_device_fs,
     get_disk_partitions,
+    get_file_extents,
     get_mountpoint,
     get_path_fs,
     get_path_inode_usage,
     get_path_usage,
     fread,
+    fread_chunks,
+    fupdate,
     fwrite,
     ls_dirs,
     ls_files,
     makedirs,
+    register_checksum,
+    register_codec,
     remove,
+    stat_many,
+    tree_digest,
+)
+from .chunking import (
+    Chunker,
+    iter_file_chunks,
+)
+from .mountinfo import (
+    MountInfo,
+    MountTable,
+    get_mount_table,
+)
+from .inotify import (
+    WatchEvent,
+    Watcher,
+)
+from .pagecache import (
+    evict,
+    get_cache_residency,
+    prefetch,
+)
+from .snapshot import (
+    SnapshotEntry,
+    diff_snapshots,
+    iter_snapshot,
+    take_snapshot,
+)
+from .throttle import (
+    AdaptiveThrottle,
+)
+from .instrument import (
+    Metrics,
+    add_event_listener,
+    remove_event_listener,
 )
 
 __all__ = [
+    "AdaptiveThrottle",
+    "Appender",
+    "Chunker",
+    "DeviceScheduler",
     "FSUtilError",
+    "FileLock",
+    "InsufficientSpace",
+    "ListingCache",
+    "LockTimeout",
+    "Metrics",
+    "MountInfo",
+    "MountTable",
     "NotMountPoint",
+    "ReadCache",
+    "SnapshotEntry",
+    "StatColumns",
+    "TreeDigestCache",
+    "WatchEvent",
+    "Watcher",
+    "add_event_listener",
     "assert_mountpoint",
     "calc_checksums",
+    "calc_range_checksums",
+    "compare_files",
+    "diff_snapshots",
+    "evict",
+    "fappend",
     "get_all_mountpoint",
+    "get_cache_residency",
     "get_device",
     "get_device_fs",
     "get_disk_partitions",
+    "get_file_extents",
+    "get_mount_table",
     "get_mountpoint",
     "get_path_fs",
     "get_path_inode_usage",
     "get_path_usage",
+    "iter_file_chunks",
+    "iter_snapshot",
     "ls_dirs",
     "ls_files",
     "makedirs",
+    "prefetch",
+    "register_checksum",
+    "register_codec",
     "fread",
+    "fread_chunks",
+    "fupdate",
     "fwrite",
     "remove",
+    "remove_event_listener",
+    "stat_many",
+    "take_snapshot",
+    "tree_digest",
 ]
+
+
+def __getattr__(name):
+    # importlib.metadata takes tens of milliseconds to import and scans installed
+    # distributions, so it is loaded only when __version__ is read.
+    # DeviceScheduler imports concurrent.futures, thus it is loaded when it is used.
+    if name == "DeviceScheduler":
+        from .scheduler import DeviceScheduler
+
+        return DeviceScheduler
+
+    if name != "__version__":
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    from importlib.metadata import version
+
+    return version("k3fs")
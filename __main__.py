@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Command line interface of k3fs.
+
+Usage::
+
+    python -m k3fs checksum -a sha1 -a md5 /data/foo /data/bar
+    find /data -type f | python -m k3fs checksum --json --workers 8 --progress -
+    python -m k3fs rm --workers 16 /data/tmp-*
+    python -m k3fs ls -f --pattern '\\.log$' /var/log
+    python -m k3fs usage
+    python -m k3fs inodes --all
+    python -m k3fs mount-of /var/log /home
+    python -m k3fs device-of /var/log
+
+Every subcommand works on a list of paths. A path `-` reads paths from stdin,
+one per line, or separated by NUL with `-0`. Paths are processed by
+`--workers` threads, and results are output in the order of the input.
+
+Output is one line per result: the fields separated by tab, with the path in
+the last column, or a JSON object with `--json`. An error of a path is output
+as `{"path": ..., "error": ...}` in JSON, or to stderr in text. The exit code
+is 1 if there is any error.
+"""
+
+import argparse
+import collections
+import json
+import os
+import sys
+import time
+
+from . import fs
+
+
+def cmd_checksum(args, path):
+    sums = fs.calc_checksums(
+        path,
+        block_size=args.block_size,
+        io_limit=args.io_limit,
+        algorithms=args.algorithm,
+    )
+
+    rec = {"path": path}
+    for n in args.algorithm:
+        rec[n] = sums[n]
+
+    return [rec]
+
+
+def cmd_rm(args, path):
+    errors = []
+
+    def _onerror(func, p, exc_info):
+        errors.append(_error_record(p, exc_info[1]))
+
+    fs.remove(path, onerror=_onerror, truncate_step=args.truncate_step, free_limit=args.free_limit)
+
+    return errors
+
+
+def cmd_ls(args, path):
+    recs = []
+
+    if not args.dirs_only:
+        for name in fs.ls_files(path, pattern=args.pattern):
+            recs.append({"path": os.path.join(path, name), "type": "file"})
+
+    if not args.files_only:
+        for name in fs.ls_dirs(path):
+            if args.pattern == ".*" or fs._compile(args.pattern).search(name):
+                recs.append({"path": os.path.join(path, name), "type": "dir"})
+
+    return recs
+
+
+def cmd_usage(args, path):
+    return [dict(path=path, **fs.get_path_usage(path))]
+
+
+def cmd_inodes(args, path):
+    return [dict(path=path, **fs.get_path_inode_usage(path))]
+
+
+def cmd_mount_of(args, path):
+    return [{"path": path, "mountpoint": fs.get_mountpoint(path)}]
+
+
+def cmd_device_of(args, path):
+    return [{"path": path, "device": fs.get_device(path)}]
+
+
+def _error_record(path, e):
+    return {"path": path, "error": "{n}: {e}".format(n=type(e).__name__, e=e)}
+
+
+def _call(path, func, args):
+    try:
+        return func(args, path)
+    except Exception as e:
+        return [_error_record(path, e)]
+
+
+def iter_paths(paths, null=False, stdin=None):
+    """
+    Yield paths in `paths`, and the paths read from `stdin` in place of a `-`.
+    """
+    for p in paths:
+        if p != "-":
+            yield p
+            continue
+
+        f = stdin or sys.stdin
+        if not null:
+            for line in f:
+                line = line.rstrip("\n")
+                if line != "":
+                    yield line
+            continue
+
+        rest = ""
+        while True:
+            buf = f.read(64 * 1024)
+            if buf == "":
+                break
+
+            parts = (rest + buf).split("\0")
+            rest = parts.pop()
+            yield from (x for x in parts if x != "")
+
+        if rest != "":
+            yield rest
+
+
+def iter_results(func, args, paths, workers, per_device=0):
+    """
+    Yield the list of records of every path, in the order of `paths`.
+
+    At most `workers * 4` paths are submitted and not yet output, thus the
+    memory used does not grow with the number of paths.
+
+    With a positive `per_device`, paths are run by a `DeviceScheduler`, with
+    at most `per_device` paths of a device at a time.
+    """
+    if workers <= 1:
+        for p in paths:
+            yield _call(p, func, args)
+        return
+
+    if per_device > 0:
+        from .scheduler import DeviceScheduler
+
+        executor = DeviceScheduler(per_device=per_device, max_workers=workers)
+    else:
+        from concurrent.futures import ThreadPoolExecutor
+
+        executor = ThreadPoolExecutor(workers)
+
+    with executor as pool:
+        pending = collections.deque()
+
+        for p in paths:
+            pending.append(pool.submit(_call, p, func, args))
+            if len(pending) >= workers * 4:
+                yield pending.popleft().result()
+
+        while len(pending) > 0:
+            yield pending.popleft().result()
+
+
+class Progress(object):
+    """
+    Report the number of paths done to stderr, at most once per `interval` seconds.
+    """
+
+    def __init__(self, out=None, interval=1.0):
+        self.out = out or sys.stderr
+        self.interval = interval
+        self.started = time.monotonic()
+        self.reported = self.started
+        self.done = 0
+        self.errors = 0
+
+    def add(self, n_errors):
+        self.done += 1
+        self.errors += n_errors
+
+        now = time.monotonic()
+        if now - self.reported >= self.interval:
+            self.reported = now
+            self.report("\r")
+
+    def report(self, end):
+        spent = max(time.monotonic() - self.started, 1e-9)
+        self.out.write(
+            "{d} done, {e} errors, {r:.1f}/s{end}".format(d=self.done, e=self.errors, r=self.done / spent, end=end)
+        )
+        self.out.flush()
+
+
+def format_text(rec):
+    vals = ["-" if v is None else str(v) for k, v in rec.items() if k != "path"]
+    vals.append(rec["path"])
+    return "\t".join(vals)
+
+
+def format_path(rec):
+    return rec["path"]
+
+
+commands = {
+    # name: (function, text formatter, help)
+    "checksum": (cmd_checksum, format_text, "calculate checksums of files"),
+    "rm": (cmd_rm, format_text, "remove files and dirs recursively"),
+    "ls": (cmd_ls, format_path, "list files and sub dirs of dirs"),
+    "usage": (cmd_usage, format_text, "space usage of file systems, of all mount points if no path is given"),
+    "inodes": (cmd_inodes, format_text, "inode usage of file systems, of all mount points if no path is given"),
+    "mount-of": (cmd_mount_of, format_text, "mount point a path resides on"),
+    "device-of": (cmd_device_of, format_text, "device a path resides on"),
+}
+
+
+def build_parser():
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("paths", nargs="*", help="paths to work on, '-' to read paths from stdin")
+    common.add_argument("-w", "--workers", type=int, default=1, help="number of paths to process concurrently")
+    common.add_argument(
+        "--per-device",
+        type=int,
+        default=0,
+        help="max number of paths of one device to process concurrently, devices are served in turn",
+    )
+    common.add_argument("-j", "--json", action="store_true", help="output JSON lines")
+    common.add_argument("-0", "--null", action="store_true", help="paths from stdin are separated by NUL")
+    common.add_argument("--progress", action="store_true", help="report progress to stderr")
+
+    parser = argparse.ArgumentParser(prog="python -m k3fs", description="file system utilities")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    parsers = {}
+    for name, (_, _, hlp) in commands.items():
+        parsers[name] = sub.add_parser(name, parents=[common], help=hlp)
+
+    p = parsers["checksum"]
+    p.add_argument(
+        "-a",
+        "--algorithm",
+        action="append",
+        choices=sorted(fs._checksum_algorithms),
+        help="checksum to calculate, can be given several times, by default sha1",
+    )
+    p.add_argument("--block-size", type=int, default=fs.READ_BLOCK, help="bytes to read at a time")
+    p.add_argument("--io-limit", type=int, default=-1, help="max bytes per second to read a file, -1 for no limit")
+
+    p = parsers["rm"]
+    p.add_argument("--truncate-step", type=int, help="free huge files by truncating this many bytes at a time")
+    p.add_argument("--free-limit", type=int, help="max bytes of files to free per second")
+
+    p = parsers["ls"]
+    p.add_argument("-f", "--files-only", action="store_true", help="list only files")
+    p.add_argument("-d", "--dirs-only", action="store_true", help="list only dirs")
+    p.add_argument("--pattern", default=".*", help="list only names matching this regular expression")
+
+    for name in ("usage", "inodes"):
+        parsers[name].add_argument(
+            "--all", action="store_true", help="include all mount points, not only the physical ones"
+        )
+
+    return parser
+
+
+def main(argv=None, stdin=None, stdout=None, stderr=None):
+    stdout = stdout or sys.stdout
+    stderr = stderr or sys.stderr
+
+    parser = build_parser()
+    args = parser.parse_args(argv)
+
+    if args.command == "checksum" and args.algorithm is None:
+        args.algorithm = ["sha1"]
+
+    paths = args.paths
+    if len(paths) == 0:
+        if args.command in ("usage", "inodes"):
+            paths = fs.get_all_mountpoint(all=args.all)
+        else:
+            parser.error("no path is given, use '-' to read paths from stdin")
+
+    func, fmt, _ = commands[args.command]
+    progress = Progress(stderr) if args.progress else None
+    has_error = False
+
+    for recs in iter_results(func, args, iter_paths(paths, args.null, stdin), args.workers, args.per_device):
+        n_errors = 0
+
+        for rec in recs:
+            if "error" in rec:
+                n_errors += 1
+                if not args.json:
+                    stderr.write("k3fs {c}: {p}: {e}\n".format(c=args.command, p=rec["path"], e=rec["error"]))
+                    continue
+
+            stdout.write((json.dumps(rec) if args.json else fmt(rec)) + "\n")
+
+        if n_errors > 0:
+            has_error = True
+
+        if progress is not None:
+            progress.add(n_errors)
+
+    if progress is not None:
+        progress.report("\n")
+
+    return 1 if has_error else 0
+
+
+if __name__ == "__main__":
+    try:
+        rc = main()
+        sys.stdout.flush()
+    except BrokenPipeError:
+        # the reader, such as `head`, exits early
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        rc = 1
+
+    sys.exit(rc)
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+The C library through ctypes, for the system calls Python does not provide.
+
+ctypes imports subprocess, tempfile and more, thus it is loaded only when a
+function of the C library is called, not when k3fs is imported.
+"""
+
+import os
+
+_libc = None
+
+# functions already passed to load_libc()
+_declared = set()
+
+
+def load_libc(declare):
+    """
+    Load the C library once, and call `declare(libc, ctypes)` once, which
+    sets `argtypes` and `restype` of the C functions a module uses.
+
+    Returns:
+        ctypes.CDLL: the C library, with `use_errno=True`.
+    """
+    global _libc
+
+    import ctypes
+
+    if _libc is None:
+        import ctypes.util
+
+        _libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+
+    if declare not in _declared:
+        declare(_libc, ctypes)
+        _declared.add(declare)
+
+    return _libc
+
+
+def check(rst, path=None):
+    """
+    Raise `OSError` of `errno` if `rst` of a C function is negative.
+    """
+    if rst < 0:
+        import ctypes
+
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e), path)
+
+    return rst
@@ -0,0 +1,407 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Benchmark k3fs hot paths with synthetic workloads in a temporary directory.
+
+Every workload runs in its own process, and every case in it reports:
+
+    {
+        'ops':         number of operations,
+        'seconds':     wall time,
+        'ops_per_sec': operations per second,
+        'mb_per_sec':  MB of file content per second, or None,
+        'syscr':       number of read syscalls, from /proc/self/io,
+        'syscw':       number of write syscalls, from /proc/self/io,
+        'peak_rss_kb': peak RSS in KB of the workload process so far,
+    }
+
+Usage::
+
+    # run all workloads and print the result in JSON
+    python bench/bench_fs.py
+
+    # run smaller workloads, only some of them
+    python bench/bench_fs.py --scale 0.1 small_files mounts
+
+    # check that `import k3fs` stays in its time budget
+    python bench/bench_fs.py import_time
+
+    # save the result as a baseline, then compare a later run with it
+    python bench/bench_fs.py --save bench-baseline.json
+    python bench/bench_fs.py --baseline bench-baseline.json
+
+Workloads use fixed sizes and seeds. Content is written shortly before it is
+read, so reads mostly hit the page cache.
+"""
+
+import argparse
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+M = 1024**2
+
+# max milliseconds `import k3fs` may add to the start up of a bare interpreter
+IMPORT_BUDGET_MS = 15
+
+# workload name -> function(base_dir, scale)
+workloads = {}
+
+
+def workload(func):
+    workloads[func.__name__] = func
+    return func
+
+
+def read_proc_io():
+    rst = {}
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                k, v = line.split(":")
+                rst[k] = int(v)
+    except OSError:
+        pass
+
+    return rst
+
+
+class Bench(object):
+    def __init__(self):
+        self.cases = {}
+
+    def run(self, name, func, items, nbytes=None):
+        """
+        Call `func` with every element of `items` and record it as case `name`.
+        """
+        items = list(items)
+
+        io0 = read_proc_io()
+        t0 = time.perf_counter()
+
+        for x in items:
+            func(x)
+
+        spent = time.perf_counter() - t0
+        io1 = read_proc_io()
+
+        spent = max(spent, 1e-9)
+        self.cases[name] = {
+            "ops": len(items),
+            "seconds": round(spent, 6),
+            "ops_per_sec": round(len(items) / spent, 3),
+            "mb_per_sec": None if nbytes is None else round(nbytes / M / spent, 3),
+            "syscr": io1.get("syscr", 0) - io0.get("syscr", 0),
+            "syscw": io1.get("syscw", 0) - io0.get("syscw", 0),
+            "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        }
+
+
+def n_of(n, scale):
+    return max(1, int(n * scale))
+
+
+@workload
+def small_files(base, scale):
+    import k3fs
+
+    n = n_of(5000, scale)
+    size = 4096
+    cont = random.Random(1).randbytes(size).hex()[:size]
+
+    paths = [os.path.join(base, "f%06d" % i) for i in range(n)]
+
+    b = Bench()
+    b.run("fwrite", lambda p: k3fs.fwrite(p, cont, fsync=False), paths, n * size)
+    b.run("fwrite_atomic", lambda p: k3fs.fwrite(p, cont, fsync=False, atomic=True), paths, n * size)
+    b.run("fread", k3fs.fread, paths, n * size)
+    b.run("fread_b", lambda p: k3fs.fread(p, mode="b"), paths, n * size)
+
+    # files changed within the last second are not cached
+    past = time.time() - 10
+    for p in paths:
+        os.utime(p, (past, past))
+    read_cache = k3fs.ReadCache()
+    for p in paths:
+        k3fs.fread(p, cache=read_cache)
+    b.run("fread_cached", lambda p: k3fs.fread(p, cache=read_cache), paths, n * size)
+
+    b.run("calc_checksums", lambda p: k3fs.calc_checksums(p, sha1=True, md5=True, io_limit=-1), paths, n * size)
+    b.run("ls_files", lambda p: k3fs.ls_files(p, pattern="^f0"), [base] * 20)
+    b.run("remove", k3fs.remove, paths)
+
+    return b.cases
+
+
+@workload
+def huge_files(base, scale):
+    import k3fs
+
+    n = 2
+    size = n_of(256, scale) * M
+    cont = random.Random(2).randbytes(M).hex()[:M] * (size // M)
+
+    paths = [os.path.join(base, "huge%d" % i) for i in range(n)]
+
+    b = Bench()
+    # before fwrite, which leaves the content in page cache for the reads below
+    b.run("fwrite_write_behind", lambda p, cont=cont: k3fs.fwrite(p, cont, write_behind=8 * M), paths, n * size)
+    b.run("fwrite", lambda p, cont=cont: k3fs.fwrite(p, cont), paths, n * size)
+    # not referenced by a closure, it is freed before the reads
+    del cont
+
+    b.run("fread_b", lambda p: k3fs.fread(p, mode="b"), paths, n * size)
+
+    all_sums = {"sha1": True, "md5": True, "crc32": True, "sha256": True, "io_limit": -1}
+    b.run("calc_checksums_sha1", lambda p: k3fs.calc_checksums(p, sha1=True, io_limit=-1), paths, n * size)
+    b.run("calc_checksums_all", lambda p: k3fs.calc_checksums(p, **all_sums), paths, n * size)
+    b.run(
+        "calc_checksums_all_parallel",
+        lambda p: k3fs.calc_checksums(p, parallel=True, **all_sums),
+        paths,
+        n * size,
+    )
+
+    b.run(
+        "calc_range_checksums",
+        lambda p: k3fs.calc_range_checksums(p, range_size=16 * M, workers=4),
+        paths,
+        n * size,
+    )
+    b.run("compare_files", lambda _: k3fs.compare_files(*paths), range(1), n * size)
+    b.run(
+        "iter_file_chunks",
+        lambda p: sum(1 for _ in k3fs.iter_file_chunks(p, algorithm="crc32", io_limit=-1)),
+        paths,
+        n * size,
+    )
+
+    sparse = os.path.join(base, "sparse")
+    with open(sparse, "wb") as f:
+        f.write(b"x" * M)
+        f.truncate(size)
+    b.run("calc_checksums_sparse", lambda p: k3fs.calc_checksums(p, sha1=True, io_limit=-1), [sparse], size)
+
+    b.run("remove", k3fs.remove, paths + [sparse])
+
+    return b.cases
+
+
+@workload
+def wide_tree(base, scale):
+    import k3fs
+
+    n = n_of(20000, scale)
+    root = os.path.join(base, "wide")
+
+    b = Bench()
+    b.run("makedirs", lambda i: k3fs.makedirs(root, "d%06d" % i), range(0, n, 10))
+    b.run("fwrite", lambda i: k3fs.fwrite(root, "f%06d" % i, "x", fsync=False), (i for i in range(n) if i % 10))
+    b.run("ls_files", lambda _: k3fs.ls_files(root), range(10))
+    b.run("ls_files_pattern", lambda _: k3fs.ls_files(root, pattern="1$"), range(10))
+    b.run("ls_dirs", lambda _: k3fs.ls_dirs(root), range(10))
+
+    names = [os.path.join(root, x) for x in k3fs.ls_files(root)]
+    b.run("stat", os.stat, names)
+    b.run("stat_many", lambda _: k3fs.stat_many(names), range(1))
+
+    # a dir changed within the last second is not cached
+    past = time.time() - 10
+    os.utime(root, (past, past))
+    listing_cache = k3fs.ListingCache()
+    k3fs.ls_files(root, cache=listing_cache)
+    b.run("ls_files_cached", lambda _: k3fs.ls_files(root, pattern="1$", cache=listing_cache), range(10))
+    b.run("tree_digest", lambda _: k3fs.tree_digest(root), range(1))
+
+    cache = k3fs.TreeDigestCache()
+    k3fs.tree_digest(root, cache=cache)
+    b.run("tree_digest_cached", lambda _: k3fs.tree_digest(root, cache=cache), range(3))
+
+    snaps = [os.path.join(base, "snap%d" % i) for i in range(2)]
+    b.run("take_snapshot", lambda p: k3fs.take_snapshot(root, p), snaps)
+    b.run("diff_snapshots", lambda _: sum(1 for _ in k3fs.diff_snapshots(*snaps)), range(1))
+
+    b.run("remove", k3fs.remove, [root])
+
+    return b.cases
+
+
+@workload
+def deep_tree(base, scale):
+    import k3fs
+
+    depth = n_of(100, scale)
+    n = n_of(50, scale)
+
+    roots = [os.path.join(base, "deep%03d" % i) for i in range(n)]
+    leaves = [os.path.join(r, *["d"] * depth) for r in roots]
+
+    b = Bench()
+    b.run("makedirs", k3fs.makedirs, leaves)
+    b.run("fwrite", lambda p: k3fs.fwrite(p, "leaf", "x", fsync=False), leaves)
+    b.run("tree_digest", lambda _: k3fs.tree_digest(base), range(1))
+    b.run("remove", k3fs.remove, roots)
+
+    return b.cases
+
+
+@workload
+def mounts(base, scale):
+    import k3fs
+    from k3fs import mountinfo
+
+    n = n_of(5000, scale)
+
+    with open(mountinfo.MOUNTINFO) as f:
+        lines = f.read().splitlines()
+
+    for i in range(n):
+        lines.append(
+            "{id} 1 8:{i} / /bench/mnt/{i} rw,relatime shared:{id} - ext4 /dev/bench{i} rw,errors=remount-ro".format(
+                id=100000 + i,
+                i=i,
+            )
+        )
+
+    fn = os.path.join(base, "mountinfo")
+    with open(fn, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+    paths = ["/bench/mnt/%d/a/b/c" % (i * 7 % n) for i in range(200)]
+
+    b = Bench()
+    b.run("read_mount_table", mountinfo.read_mount_table, [fn] * 20)
+
+    mountinfo.MOUNTINFO = fn
+    b.run("get_disk_partitions", lambda _: k3fs.get_disk_partitions(), range(200))
+    b.run("get_mountpoint", k3fs.get_mountpoint, paths)
+    b.run("get_device", k3fs.get_device, paths)
+    b.run("get_path_fs", k3fs.get_path_fs, paths)
+    b.run("get_device_fs", k3fs.get_device_fs, ["/dev/bench%d" % (i * 7 % n) for i in range(200)])
+
+    return b.cases
+
+
+@workload
+def import_time(base, scale):
+    n = n_of(20, scale)
+
+    def _spawn(code):
+        subprocess.check_call([sys.executable, "-c", code])
+
+    b = Bench()
+    b.run("python_bare", _spawn, ["pass"] * n)
+    b.run("import_k3fs", _spawn, ["import k3fs"] * n)
+
+    bare = b.cases["python_bare"]["seconds"] / n
+    k3fs_import = b.cases["import_k3fs"]["seconds"] / n
+
+    b.cases["import_k3fs"]["import_ms"] = round((k3fs_import - bare) * 1000, 3)
+    b.cases["import_k3fs"]["budget_ms"] = IMPORT_BUDGET_MS
+
+    return b.cases
+
+
+def run_workload(name, scale):
+    with tempfile.TemporaryDirectory(prefix="k3fs-bench-") as base:
+        return workloads[name](base, scale)
+
+
+def run_in_subprocess(name, scale):
+    out = subprocess.check_output(
+        [sys.executable, os.path.abspath(__file__), "--workload-process", name, "--scale", str(scale)],
+    )
+    return json.loads(out)
+
+
+def compare(result, baseline, tolerance):
+    """
+    Compare `ops_per_sec` of every case with the baseline.
+
+    Returns:
+        list: of `(workload, case, ratio)` of cases slower than `1 - tolerance` times the baseline.
+    """
+    regressions = []
+    for wname, cases in result["workloads"].items():
+        for cname, case in cases.items():
+            base = baseline.get("workloads", {}).get(wname, {}).get(cname)
+            if base is None:
+                continue
+
+            ratio = case["ops_per_sec"] / base["ops_per_sec"]
+            case["baseline_ops_per_sec"] = base["ops_per_sec"]
+            case["ratio"] = round(ratio, 3)
+
+            if ratio < 1 - tolerance:
+                regressions.append((wname, cname, ratio))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark k3fs with synthetic workloads")
+    parser.add_argument("workloads", nargs="*", help="workloads to run, by default all: " + ", ".join(workloads))
+    parser.add_argument("--scale", type=float, default=1.0, help="scale the number and size of files")
+    parser.add_argument("--save", help="save the result as a baseline to this file")
+    parser.add_argument("--baseline", help="compare with a saved baseline")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.2, help="a case is a regression if slower than baseline by this ratio"
+    )
+    parser.add_argument("--workload-process", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.workload_process:
+        json.dump(run_workload(args.workload_process, args.scale), sys.stdout)
+        return 0
+
+    names = args.workloads or list(workloads)
+    for n in names:
+        if n not in workloads:
+            parser.error("unknown workload: " + n)
+
+    import k3fs
+
+    result = {
+        "version": k3fs.__version__,
+        "python": sys.version.split()[0],
+        "scale": args.scale,
+        "workloads": {},
+    }
+    for n in names:
+        print("running", n, file=sys.stderr)
+        result["workloads"][n] = run_in_subprocess(n, args.scale)
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(result, json.load(f), args.tolerance)
+
+    print(json.dumps(result, indent=2, sort_keys=True))
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+
+    for wname, cname, ratio in regressions:
+        print("regression: {w}.{c}: {r:.2f}x of baseline".format(w=wname, c=cname, r=ratio), file=sys.stderr)
+
+    over_budget = False
+    imp = result["workloads"].get("import_time", {}).get("import_k3fs")
+    if imp is not None and imp["import_ms"] > imp["budget_ms"]:
+        over_budget = True
+        print(
+            "import k3fs takes {t} ms, over budget {b} ms".format(t=imp["import_ms"], b=imp["budget_ms"]),
+            file=sys.stderr,
+        )
+
+    return 1 if regressions or over_budget else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Content-defined chunking, to find the parts of a file that are the same as in
+another version of it, for dedupe or delta transfer.
+
+A file is cut where a rolling hash of the last 32 bytes matches a mask, so
+that an insert or delete changes only the chunks around it, while the
+chunks before and after are cut at the same content and have the same digest.
+
+Chunk boundaries follow FastCDC: a gear hash, and a harder mask before the
+average size and an easier one after it, so that chunk sizes spread closely
+around the average.
+
+Usage::
+
+    for offset, length, digest in iter_file_chunks('/data/foo.img', avg_size=1024**2):
+        ...
+
+The hash is vectorized with numpy if it is installed, or it is calculated
+byte by byte in Python, with the same result but much slower.
+"""
+
+import collections
+import os
+
+from . import fs
+
+# bytes to hash in one numpy call, small enough to keep the arrays in CPU cache
+VECTOR_BLOCK = 64 * 1024
+
+# the hash of a byte depends on this many bytes ending at it
+WINDOW = 32
+
+
+def _gear_table():
+    # splitmix64, fixed seed: the table must never change, or chunks change.
+    table = []
+    x = 0x6B3F5C2D1A0E9F87
+    for _ in range(256):
+        x = (x + 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+        z = x
+        z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+        z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+        z = z ^ (z >> 31)
+        table.append(z >> 32)
+
+    return table
+
+
+GEAR = _gear_table()
+
+
+def _numpy():
+    try:
+        import numpy
+    except ImportError:
+        return None
+
+    return numpy
+
+
+class Chunker(object):
+    """
+    Cut a stream of bytes into content-defined chunks.
+
+    Feed it with `update()`, and it returns the chunks cut so far. `finish()`
+    returns the last ones.
+
+    Args:
+
+        avg_size(int):
+            expected average size of chunks, a power of 2.
+
+        min_size(int):
+            min size of a chunk, except the last one. By default `avg_size / 4`.
+
+        max_size(int):
+            max size of a chunk. By default `avg_size * 4`.
+
+        algorithm(str):
+            digest of chunks, one of the algorithms of `calc_checksums`.
+
+        vectorize(bool):
+            use numpy to calculate the hash. By default it is used if it is
+            installed. The result is the same either way.
+    """
+
+    def __init__(
+        self,
+        avg_size=1024 * 1024,
+        min_size=None,
+        max_size=None,
+        algorithm="sha256",
+        vectorize=None,
+    ):
+        if min_size is None:
+            min_size = avg_size // 4
+        if max_size is None:
+            max_size = avg_size * 4
+
+        bits = avg_size.bit_length() - 1
+        if avg_size != 1 << bits or not 8 <= avg_size <= 1 << 28:
+            raise fs.FSUtilError("avg_size must be a power of 2 in [8, 2^28], but: {s}".format(s=avg_size))
+
+        if not 0 < min_size <= avg_size <= max_size:
+            raise fs.FSUtilError(
+                "it requires 0 < min_size <= avg_size <= max_size, but: {a}, {b}, {c}".format(
+                    a=min_size, b=avg_size, c=max_size
+                )
+            )
+
+        if algorithm not in fs._checksum_algorithms:
+            raise fs.FSUtilError("unknown checksum algorithm: {n}".format(n=algorithm))
+
+        self.avg_size = avg_size
+        self.min_size = min_size
+        self.max_size = max_size
+        self.algorithm = algorithm
+
+        # The top bits of the hash depend on the most bytes.
+        # Before avg_size a cut requires 2 more bits to match, after it 2 less.
+        self.mask_hard = ((1 << (bits + 2)) - 1) << (32 - bits - 2)
+        self.mask_easy = ((1 << (bits - 2)) - 1) << (32 - bits + 2)
+
+        self.np = _numpy() if vectorize is not False else None
+        if vectorize and self.np is None:
+            raise fs.FSUtilError("vectorize requires numpy")
+
+        if self.np is not None:
+            self.np_gear = self.np.array(GEAR, dtype=self.np.uint32)
+
+            # reused for every block
+            self.np_h = self.np.empty(VECTOR_BLOCK + WINDOW - 1, dtype=self.np.uint32)
+            self.np_shifted = self.np.empty_like(self.np_h)
+
+        # offset of the first byte in buf
+        self.start = 0
+        self.buf = bytearray()
+
+        # number of bytes hashed
+        self.hashed = 0
+
+        # hash of the last byte, for the byte by byte calculation
+        self.h = 0
+
+        # last WINDOW-1 bytes, for the numpy calculation
+        self.tail = b""
+
+        # (end offset, matches the hard mask) of positions that match the easy mask.
+        # The hard mask has all of the bits of the easy one.
+        self.cuts = collections.deque()
+
+    def update(self, buf):
+        """
+        Feed more bytes.
+
+        Returns:
+            list: of `(offset, length, digest)` of the chunks cut.
+        """
+        self.buf += buf
+
+        if self.np is not None:
+            buf = memoryview(buf).cast("B")
+            for i in range(0, len(buf), VECTOR_BLOCK):
+                self._hash_numpy(buf[i : i + VECTOR_BLOCK])
+        else:
+            self._hash_python(buf)
+
+        return self._cut(False)
+
+    def finish(self):
+        """
+        Returns:
+            list: of `(offset, length, digest)` of the remaining chunks.
+        """
+        return self._cut(True)
+
+    def _hash_python(self, buf):
+        gear = GEAR
+        mask_easy = self.mask_easy
+        mask_hard = self.mask_hard
+        cuts = self.cuts
+        end = self.hashed + 1
+
+        h = self.h
+        for i, b in enumerate(memoryview(buf).cast("B")):
+            h = ((h << 1) + gear[b]) & 0xFFFFFFFF
+            if (h & mask_easy) == 0:
+                cuts.append((end + i, (h & mask_hard) == 0))
+
+        self.h = h
+        self.hashed += len(buf)
+
+    def _hash_numpy(self, buf):
+        np = self.np
+
+        n_tail = len(self.tail)
+        n = n_tail + len(buf)
+
+        # hash[i] = sum(gear[data[i-k]] << k for k in 0..31), in 5 steps of doubling the window.
+        h = self.np_h[:n]
+        shifted = self.np_shifted[:n]
+
+        # a byte is always a valid index, "wrap" skips the bound check
+        np.take(self.np_gear, np.frombuffer(self.tail, dtype=np.uint8), out=h[:n_tail], mode="wrap")
+        np.take(self.np_gear, np.frombuffer(buf, dtype=np.uint8), out=h[n_tail:], mode="wrap")
+
+        width = 1
+        while width < WINDOW:
+            np.left_shift(h[:-width], width, out=shifted[width:])
+            np.add(h[width:], shifted[width:], out=h[width:])
+            width *= 2
+
+        h = h[n_tail:]
+
+        idx = np.flatnonzero((h & self.mask_easy) == 0)
+        hard = (h[idx] & self.mask_hard) == 0
+
+        end = self.hashed + 1
+        self.cuts.extend(zip((idx + end).tolist(), hard.tolist()))
+
+        self.hashed += len(buf)
+        self.tail = (self.tail + bytes(buf[-(WINDOW - 1) :]))[-(WINDOW - 1) :]
+
+    def _cut(self, final):
+        chunks = []
+
+        while True:
+            end = self._next_cut(final)
+            if end is None:
+                return chunks
+
+            length = end - self.start
+
+            hasher = fs._checksum_algorithms[self.algorithm]()
+            hasher.update(self.buf[:length])
+            chunks.append((self.start, length, hasher.hexdigest()))
+
+            del self.buf[:length]
+            self.start = end
+
+    def _next_cut(self, final):
+        start = self.start
+        lo = start + self.min_size
+        mid = start + self.avg_size
+        hi = start + self.max_size
+
+        cuts = self.cuts
+        while len(cuts) > 0 and cuts[0][0] < lo:
+            cuts.popleft()
+
+        for end, hard in cuts:
+            if end >= hi:
+                break
+
+            if hard or end >= mid:
+                return end
+
+        if self.hashed >= hi:
+            return hi
+
+        if final and self.hashed > start:
+            return self.hashed
+
+        return None
+
+
+def iter_file_chunks(
+    *paths,
+    avg_size=1024 * 1024,
+    min_size=None,
+    max_size=None,
+    algorithm="sha256",
+    block_size=1024 * 1024,
+    io_limit=fs.READ_BLOCK,
+    vectorize=None,
+):
+    """
+    Cut a file into content-defined chunks, and yield them one by one.
+
+    The file is read in the same way as `calc_checksums`: holes of a sparse
+    file are not read and reading is throttled by `io_limit`.
+
+    Args:
+
+        paths:
+            is the path of the file.
+
+        avg_size, min_size, max_size, algorithm, vectorize:
+            are the same as `Chunker`.
+
+        block_size(int):
+            is the max number of bytes to read at a time.
+
+        io_limit(int):
+            is the max number of bytes to read per second.
+            A negative value means no limit.
+            It can also be an `AdaptiveThrottle`, the same as `calc_checksums`.
+
+    Returns:
+        generator: of `(offset, length, digest)` of every chunk.
+    """
+    path = os.path.join(*paths)
+
+    if io_limit == 0:
+        raise fs.FSUtilError("io_limit shoud not be zero")
+
+    chunker = Chunker(
+        avg_size=avg_size,
+        min_size=min_size,
+        max_size=max_size,
+        algorithm=algorithm,
+        vectorize=vectorize,
+    )
+
+    with open(path, "rb") as f:
+        for buf in fs._iter_file_blocks(f.fileno(), block_size, io_limit):
+            yield from chunker.update(buf)
+
+    yield from chunker.finish()
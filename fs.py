@@ -1,16 +1,27 @@
 #!/usr/bin/env python
 # coding: utf-8
 
-import binascii
-import hashlib
+# Heavy modules are imported when they are used: psutil by mount point
+# functions where there is no /proc/self/mountinfo, hashlib by checksum
+# functions, concurrent.futures by functions using a thread pool. Thus
+# `import k3fs` stays cheap for programs that only read and write files.
+import array
+import collections
 import errno
+import functools
+import io
 import os
 import re
+import stat
 import sys
-import psutil
+import threading
+import zlib
 
 import time
-import k3confloader
+
+from . import instrument
+from . import mountinfo
+from .instrument import instrumented
 
 READ_BLOCK = 32 * 1024 * 1024
 WRITE_BLOCK = 32 * 1024 * 1024
@@ -24,6 +35,52 @@ class NotMountPoint(FSUtilError):
     pass
 
 
+class LockTimeout(FSUtilError):
+    pass
+
+
+class InsufficientSpace(FSUtilError):
+    pass
+
+
+_k3conf = None
+
+
+def _conf(name):
+    """
+    Read a config from module `k3conf`, the config file of pykit3, or `None` if not set.
+    """
+    # It loads the same `k3conf.py` as `k3confloader` does, without importing
+    # `k3confloader`, which builds the default configs of all pykit3 modules at
+    # import time. k3fs only reads `uid`, `gid` and `max_usage`, which default to `None`.
+    global _k3conf
+
+    if _k3conf is None:
+        try:
+            import k3conf
+        except ModuleNotFoundError as e:
+            # A k3conf.py that fails to import its own dependency must not look like a missing k3conf.
+            if e.name != "k3conf":
+                raise
+            k3conf = object()
+
+        _k3conf = k3conf
+
+    return getattr(_k3conf, name, None)
+
+
+def _join_path(args):
+    return os.path.join(*args)
+
+
+def _join_path_but_last(args):
+    return os.path.join(*args[:-1])
+
+
+def _first_arg(args):
+    return args[0]
+
+
 def assert_mountpoint(path):
     """
     Ensure that `path` must be a **mount point**.
@@ -35,6 +92,15 @@ def assert_mountpoint(path):
         raise NotMountPoint(path)
 
 
+def _get_mount_table():
+    # psutil is used only where /proc/self/mountinfo is not available, such as macOS.
+    if sys.platform.startswith("linux"):
+        return mountinfo.get_mount_table()
+
+    return None
+
+
+@instrumented("get_all_mountpoint")
 def get_all_mountpoint(all=False):
     """
     Returns a list of all mount points on this host.
@@ -42,11 +108,18 @@ def get_all_mountpoint(all=False):
     :return: By default it is `False` thus only disk drive mount points are returned.
     `tmpfs` or `/proc` are not returned by default.
     """
+    table = _get_mount_table()
+    if table is not None:
+        return [m.mountpoint for m in table.mounts if all or table.is_physical(m)]
+
+    import psutil
+
     partitions = psutil.disk_partitions(all=all)
     prt_by_mp = [x.mountpoint for x in partitions]
     return prt_by_mp
 
 
+@instrumented("get_mountpoint", _first_arg)
 def get_mountpoint(path):
     """
     Return the mount point where this `path` resides on.
@@ -56,7 +129,11 @@ def get_mountpoint(path):
     """
     path = os.path.realpath(path)
 
-    prt_by_mountpoint = get_disk_partitions()
+    table = _get_mount_table()
+    if table is not None:
+        prt_by_mountpoint = table.by_mountpoint
+    else:
+        prt_by_mountpoint = get_disk_partitions()
 
     while path != "/" and path not in prt_by_mountpoint:
         path = os.path.dirname(path)
@@ -64,6 +141,7 @@ def get_mountpoint(path):
     return path
 
 
+@instrumented("get_device", _first_arg)
 def get_device(path):
     """
     Get the device path(`/dev/sdb` etc) where `path` resides on.
@@ -71,19 +149,31 @@ def get_device(path):
     :return: device path like `"/dev/sdb"` in string.
     """
 
-    prt_by_mountpoint = get_disk_partitions()
-
     mp = get_mountpoint(path)
 
+    table = _get_mount_table()
+    if table is not None:
+        return table.by_mountpoint[mp].device
+
+    prt_by_mountpoint = get_disk_partitions()
+
     return prt_by_mountpoint[mp]["device"]
 
 
+@instrumented("get_device_fs", _first_arg)
 def get_device_fs(device):
     """
     Return the file-system name of a device, if the device is a disk device.
     :param device: is a path of a device, such as `/dev/sdb1`.
     :return: the file-system name, such as `ext4` or `hfs`.
     """
+    table = _get_mount_table()
+    if table is not None:
+        for m in table.by_mountpoint.values():
+            if device == m.device:
+                return m.fstype
+        return "unknown"
+
     prt_by_mp = get_disk_partitions()
 
     for prt in list(prt_by_mp.values()):
@@ -93,10 +183,15 @@ def get_device_fs(device):
         return "unknown"
 
 
+@instrumented("get_disk_partitions")
 def get_disk_partitions(all=True):
     """
     Find and return all mounted path and its mount point information in a
     dictionary.
+
+    On Linux it is built from `/proc/self/mountinfo`, see `get_mount_table`
+    for more information of every mount point.
+    On other systems it is built from `psutil.disk_partitions()`.
     :param all:  By default it is `True` thus all mount points including non-disk path are also returned,
     otherwise `tmpfs` or `/proc` are not returned.
     :return: an dictionary indexed by mount point path:
@@ -119,6 +214,12 @@ def get_disk_partitions(all=True):
     #              'mountpoint': '/net',
     #              'opts': 'rw,nosuid,dontbrowse,automounted,multilabel'}
     # }
+    table = _get_mount_table()
+    if table is not None:
+        return {mp: m.to_dict() for mp, m in table.by_mountpoint.items() if all or table.is_physical(m)}
+
+    import psutil
+
     partitions = psutil.disk_partitions(all=all)
 
     by_mount_point = {}
@@ -133,6 +234,7 @@ def get_disk_partitions(all=True):
     return by_mount_point
 
 
+@instrumented("get_path_fs", _first_arg)
 def get_path_fs(path):
     """
     Return the name of device where the `path` is mounted.
@@ -140,6 +242,11 @@ def get_path_fs(path):
     :return: the file-system name, such as `ext4` or `hfs`.
     """
     mp = get_mountpoint(path)
+
+    table = _get_mount_table()
+    if table is not None:
+        return table.by_mountpoint[mp].fstype
+
     prt_by_mp = get_disk_partitions()
 
     return prt_by_mp[mp]["fstype"]
@@ -155,7 +262,7 @@ def get_path_usage(path):
         'total':     total space in byte,
         'used':      used space in byte(includes space reserved for super user),
         'available': total - used,
-        'percent':   float(used) / 'total',
+        'percent':   float(used) / 'total', 0.0 if 'total' is 0,
     }
     """
     space_st = os.statvfs(path)
@@ -171,7 +278,8 @@ def get_path_usage(path):
         "total": capa,
         "used": used,
         "available": avail,
-        "percent": float(used) / capa,
+        # a pseudo file system such as proc or sysfs has no blocks
+        "percent": float(used) / capa if capa > 0 else 0.0,
     }
 
 
@@ -187,7 +295,7 @@ def get_path_inode_usage(path):
     #     'total':     total number of inode,
     # 'used':      used inode(includes inode reserved for super user),
     # 'available': total - used,
-    #              'percent':   float(used) / 'total'
+    #              'percent':   float(used) / 'total', 0.0 if 'total' is 0
     # }
     # ```
     inode_st = os.statvfs(path)
@@ -200,10 +308,12 @@ def get_path_inode_usage(path):
         "total": total,
         "used": used,
         "available": available,
-        "percent": float(used) / total,
+        # a pseudo file system such as proc or sysfs has no inodes
+        "percent": float(used) / total if total > 0 else 0.0,
     }
 
 
+@instrumented("makedirs", _join_path)
 def makedirs(*paths, **kwargs):
     """
     Make directory.
@@ -233,8 +343,8 @@ def makedirs(*paths, **kwargs):
     """
 
     mode = kwargs.get("mode", 0o755)
-    uid = kwargs.get("uid") or k3confloader.conf.uid
-    gid = kwargs.get("gid") or k3confloader.conf.gid
+    uid = kwargs.get("uid") or _conf("uid")
+    gid = kwargs.get("gid") or _conf("gid")
 
     path = os.path.join(*paths)
     last_err = None
@@ -261,7 +371,175 @@ def makedirs(*paths, **kwargs):
         raise last_err
 
 
-def ls_dirs(*paths):
+class _LRUCache(object):
+    """
+    The LRU machinery shared by `ListingCache`, `ReadCache` and `TreeDigestCache`.
+
+    A record is indexed by a key, such as `(st_dev, st_ino)`, and is kept
+    with the absolute path it is cached for, to be invalidated by path, and
+    with its cost, such as a number of entries or bytes. The least recently
+    used records are evicted when the total cost exceeds `max_cost`.
+
+    A record of a file or dir changed within `racy_ns` must not be kept, see
+    `_is_racy()`, because another change in the same timestamp tick would
+    not change the mtime, and would not be noticed.
+
+    Attributes:
+        stats(dict): numbers of `hits`, `misses` and `evictions`.
+    """
+
+    racy_ns = 1000 * 1000 * 1000
+
+    def __init__(self, max_cost):
+        self.max_cost = max_cost
+
+        self.lock = threading.Lock()
+
+        # key -> [path, cost, record]
+        self.records = collections.OrderedDict()
+        # absolute path -> key
+        self.keys = {}
+        self.cost = 0
+
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def _is_racy(self, mtime_ns):
+        return time.time_ns() - mtime_ns < self.racy_ns
+
+    def _get(self, key, valid=None):
+        """
+        Return the record of `key` if there is one and `valid(record)` is true,
+        otherwise `None`.
+        """
+        with self.lock:
+            c = self.records.get(key)
+            if c is not None and (valid is None or valid(c[2])):
+                self.records.move_to_end(key)
+                self.stats["hits"] += 1
+                return c[2]
+
+            self.stats["misses"] += 1
+            return None
+
+    def _put(self, key, path, record, cost):
+        if cost > self.max_cost:
+            return
+
+        with self.lock:
+            self._pop(key)
+
+            self.records[key] = [path, cost, record]
+            self.keys[path] = key
+            self.cost += cost
+
+            self._evict()
+
+    def _evict(self):
+        # called with self.lock held
+        while self.cost > self.max_cost:
+            self._pop(next(iter(self.records)))
+            self.stats["evictions"] += 1
+
+    def _pop(self, key):
+        # called with self.lock held
+        c = self.records.pop(key, None)
+        if c is not None:
+            self.cost -= c[1]
+            if self.keys.get(c[0]) == key:
+                del self.keys[c[0]]
+
+    def _invalidate(self, *paths):
+        with self.lock:
+            for p in paths:
+                key = self.keys.get(p)
+                if key is not None:
+                    self._pop(key)
+
+    def clear(self):
+        with self.lock:
+            self.records.clear()
+            self.keys.clear()
+            self.cost = 0
+
+
+class ListingCache(_LRUCache):
+    """
+    LRU cache of dir listings for `ls_files` and `ls_dirs`.
+
+    A listing is indexed by `(st_dev, st_ino)` of the dir and is valid while
+    `st_mtime_ns` of the dir does not change, thus a cache hit costs one
+    `stat()`. The type of every entry is kept, so that `ls_files` with
+    different `pattern` and `ls_dirs` share one listing.
+
+    A listing of a dir changed within `racy_ns` is not kept.
+
+    Args:
+
+        max_entries(int):
+            the max total number of entries in all listings kept.
+            The least recently used listings are evicted when it is exceeded.
+
+    Attributes:
+        stats(dict): numbers of `hits`, `misses` and `evictions`.
+    """
+
+    def __init__(self, max_entries=1024 * 1024):
+        super().__init__(max_entries)
+
+    @property
+    def n_entries(self):
+        return self.cost
+
+    def list(self, path):
+        """
+        Return the sorted `(name, is_file, is_dir)` of all entries in dir `path`.
+        Symbolic links are followed, like `os.path.isfile()` does.
+        """
+        st = os.stat(path)
+        key = (st.st_dev, st.st_ino)
+
+        # record: (st_mtime_ns, entries)
+        c = self._get(key, lambda c: c[0] == st.st_mtime_ns)
+        if c is not None:
+            return c[1]
+
+        entries = _list_entries(path)
+
+        if not self._is_racy(st.st_mtime_ns):
+            self._put(key, os.path.abspath(path), (st.st_mtime_ns, entries), len(entries))
+
+        return entries
+
+    def invalidate(self, path):
+        """
+        Drop the listing of the dir `path` and of the dir containing `path`.
+        """
+        path = os.path.abspath(path)
+        self._invalidate(path, os.path.dirname(path))
+
+
+def _list_entries(path):
+    entries = []
+
+    with os.scandir(path) as it:
+        for ent in it:
+            try:
+                is_file = ent.is_file()
+                is_dir = not is_file and ent.is_dir()
+            except OSError:
+                is_file = is_dir = False
+
+            entries.append((ent.name, is_file, is_dir))
+
+    entries.sort()
+
+    return entries
+
+
+_compile = functools.lru_cache(maxsize=256)(re.compile)
+
+
+def ls_dirs(*paths, cache=None):
     """
     Get sorted sub directories of `paths`.
 
@@ -269,24 +547,24 @@ def ls_dirs(*paths):
         paths:
             is the directory path.
 
+        cache(ListingCache):
+            reuse the dir listing in `cache` if the dir is not changed.
+
     Returns:
         list: of all sub directory names.
     """
 
     path = os.path.join(*paths)
-    files = os.listdir(path)
 
-    sub_dirs = []
-    for f in files:
-        if os.path.isdir(os.path.join(path, f)):
-            sub_dirs.append(f)
-
-    sub_dirs.sort()
+    if cache is not None:
+        entries = cache.list(path)
+    else:
+        entries = _list_entries(path)
 
-    return sub_dirs
+    return [name for name, _, is_dir in entries if is_dir]
 
 
-def ls_files(*paths, pattern=".*"):
+def ls_files(*paths, pattern=".*", cache=None):
     """
     List all files that match `pattern` in `path`.
 
@@ -298,21 +576,277 @@ def ls_files(*paths, pattern=".*"):
         pattern(str):
             is a regular expression that matches wanted file names.
 
+        cache(ListingCache):
+            reuse the dir listing in `cache` if the dir is not changed.
+
     Returns:
         list: of sorted file names.
     """
 
     path = os.path.join(*paths)
-    fns = os.listdir(path)
 
-    pt = re.compile(pattern)
+    if cache is not None:
+        entries = cache.list(path)
+    else:
+        entries = _list_entries(path)
+
+    pt = _compile(pattern)
+
+    return [name for name, is_file, _ in entries if is_file and pt.search(name) is not None]
+
+
+def _stdlib_codec(module, compressor, decompressor):
+    def _compressor():
+        return getattr(__import__(module), compressor)()
+
+    def _decompressor():
+        return getattr(__import__(module), decompressor)()
+
+    return (_compressor, _decompressor)
+
+
+_codecs = {
+    # wbits=31: the gzip format, the same as the `gzip` command.
+    "gzip": (lambda: zlib.compressobj(6, zlib.DEFLATED, 31), lambda: zlib.decompressobj(31)),
+    "bz2": _stdlib_codec("bz2", "BZ2Compressor", "BZ2Decompressor"),
+    "lzma": _stdlib_codec("lzma", "LZMACompressor", "LZMADecompressor"),
+}
+
+# max bytes to compress or decompress at a time
+CODEC_BLOCK = 1024 * 1024
+
+
+def register_codec(name, compressor, decompressor):
+    """
+    Register a compression codec so that it can be used by `fwrite` and `fread`.
+
+    Args:
+
+        name(str):
+            is the name of the codec, as the `codec` argument of `fwrite` and `fread`.
+
+        compressor(callable):
+            is called without argument to create a compressor, which provides
+            `compress(buf)` and `flush()`, like `zlib.compressobj()`.
+
+        decompressor(callable):
+            is called without argument to create a decompressor, which provides
+            `decompress(buf, max_length)`, `eof` and `unused_data`, and
+            `unconsumed_tail` like `zlib.decompressobj()` or `needs_input` like
+            `bz2.BZ2Decompressor()`, so that output is produced at most
+            `max_length` bytes at a time.
+    """
+    _codecs[name] = (compressor, decompressor)
+
+
+def _get_codec(name):
+    try:
+        return _codecs[name]
+    except KeyError:
+        raise FSUtilError("unknown codec: {n}".format(n=name)) from None
+
+
+def _compress(codec, chunks):
+    c = _get_codec(codec)[0]()
+
+    for chunk in chunks:
+        chunk = memoryview(chunk)
+        for i in range(0, len(chunk), CODEC_BLOCK):
+            buf = c.compress(chunk[i : i + CODEC_BLOCK])
+            if len(buf) > 0:
+                yield buf
+
+    yield c.flush()
+
+
+def _decompress(codec, blocks, max_length):
+    new_decompressor = _get_codec(codec)[1]
+
+    d = new_decompressor()
+    fed = False
+
+    for buf in blocks:
+        while True:
+            if len(buf) > 0:
+                fed = True
+
+            # bounded output, a small input may expand to gigabytes
+            out = d.decompress(buf, max_length)
+            if len(out) > 0:
+                yield out
+
+            if d.eof:
+                # the stream ends, the rest is the next stream concatenated
+                buf = d.unused_data
+                d = new_decompressor()
+                fed = False
+                if len(buf) == 0:
+                    break
+                continue
+
+            # zlib returns the input not consumed yet in `unconsumed_tail`,
+            # bz2 and lzma keep it and tell with `needs_input` if there is more output.
+            buf = getattr(d, "unconsumed_tail", b"")
+            if len(buf) == 0 and getattr(d, "needs_input", len(out) < max_length):
+                break
+
+    if fed and not d.eof:
+        raise FSUtilError("compressed data is truncated")
+
+
+def _iter_in_thread(it, depth=4):
+    """
+    Run the iterator `it` in a worker thread, `depth` items ahead of the consumer.
+    """
+    import queue
+
+    q = queue.Queue(depth)
+    stop = threading.Event()
+
+    def _put(item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _produce():
+        try:
+            for x in it:
+                _put((x, None))
+                if stop.is_set():
+                    return
+            _put((None, StopIteration()))
+        except BaseException as e:
+            _put((None, e))
+
+    th = threading.Thread(target=_produce, daemon=True)
+    th.start()
+
+    try:
+        while True:
+            x, err = q.get()
+            if err is None:
+                yield x
+            elif isinstance(err, StopIteration):
+                return
+            else:
+                raise err
+    finally:
+        stop.set()
+        th.join()
+
+
+def _iter_bytes(fcont):
+    # str is encoded in utf-8, in pieces to avoid copying a huge str at once.
+    if isinstance(fcont, (str, bytes)):
+        fcont = [fcont]
+
+    for chunk in fcont:
+        if isinstance(chunk, str):
+            for i in range(0, len(chunk), CODEC_BLOCK):
+                yield chunk[i : i + CODEC_BLOCK].encode("utf-8")
+        else:
+            yield chunk
+
+
+class ReadCache(_LRUCache):
+    """
+    LRU cache of file content for `fread`, for small files read again and
+    again, such as config files.
+
+    Content is indexed by `(st_dev, st_ino)` of the file and is valid while
+    `st_size` and `st_mtime_ns` do not change, thus a cache hit costs one
+    `stat()`, without open, read or close. `bytes` is kept for `mode='b'`, and
+    the decoded `str` is kept separately when it is read with `mode=''`.
 
-    fns = sorted([x for x in fns if re.search(pt, x) is not None and os.path.isfile(os.path.join(path, x))])
+    Content of a file changed within `racy_ns` is not kept.
 
-    return fns
+    Args:
+
+        max_bytes(int):
+            the max total memory in bytes of content kept.
+            The least recently used files are evicted when it is exceeded.
 
+        max_file_size(int):
+            a file larger than it is never kept. By default `max_bytes / 16`.
+
+    Attributes:
+        stats(dict): numbers of `hits`, `misses` and `evictions`.
+    """
 
-def fread(*paths, mode=""):
+    def __init__(self, max_bytes=64 * 1024 * 1024, max_file_size=None):
+        super().__init__(max_bytes)
+        self.max_file_size = max_file_size if max_file_size is not None else max_bytes // 16
+
+    @property
+    def n_bytes(self):
+        return self.cost
+
+    def read(self, path, mode=""):
+        """
+        Return the content of file `path`, the same as `fread(path, mode=mode)`.
+        """
+        st = os.stat(path)
+        key = (st.st_dev, st.st_ino)
+
+        # record: [st_size, st_mtime_ns, bytes, str or None]
+        c = self._get(key, lambda c: c[0] == st.st_size and c[1] == st.st_mtime_ns)
+
+        data = None
+        if c is not None:
+            if mode == "b":
+                return c[2]
+            if c[3] is not None:
+                return c[3]
+
+            data = c[2]
+
+        if data is None:
+            with open(path, "rb") as f:
+                st = os.fstat(f.fileno())
+                key = (st.st_dev, st.st_ino)
+                data = f.read()
+
+            if instrument.listeners:
+                instrument.record("bytes", len(data))
+                instrument.record("blocks", 1)
+
+        text = None
+        if mode != "b":
+            # the same decoding and newline translation as open() in text mode
+            text = io.TextIOWrapper(io.BytesIO(data)).read()
+
+        if len(data) == st.st_size and len(data) <= self.max_file_size and not self._is_racy(st.st_mtime_ns):
+            self._put_content(key, os.path.abspath(path), st, data, text)
+
+        return data if mode == "b" else text
+
+    def _put_content(self, key, path, st, data, text):
+        with self.lock:
+            c = self.records.get(key)
+            if c is not None and c[2][2] is data:
+                # add str to the cached bytes
+                if text is not None and c[2][3] is None:
+                    c[2][3] = text
+                    c[1] += sys.getsizeof(text)
+                    self.cost += sys.getsizeof(text)
+                    self._evict()
+                return
+
+        used = sys.getsizeof(data) + (sys.getsizeof(text) if text is not None else 0)
+        self._put(key, path, [st.st_size, st.st_mtime_ns, data, text], used)
+
+    def invalidate(self, path):
+        """
+        Drop the content of file `path`.
+        """
+        self._invalidate(os.path.abspath(path))
+
+
+@instrumented("fread", _join_path)
+def fread(*paths, mode="", codec=None, codec_thread=False, cache=None):
     """
     Read and return the entire file specified by `path`
 
@@ -325,15 +859,96 @@ def fread(*paths, mode=""):
             If `mode='b'` it returns `bytes`.
             If `mode=''` it returns a `str` decoded from `bytes`.
 
+        codec(str):
+            decompress the file content with a codec: `gzip`, `bz2`, `lzma`,
+            or one added with `register_codec`.
+            The decompressed content is decoded in utf-8 if `mode=''`.
+
+        codec_thread(bool):
+            decompress in a worker thread while reading.
+
+        cache(ReadCache):
+            return the content in `cache` if the file is not changed.
+            It can not be used with `codec`.
+
     Returns:
         file content in string or bytes.
     """
     path = os.path.join(*paths)
+
+    if cache is not None:
+        if codec is not None:
+            raise FSUtilError("cache can not be used with codec")
+
+        return cache.read(path, mode)
+
+    if codec is not None:
+        cont = b"".join(fread_chunks(path, codec=codec, codec_thread=codec_thread))
+        if mode == "b":
+            return cont
+        return cont.decode("utf-8")
+
     with open(path, "r" + mode) as f:
-        return f.read()
+        cont = f.read()
+
+        if instrument.listeners:
+            instrument.record("bytes", os.fstat(f.fileno()).st_size)
+            instrument.record("blocks", 1)
+
+        return cont
+
+
+def fread_chunks(*paths, codec=None, block_size=CODEC_BLOCK, codec_thread=False):
+    """
+    Yield the content of a file in `bytes` chunks, so that a large file is
+    read with bounded memory.
 
+    Args:
+
+        paths:
+            is the path of the file to read.
+
+        codec(str):
+            decompress the content with a codec, the same as `fread`.
+
+        block_size(int):
+            is the max number of bytes to read at a time, and the max size of
+            a decompressed chunk.
+
+        codec_thread(bool):
+            read and decompress in a worker thread, while the caller consumes
+            the chunks.
+    """
+    path = os.path.join(*paths)
 
-def fwrite(*paths_content, uid=None, gid=None, atomic=False, fsync=True):
+    if codec is not None:
+        _get_codec(codec)
+
+    with open(path, "rb") as f:
+        chunks = _iter_file_blocks(f.fileno(), block_size, -1)
+        if codec is not None:
+            chunks = _decompress(codec, chunks, block_size)
+
+        if codec_thread:
+            chunks = _iter_in_thread(chunks)
+
+        for chunk in chunks:
+            yield bytes(chunk)
+
+
+@instrumented("fwrite", _join_path_but_last)
+def fwrite(
+    *paths_content,
+    uid=None,
+    gid=None,
+    atomic=False,
+    fsync=True,
+    preallocate=False,
+    max_usage=None,
+    codec=None,
+    codec_thread=False,
+    write_behind=None,
+):
     """
     Write `fcont` into file `path`.
 
@@ -344,6 +959,10 @@ def fwrite(*paths_content, uid=None, gid=None, atomic=False, fsync=True):
             The last elt is content, e.g.:
             `fwrite('/tmp', 'foo', 'bar')` write 'bar' into file '/tmp/foo'.
 
+            The content is a `str`, `bytes`, or an iterable of them, which is
+            written chunk by chunk. `str` chunks of an iterable are encoded
+            in utf-8.
+
         uid:
             specifies the user_id the file belongs to.
 
@@ -362,169 +981,1971 @@ def fwrite(*paths_content, uid=None, gid=None, atomic=False, fsync=True):
             created at the same nanosecond.
             The renaming will be an atomic operation (this is a POSIX requirement).
 
-        fsync(bool):
+        fsync(bool or str):
             specify if need to synchronize data to storage device.
+            `True` or `"fsync"` to call `fsync()`, `"fdatasync"` to call
+            `fdatasync()`, which does not write back metadata not needed to
+            read the data, such as mtime, or `fsync()` where it is not
+            supported, such as macOS. `False` to not synchronize.
+
+        preallocate(bool):
+            allocate the space of the entire content with `posix_fallocate()`
+            before writing. The file gets fewer and larger extents, and it
+            fails with `InsufficientSpace` before writing anything if the disk
+            does not have enough space.
+            On a file system that does not support it, glibc emulates it by
+            writing every block, which is slow.
+            It requires the content to be a `str` or `bytes`, without `codec`.
+
+        max_usage(float):
+            max ratio of used space of the file system, `0` to `1`, after
+            writing. If `used + content size` would exceed `total * max_usage`,
+            `InsufficientSpace` is raised without writing.
+            Content being written by other `fwrite` calls in this process is
+            counted as used too.
+            By default it is config `max_usage` in k3conf.py, or no check if
+            it is not set.
+            The size of an iterable content is unknown, only the current usage
+            is checked.
+
+        codec(str):
+            compress the content while writing, with a codec: `gzip`, `bz2`,
+            `lzma`, or one added with `register_codec`.
+            `str` content is encoded in utf-8 before compressing.
+
+        codec_thread(bool):
+            compress in a worker thread while writing.
+
+        write_behind(int):
+            start writing back the content every `write_behind` bytes
+            written, with `sync_file_range()`, wait for the previous part to
+            be on disk, and drop it from the page cache.
+            Dirty pages of the file are kept under about `2 * write_behind`
+            bytes, instead of piling up until the final sync, which then
+            blocks for long and stalls other writers of the device.
+            Where `sync_file_range()` is not supported, `fdatasync()` is
+            called instead, and where `posix_fadvise()` is not supported,
+            such as macOS, pages are not dropped. `None` to write back at
+            the end.
 
     """
 
     fcont = paths_content[-1]
     path = os.path.join(*paths_content[:-1])
-    if not atomic:
-        return _write_file(path, fcont, uid, gid, fsync)
 
-    tmp_path = "{path}._tmp_.{pid}_{timestamp}".format(
-        path=path,
-        pid=os.getpid(),
-        timestamp=int(time.time() * (1000**3)),
-    )
-    _write_file(tmp_path, fcont, uid, gid, fsync)
+    if codec is not None:
+        _get_codec(codec)
+
+    if preallocate and (codec is not None or not isinstance(fcont, (str, bytes))):
+        raise FSUtilError("preallocate requires str or bytes content without codec")
+
+    if isinstance(fsync, str) and fsync not in ("fsync", "fdatasync"):
+        raise FSUtilError("fsync must be 'fsync' or 'fdatasync' if it is a str, but: {f}".format(f=fsync))
+
+    if write_behind is not None and write_behind <= 0:
+        raise FSUtilError("write_behind must be positive integer")
+
+    if max_usage is None:
+        max_usage = _conf("max_usage")
+
+    dev = None
+    if max_usage is not None:
+        size = _content_size(fcont)
+        dev = _reserve(path, size, max_usage)
 
     try:
-        os.rename(tmp_path, path)
-    except EnvironmentError:
-        os.remove(tmp_path)
-        raise
+        if not atomic:
+            return _write_file(path, fcont, uid, gid, fsync, preallocate, codec, codec_thread, write_behind)
 
+        tmp_path = "{path}._tmp_.{pid}_{timestamp}".format(
+            path=path,
+            pid=os.getpid(),
+            timestamp=int(time.time() * (1000**3)),
+        )
 
-def _write_file(path, fcont, uid=None, gid=None, fsync=True):
-    uid = uid or k3confloader.conf.uid
-    gid = gid or k3confloader.conf.gid
+        try:
+            _write_file(tmp_path, fcont, uid, gid, fsync, preallocate, codec, codec_thread, write_behind)
+            os.rename(tmp_path, path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+    finally:
+        if dev is not None:
+            _release(dev, size)
 
-    with open(path, "w") as f:
-        f.write(fcont)
-        f.flush()
-        if fsync:
-            os.fsync(f.fileno())
 
-    if uid is not None and gid is not None:
-        os.chown(path, uid, gid)
+# bytes being written by this process, by device
+_reserved = {}
+_reserved_lock = threading.Lock()
 
 
-def remove(*paths, onerror=None):
-    """
-    Recursively delete `path`, the `path` is *file*, *directory* or *symbolic link*.
+def _content_size(fcont, encoding="utf-8"):
+    if not isinstance(fcont, (str, bytes)):
+        return 0
 
-    Args:
+    if isinstance(fcont, bytes) or fcont.isascii():
+        return len(fcont)
 
-        paths:
-            is the path to remove.
+    return len(fcont.encode(encoding))
 
-        onerror(str or callable):
-            - "raise": when error occur it raises the original error.
-            - "ignore": ignore error and go on.
-            - A callable:
-                it is called to handle the error with arguments `(func, path,
-                exc_info)` where func is *os.listdir*, *os.remove*, *os.rmdir*
-                or *os.path.isdir*.
+
+def _reserve(path, size, max_usage):
     """
+    Check that writing `size` bytes to `path` keeps the file system usage no
+    more than `max_usage`, and count the bytes as used until `_release()`.
 
-    path = os.path.join(*paths)
+    Space allocated by an ongoing write is not yet seen by `statvfs()`, thus
+    concurrent writes would pass the check together without the reservation.
+    """
+    parent = os.path.dirname(os.path.abspath(path))
+    dev = os.stat(parent).st_dev
+
+    with _reserved_lock:
+        usage = get_path_usage(parent)
+        reserved = _reserved.get(dev, 0)
+
+        if usage["used"] + reserved + size > usage["total"] * max_usage:
+            raise InsufficientSpace(
+                "writing {size} bytes to {path} exceeds max_usage {m}: used: {u}, reserved: {r}, total: {t}".format(
+                    size=size,
+                    path=path,
+                    m=max_usage,
+                    u=usage["used"],
+                    r=reserved,
+                    t=usage["total"],
+                )
+            )
+
+        _reserved[dev] = reserved + size
+
+    return dev
+
+
+def _release(dev, size):
+    with _reserved_lock:
+        left = _reserved[dev] - size
+        if left == 0:
+            del _reserved[dev]
+        else:
+            _reserved[dev] = left
+
+
+def _write_file(
+    path,
+    fcont,
+    uid=None,
+    gid=None,
+    fsync=True,
+    preallocate=False,
+    codec=None,
+    codec_thread=False,
+    write_behind=None,
+):
+    if codec is None and isinstance(fcont, str):
+        mode = "w"
+    else:
+        mode = "wb"
 
-    if onerror is None:
-        onerror = "raise"
+    with open(path, mode) as f:
+        wb = _WriteBehind(f, write_behind) if write_behind is not None else None
 
-    try:
-        is_dir = os.path.isdir(path)
-    except os.error as e:
-        if onerror == "raise":
-            raise e
-        elif onerror == "ignore":
-            pass
+        if preallocate:
+            _preallocate(f, fcont)
+
+        if codec is None and isinstance(fcont, (str, bytes)):
+            if wb is None:
+                f.write(fcont)
+            else:
+                if isinstance(fcont, bytes):
+                    fcont = memoryview(fcont)
+
+                for i in range(0, len(fcont), write_behind):
+                    piece = fcont[i : i + write_behind]
+                    f.write(piece)
+                    wb.wrote(len(piece))
         else:
-            onerror(os.path.isdir, path, sys.exc_info())
+            chunks = _iter_bytes(fcont)
+            if codec is not None:
+                chunks = _compress(codec, chunks)
 
-        return
+            if codec_thread:
+                chunks = _iter_in_thread(chunks)
 
-    if not is_dir:
-        try:
-            os.remove(path)
-        except os.error as e:
-            if onerror == "raise":
-                raise e
-            elif onerror == "ignore":
-                pass
+            try:
+                for chunk in chunks:
+                    f.write(chunk)
+                    if wb is not None:
+                        wb.wrote(len(chunk))
+            finally:
+                chunks.close()
+
+        f.flush()
+        if fsync:
+            t0 = time.monotonic()
+            if fsync == "fdatasync":
+                _fdatasync(f.fileno())
             else:
-                onerror(os.remove, path, sys.exc_info())
-        return
+                os.fsync(f.fileno())
+            if instrument.listeners:
+                instrument.record("fsync_time", time.monotonic() - t0)
 
-    names = []
-    try:
-        names = os.listdir(path)
-    except os.error as e:
-        if onerror == "raise":
-            raise e
-        elif onerror == "ignore":
-            pass
-        else:
-            onerror(os.listdir, path, sys.exc_info())
+            if wb is not None:
+                wb.synced()
 
-    for name in names:
-        fullname = os.path.join(path, name)
-        remove(fullname, onerror=onerror)
+        if instrument.listeners:
+            instrument.record("bytes", os.fstat(f.fileno()).st_size)
+            instrument.record("blocks", 1)
 
-    try:
-        os.rmdir(path)
-    except os.error as e:
-        if onerror == "raise":
-            raise e
-        elif onerror == "ignore":
-            pass
-        else:
-            onerror(os.rmdir, path, sys.exc_info())
+    _chown(path, uid, gid)
 
 
-def calc_checksums(path, sha1=False, md5=False, crc32=False, sha256=False, block_size=READ_BLOCK, io_limit=READ_BLOCK):
-    checksums = {"sha1": None, "md5": None, "crc32": None, "sha256": None}
+class _WriteBehind(object):
+    """
+    Write back file `f` being written, `step` bytes at a time, and drop the
+    written back pages from the page cache.
 
-    if (sha1 or md5 or crc32 or sha256) is False:
-        return checksums
+    When `step` more bytes are written, write back of them is started without
+    waiting, and then the write back started before is waited for, so that
+    one step is being written back while the next one is being written.
+    """
 
-    if block_size <= 0:
-        raise FSUtilError("block_size must be positive integer")
+    def __init__(self, f, step):
+        self.f = f
+        self.fd = f.fileno()
+        self.step = step
 
-    if io_limit == 0:
-        raise FSUtilError("io_limit shoud not be zero")
+        # bytes written since the last check, of str or of bytes
+        self.written = 0
 
-    min_io_time = float(block_size) / io_limit
+        # write back of [0, started) is started
+        self.started = 0
 
-    sum_sha1 = hashlib.sha1()
-    sum_md5 = hashlib.md5()
-    sum_crc32 = 0
-    sum_sha256 = hashlib.sha256()
+        # [0, done) is on disk and dropped from page cache
+        self.done = 0
 
-    with open(path, "rb") as f_path:
-        while True:
-            t0 = time.time()
+        self.no_sync_file_range = False
 
-            buf = f_path.read(block_size)
-            if len(buf) == 0:
-                break
+    def wrote(self, n):
+        self.written += n
+        if self.written < self.step:
+            return
 
-            t1 = time.time()
+        # pagecache is not imported with fs, fwrite without write_behind does not need it
+        from . import pagecache
 
-            time_sleep = max(0, min_io_time - (t1 - t0))
-            if time_sleep > 0:
-                time.sleep(time_sleep)
+        self.written = 0
+        self.f.flush()
+        pos = os.lseek(self.fd, 0, os.SEEK_CUR)
 
-            if sha1:
-                sum_sha1.update(buf)
-            if md5:
-                sum_md5.update(buf)
-            if crc32:
-                sum_crc32 = binascii.crc32(buf, sum_crc32)
-            if sha256:
-                sum_sha256.update(buf)
-
-    if sha1:
-        checksums["sha1"] = sum_sha1.hexdigest()
-    if md5:
-        checksums["md5"] = sum_md5.hexdigest()
-    if crc32:
-        checksums["crc32"] = "%08x" % (sum_crc32 & 0xFFFFFFFF)
-    if sha256:
-        checksums["sha256"] = sum_sha256.hexdigest()
+        while pos - self.started >= self.step:
+            self._sync_range(self.started, self.step, pagecache.SYNC_FILE_RANGE_WRITE)
+            self._wait(self.started)
+            self.started += self.step
 
-    return checksums
+    def _wait(self, end):
+        if end <= self.done:
+            return
+
+        from . import pagecache
+
+        t0 = time.monotonic()
+        self._sync_range(
+            self.done,
+            end - self.done,
+            pagecache.SYNC_FILE_RANGE_WAIT_BEFORE
+            | pagecache.SYNC_FILE_RANGE_WRITE
+            | pagecache.SYNC_FILE_RANGE_WAIT_AFTER,
+        )
+        if instrument.listeners:
+            instrument.record("fsync_time", time.monotonic() - t0)
+
+        _dontneed(self.fd, self.done, end - self.done)
+        self.done = end
+
+    def _sync_range(self, offset, nbytes, flags):
+        from . import pagecache
+
+        if not self.no_sync_file_range:
+            try:
+                pagecache._sync_file_range(self.fd, offset, nbytes, flags)
+                return
+            except OSError as e:
+                if e.errno != errno.ENOSYS:
+                    raise
+                self.no_sync_file_range = True
+
+        if flags & pagecache.SYNC_FILE_RANGE_WAIT_AFTER:
+            _fdatasync(self.fd)
+
+    def synced(self):
+        """
+        Drop the rest of the file from page cache, after it is synchronized.
+        """
+        # length 0 means to the end of file
+        _dontneed(self.fd, self.done, 0)
+
+
+def _fdatasync(fd):
+    # macOS has no fdatasync()
+    if hasattr(os, "fdatasync"):
+        os.fdatasync(fd)
+    else:
+        os.fsync(fd)
+
+
+def _dontneed(fd, offset, length):
+    # macOS has no posix_fadvise(), pages are left to the kernel to drop
+    if hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(fd, offset, length, os.POSIX_FADV_DONTNEED)
+
+
+def _preallocate(f, fcont):
+    size = _content_size(fcont, getattr(f, "encoding", "utf-8"))
+    if size == 0:
+        return
+
+    try:
+        os.posix_fallocate(f.fileno(), 0, size)
+    except OSError as e:
+        if e.errno == errno.ENOSPC:
+            raise InsufficientSpace(
+                "no space to preallocate {size} bytes for {path}".format(size=size, path=f.name)
+            ) from e
+        raise
+
+
+def _chown(path, uid=None, gid=None):
+    # uid and gid default to config `uid` and `gid` in k3conf.py
+    uid = uid or _conf("uid")
+    gid = gid or _conf("gid")
+
+    if uid is not None and gid is not None:
+        os.chown(path, uid, gid)
+
+
+class Appender(object):
+    """
+    Append records to a file through one open `O_APPEND` fd.
+
+    Records are buffered and written with one `writev()` per flush. A flush
+    happens when buffered records reach `flush_size` bytes, when the oldest
+    buffered record is older than `flush_interval` seconds, or when `flush()`
+    or `close()` is called.
+
+    It is thread safe. Usage::
+
+        with Appender('/var/log/foo/journal', sync='interval', sync_interval=0.1) as a:
+            a.write('record 1\\n')
+            a.write(b'record 2\\n')
+
+    Args:
+
+        paths:
+            is the path of the file to append to.
+
+        flush_size(int):
+            flush when buffered records reach this many bytes.
+
+        flush_interval(float):
+            max seconds a record stays in buffer. A background thread flushes
+            records, and syncs them in the `"interval"` mode, if `write()`
+            does not do it in time.
+            `None` to flush only by size or by an explicit call.
+
+        sync(str):
+            durability of flushed records:
+            - `"none"`: leave them to the OS.
+            - `"interval"`: `fdatasync()` after a flush, at most once per `sync_interval` seconds.
+            - `"batch"`: `fdatasync()` after every flush.
+
+        sync_interval(float):
+            seconds between two `fdatasync()` in the `"interval"` mode.
+
+        rotate_size(int):
+            before a flush that would make the file larger than this, the
+            file is renamed to `<path>.<timestamp>` and a new one is created.
+
+        rotate_interval(float):
+            rename the file and create a new one if it has been written for
+            this many seconds.
+
+        uid, gid:
+            owner of the created files. They default to config `uid`/`gid`,
+            the same as `fwrite`.
+    """
+
+    sync_modes = ("none", "interval", "batch")
+
+    def __init__(
+        self,
+        *paths,
+        flush_size=64 * 1024,
+        flush_interval=1.0,
+        sync="none",
+        sync_interval=1.0,
+        rotate_size=None,
+        rotate_interval=None,
+        uid=None,
+        gid=None,
+    ):
+        if sync not in self.sync_modes:
+            raise FSUtilError("sync must be one of {m}, but: {s}".format(m=self.sync_modes, s=sync))
+
+        self.path = os.path.join(*paths)
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.sync = sync
+        self.sync_interval = sync_interval
+        self.rotate_size = rotate_size
+        self.rotate_interval = rotate_interval
+        self.uid = uid
+        self.gid = gid
+
+        self.lock = threading.RLock()
+        self.cond = threading.Condition(self.lock)
+
+        self.bufs = []
+        self.buf_size = 0
+        self.buf_since = None
+
+        self.fd = None
+        self.opened_at = None
+        self.synced_at = time.monotonic()
+        self.dirty = False
+
+        self._open()
+
+        self.flusher = None
+        if flush_interval is not None:
+            self.flusher = threading.Thread(target=self._flush_loop, daemon=True)
+            self.flusher.start()
+
+    def _open(self):
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_CLOEXEC, 0o666)
+        self.opened_at = time.monotonic()
+        _chown(self.path, self.uid, self.gid)
+
+    def write(self, record):
+        """
+        Buffer a record, a `str` that is encoded in utf-8 or `bytes`.
+        """
+        if isinstance(record, str):
+            record = record.encode("utf-8")
+
+        with self.lock:
+            if self.fd is None:
+                raise FSUtilError("appender is closed: " + self.path)
+
+            if self.buf_since is None:
+                self.buf_since = time.monotonic()
+
+            self.bufs.append(record)
+            self.buf_size += len(record)
+
+            if self.buf_size >= self.flush_size or (
+                self.flush_interval is not None and time.monotonic() - self.buf_since >= self.flush_interval
+            ):
+                self._flush()
+
+    def flush(self):
+        """
+        Write all buffered records to the file, and sync them according to `sync`.
+        """
+        with self.lock:
+            if self.fd is not None:
+                self._flush()
+
+    def _flush(self):
+        if self.buf_size == 0:
+            return
+
+        if self._should_rotate():
+            self._rotate()
+
+        _writev(self.fd, self.bufs)
+
+        self.bufs = []
+        self.buf_size = 0
+        self.buf_since = None
+
+        if not self.dirty:
+            self.dirty = True
+            # let the flusher thread sync it in time
+            self.cond.notify()
+
+        if self.sync == "batch":
+            self._sync()
+        elif self.sync == "interval" and time.monotonic() - self.synced_at >= self.sync_interval:
+            self._sync()
+
+    def _sync(self):
+        if self.dirty:
+            _fdatasync(self.fd)
+            self.dirty = False
+        self.synced_at = time.monotonic()
+
+    def _should_rotate(self):
+        if self.rotate_interval is not None and time.monotonic() - self.opened_at >= self.rotate_interval:
+            return True
+
+        if self.rotate_size is not None:
+            size = os.fstat(self.fd).st_size
+            if size > 0 and size + self.buf_size > self.rotate_size:
+                return True
+
+        return False
+
+    def _rotate(self):
+        if self.sync != "none":
+            self._sync()
+
+        ts = time.strftime("%Y%m%d-%H%M%S")
+        rotated = "{path}.{ts}".format(path=self.path, ts=ts)
+        i = 0
+        while os.path.exists(rotated):
+            i += 1
+            rotated = "{path}.{ts}.{i}".format(path=self.path, ts=ts, i=i)
+
+        os.rename(self.path, rotated)
+        os.close(self.fd)
+        self._open()
+
+    def _flush_loop(self):
+        with self.lock:
+            while self.fd is not None:
+                deadlines = []
+                if self.buf_since is not None:
+                    deadlines.append(self.buf_since + self.flush_interval)
+                if self.sync == "interval" and self.dirty:
+                    deadlines.append(self.synced_at + self.sync_interval)
+
+                if len(deadlines) == 0:
+                    self.cond.wait(self.flush_interval)
+                    continue
+
+                wait = min(deadlines) - time.monotonic()
+                if wait > 0:
+                    self.cond.wait(wait)
+                    continue
+
+                self._flush()
+
+                if self.sync == "interval" and time.monotonic() - self.synced_at >= self.sync_interval:
+                    self._sync()
+
+    def close(self):
+        """
+        Flush buffered records, sync them unless `sync` is `"none"`, and close the file.
+        """
+        with self.lock:
+            if self.fd is None:
+                return
+
+            try:
+                self._flush()
+                if self.sync != "none":
+                    self._sync()
+            finally:
+                os.close(self.fd)
+                self.fd = None
+                self.cond.notify_all()
+
+        if self.flusher is not None and self.flusher is not threading.current_thread():
+            self.flusher.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+_iov_max = None
+
+
+def _writev(fd, bufs):
+    global _iov_max
+
+    if _iov_max is None:
+        try:
+            _iov_max = os.sysconf("SC_IOV_MAX")
+        except (ValueError, OSError):
+            _iov_max = 1024
+
+    i = 0
+    while i < len(bufs):
+        batch = bufs[i : i + _iov_max]
+        n = os.writev(fd, batch)
+        i += len(batch)
+
+        total = sum(len(b) for b in batch)
+        if n < total:
+            # partial write: put the unwritten part back in front of the rest
+            rest = b"".join(batch)[n:]
+            bufs = [rest, *bufs[i:]]
+            i = 0
+
+
+def fappend(*paths_content, uid=None, gid=None, fsync=False):
+    """
+    Append content to a file.
+    To append many records, use `Appender`, which keeps the file open and
+    writes records in batches.
+
+    Args:
+
+        paths_content:
+            is the file path to append to and the content to append, in
+            `str` or `bytes`. The last elt is content, e.g.:
+            `fappend('/tmp', 'foo', 'bar')` appends 'bar' to file '/tmp/foo'.
+
+        uid, gid:
+            specifies the owner of the file, the same as `fwrite`.
+
+        fsync(bool):
+            specify if need to synchronize data to storage device.
+    """
+    fcont = paths_content[-1]
+
+    with Appender(
+        *paths_content[:-1],
+        flush_interval=None,
+        sync="batch" if fsync else "none",
+        uid=uid,
+        gid=gid,
+    ) as a:
+        a.write(fcont)
+
+
+class FileLock(object):
+    """
+    A `flock()` lock of a file, taken on a sidecar file `<path>.lock`.
+
+    The sidecar is locked instead of the file itself, because an atomic
+    write replaces the file with another inode, on which a waiter would get
+    a lock that protects nothing. The sidecar is never removed.
+
+    The lock belongs to the open file description, thus it excludes other
+    threads of the same process as well as other processes.
+
+    Usage::
+
+        with FileLock('/var/run/foo/state', shared=True):
+            state = fread('/var/run/foo/state')
+
+    Args:
+
+        paths:
+            is the path of the file to lock.
+
+        shared(bool):
+            take a shared lock for readers, instead of an exclusive one.
+
+        timeout(float):
+            max seconds to wait for the lock. `LockTimeout` is raised if it
+            is not acquired in time. `None` to wait forever, in the kernel
+            lock queue, without polling.
+    """
+
+    def __init__(self, *paths, shared=False, timeout=None):
+        self.path = os.path.join(*paths)
+        self.lock_path = self.path + ".lock"
+        self.shared = shared
+        self.timeout = timeout
+        self.fd = None
+
+    def acquire(self):
+        import fcntl
+
+        op = fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX
+
+        fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o666)
+        try:
+            if self.timeout is None:
+                fcntl.flock(fd, op)
+            else:
+                self._acquire_in_time(fd, op)
+        except BaseException:
+            os.close(fd)
+            raise
+
+        self.fd = fd
+
+    def _acquire_in_time(self, fd, op):
+        import fcntl
+
+        deadline = time.monotonic() + self.timeout
+        delay = 0.001
+
+        while True:
+            try:
+                fcntl.flock(fd, op | fcntl.LOCK_NB)
+                return
+            except BlockingIOError:
+                pass
+
+            left = deadline - time.monotonic()
+            if left <= 0:
+                raise LockTimeout("lock is not acquired in {t} seconds: {p}".format(t=self.timeout, p=self.lock_path))
+
+            # backoff with jitter, so that waiters do not wake up together
+            import random
+
+            time.sleep(min(left, delay * random.uniform(0.5, 1.5)))
+            delay = min(delay * 2, 0.05)
+
+    def release(self):
+        if self.fd is not None:
+            # closing the fd releases the lock
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+@instrumented("fupdate", _join_path_but_last)
+def fupdate(*paths_func, mode="", timeout=None, uid=None, gid=None, fsync=True):
+    """
+    Read, modify and atomically write a file, with an exclusive `FileLock`
+    held, so that concurrent updates by threads or processes are not lost.
+
+    Readers that must not see the file change while they use it can take a
+    `FileLock(path, shared=True)`.
+
+    Args:
+
+        paths_func:
+            is the file path to update and a function to update the content.
+            The last elt is the function, e.g.:
+            `fupdate('/tmp', 'foo', lambda c: c + 'x')` appends 'x' to file '/tmp/foo'.
+
+            The function is called with the current content, or `None` if
+            the file does not exist. It returns the new content, or `None` to
+            leave the file unchanged.
+
+        mode(str):
+            `'b'` to read and write `bytes`, `''` for `str`, the same as `fread`.
+
+        timeout(float):
+            max seconds to wait for the lock, or `None` to wait forever.
+            `LockTimeout` is raised if the lock is not acquired in time.
+
+        uid, gid:
+            specifies the owner of the file, the same as `fwrite`.
+
+        fsync(bool):
+            specify if need to synchronize data to storage device.
+
+    Returns:
+        the content returned by the function.
+    """
+    func = paths_func[-1]
+    path = os.path.join(*paths_func[:-1])
+
+    with FileLock(path, timeout=timeout):
+        try:
+            cont = fread(path, mode=mode)
+        except FileNotFoundError:
+            cont = None
+
+        cont = func(cont)
+        if cont is not None:
+            fwrite(path, cont, uid=uid, gid=gid, atomic=True, fsync=fsync)
+
+    return cont
+
+
+def _handle_error(onerror, func, path):
+    # called in an `except` block, `onerror` is the same as of `remove()`
+    exc_info = sys.exc_info()
+
+    if onerror == "raise":
+        raise exc_info[1]
+    elif onerror == "ignore":
+        pass
+    else:
+        onerror(func, path, exc_info)
+
+
+TRUNCATE_STEP = 1024**3
+
+
+@instrumented("remove", _join_path)
+def remove(*paths, onerror=None, truncate_step=None, free_limit=None):
+    """
+    Recursively delete `path`, the `path` is *file*, *directory* or *symbolic link*.
+    Symbolic links are removed, not followed.
+
+    Removing a huge file frees all of its extents at once, which may stall
+    other I/O of the device for seconds. With `truncate_step` or
+    `free_limit`, a file larger than a step is kept open while it is
+    removed, and then truncated from its end, a step at a time, until it is
+    closed. A file that can not be removed keeps its content. A file with
+    other hard links is removed at once, since its content is still in use.
+
+    Args:
+
+        paths:
+            is the path to remove.
+
+        onerror(str or callable):
+            - "raise": when error occur it raises the original error.
+            - "ignore": ignore error and go on.
+            - A callable:
+                it is called to handle the error with arguments `(func, path,
+                exc_info)` where func is *os.listdir*, *os.remove* or *os.rmdir*.
+
+        truncate_step(int):
+            is the number of bytes to free at a time from a huge file.
+            `None` to remove files at once, or `TRUNCATE_STEP` if `free_limit`
+            is given.
+
+        free_limit(int):
+            is the max number of bytes of files to free per second.
+            `None` means no limit.
+    """
+
+    path = os.path.join(*paths)
+
+    if onerror is None:
+        onerror = "raise"
+
+    if free_limit is not None and truncate_step is None:
+        truncate_step = TRUNCATE_STEP
+
+    try:
+        st = os.lstat(path)
+    except OSError:
+        # reported by os.remove() below
+        st = None
+
+    if st is None or not stat.S_ISDIR(st.st_mode):
+        fd = None
+        if (
+            st is not None
+            and truncate_step is not None
+            and stat.S_ISREG(st.st_mode)
+            and st.st_nlink == 1
+            and st.st_size > truncate_step
+        ):
+            fd = _open_to_truncate(path, st)
+
+        try:
+            try:
+                os.remove(path)
+            except os.error:
+                _handle_error(onerror, os.remove, path)
+                return
+
+            # truncated only after it is unlinked, so that a file that can
+            # not be removed never loses its content
+            if fd is not None:
+                _truncate_gently(fd, truncate_step, free_limit)
+        finally:
+            if fd is not None:
+                os.close(fd)
+        return
+
+    names = []
+    try:
+        names = os.listdir(path)
+    except os.error:
+        _handle_error(onerror, os.listdir, path)
+
+    for name in names:
+        fullname = os.path.join(path, name)
+        remove(fullname, onerror=onerror, truncate_step=truncate_step, free_limit=free_limit)
+
+    try:
+        os.rmdir(path)
+    except os.error:
+        _handle_error(onerror, os.rmdir, path)
+
+
+def _open_to_truncate(path, st):
+    """
+    Open the file `path` to truncate after it is unlinked, if it is still the
+    regular file of stat `st` and has no other hard link.
+    `None` if it can not be opened, then the file is removed at once.
+    """
+    try:
+        # O_NONBLOCK: it is not blocked if path is replaced with a fifo
+        fd = os.open(path, os.O_WRONLY | os.O_NOFOLLOW | os.O_NONBLOCK | os.O_CLOEXEC)
+    except OSError:
+        return None
+
+    try:
+        fst = os.fstat(fd)
+    except OSError:
+        fst = None
+
+    if (
+        fst is None
+        or not stat.S_ISREG(fst.st_mode)
+        or (fst.st_dev, fst.st_ino) != (st.st_dev, st.st_ino)
+        or fst.st_nlink != 1
+    ):
+        # replaced since it is checked
+        os.close(fd)
+        return None
+
+    return fd
+
+
+def _truncate_gently(fd, step, free_limit):
+    """
+    Truncate an unlinked file `fd` to at most `step` bytes, `step` bytes at
+    a time, at most `free_limit` bytes per second.
+
+    It is best effort: if the file can not be truncated, the rest of it is
+    freed at once when `fd` is closed.
+    """
+    try:
+        size = os.fstat(fd).st_size
+        while size > step:
+            t0 = time.time()
+
+            size -= step
+            os.ftruncate(fd, size)
+
+            if free_limit is None:
+                continue
+
+            time_sleep = float(step) / free_limit - (time.time() - t0)
+            if time_sleep > 0:
+                time.sleep(time_sleep)
+
+                if instrument.listeners:
+                    instrument.record("throttle_time", time_sleep)
+    except OSError:
+        pass
+
+
+# field of stat_many() result: array typecode
+_stat_fields = (
+    ("size", "q"),
+    ("mtime_ns", "q"),
+    ("ino", "Q"),
+    ("dev", "Q"),
+    ("mode", "I"),
+    ("nlink", "Q"),
+    ("blocks", "q"),
+)
+
+# number of paths a worker of stat_many() stats at a time
+STAT_BATCH = 1024
+
+
+class StatColumns(object):
+    """
+    Result of `stat_many`: one `array.array` of every stat field, whose i-th
+    element is of the i-th path, and an `errno` array of the error of every
+    path, `0` if it succeeded. Fields of a failed path are `0`.
+
+    A field takes 4 or 8 bytes per path, instead of hundreds of bytes of an
+    `os.stat_result`. An array supports the buffer protocol, thus it can be
+    used without copying by numpy, e.g.
+    `numpy.frombuffer(cols.size, dtype=numpy.int64).sum()`.
+
+    Attributes:
+
+        size, mtime_ns, blocks:     `array('q')`.
+        ino, dev, nlink:            `array('Q')`.
+        mode:                       `array('I')`.
+        errno:                      `array('i')`.
+    """
+
+    def __init__(self, n):
+        for name, typecode in _stat_fields:
+            setattr(self, name, array.array(typecode, [0]) * n)
+
+        self.errno = array.array("i", [0]) * n
+
+    def __len__(self):
+        return len(self.errno)
+
+    def failed(self):
+        """
+        Returns:
+            list: indexes of the paths that failed.
+        """
+        return [i for i, e in enumerate(self.errno) if e != 0]
+
+    def get(self, i):
+        """
+        Returns:
+            dict: fields of the i-th path, or `None` if it failed.
+        """
+        if self.errno[i] != 0:
+            return None
+
+        return {name: getattr(self, name)[i] for name, _ in _stat_fields}
+
+
+@instrumented("stat_many")
+def stat_many(paths, workers=4, follow_symlinks=True):
+    """
+    Stat many paths concurrently, and keep the results in compact arrays.
+
+    Args:
+
+        paths:
+            an iterable of paths.
+
+        workers(int):
+            number of threads to stat with. Every thread stats `STAT_BATCH`
+            paths at a time.
+
+        follow_symlinks(bool):
+            `False` to stat a symbolic link itself, like `os.lstat`.
+
+    Returns:
+        StatColumns: the fields and the errors, in the order of `paths`.
+    """
+    paths = list(paths)
+    cols = StatColumns(len(paths))
+
+    batches = [(i, min(i + STAT_BATCH, len(paths))) for i in range(0, len(paths), STAT_BATCH)]
+
+    def _stat_batch(batch):
+        _stat_range(cols, paths, batch[0], batch[1], follow_symlinks)
+
+    if workers <= 1 or len(batches) <= 1:
+        for b in batches:
+            _stat_batch(b)
+    else:
+        from concurrent.futures import ThreadPoolExecutor
+
+        with ThreadPoolExecutor(min(workers, len(batches))) as pool:
+            list(pool.map(_stat_batch, batches))
+
+    return cols
+
+
+def _stat_range(cols, paths, start, end, follow_symlinks):
+    size = cols.size
+    mtime_ns = cols.mtime_ns
+    ino = cols.ino
+    dev = cols.dev
+    mode = cols.mode
+    nlink = cols.nlink
+    blocks = cols.blocks
+    errnos = cols.errno
+
+    for i in range(start, end):
+        try:
+            st = os.stat(paths[i], follow_symlinks=follow_symlinks)
+        except OSError as e:
+            errnos[i] = e.errno or errno.EIO
+            continue
+        except ValueError:
+            # such as a path with NUL in it
+            errnos[i] = errno.EINVAL
+            continue
+
+        size[i] = st.st_size
+        mtime_ns[i] = st.st_mtime_ns
+        ino[i] = st.st_ino
+        dev[i] = st.st_dev
+        mode[i] = st.st_mode
+        nlink[i] = st.st_nlink
+        blocks[i] = st.st_blocks
+
+
+def get_file_extents(*paths):
+    """
+    Find the data extents and holes of a sparse file with `SEEK_DATA`/`SEEK_HOLE`.
+
+    On a system or file system that can not report holes, the entire file is
+    returned as one data extent.
+
+    Args:
+
+        paths:
+            is the path of the file.
+
+    Returns:
+        list: of `(offset, length, is_data)` tuples that cover the file in order.
+        `is_data` is `False` for a hole, which reads as zeros without any disk I/O.
+    """
+    path = os.path.join(*paths)
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return _get_extents(fd)
+    finally:
+        os.close(fd)
+
+
+def _is_stream(st):
+    """
+    Whether a file is read sequentially until EOF, instead of by its extents:
+    a pipe, a char device, or a file whose size is not known from stat, such
+    as one in procfs or sysfs.
+    """
+    return not stat.S_ISREG(st.st_mode) or st.st_size == 0
+
+
+def _get_extents(fd):
+    # lseek() moves the file offset, so extents are all collected before any read.
+    size = os.fstat(fd).st_size
+    if size == 0:
+        return []
+
+    if not hasattr(os, "SEEK_DATA"):
+        return [(0, size, True)]
+
+    extents = []
+    pos = 0
+    while pos < size:
+        try:
+            data = os.lseek(fd, pos, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # no data after pos, the rest is a hole
+                data = size
+            elif e.errno == errno.EINVAL and pos == 0:
+                # file system does not support SEEK_DATA
+                return [(0, size, True)]
+            else:
+                raise
+
+        data = min(data, size)
+        if data > pos:
+            extents.append((pos, data - pos, False))
+
+        if data == size:
+            break
+
+        hole = min(os.lseek(fd, data, os.SEEK_HOLE), size)
+        extents.append((data, hole - data, True))
+        pos = hole
+
+    return extents
+
+
+_zero_buf = b""
+
+
+def _zeros(size):
+    # Holes are fed to consumers from one shared buffer of zeros.
+    global _zero_buf
+
+    if len(_zero_buf) < size:
+        _zero_buf = bytes(size)
+
+    return memoryview(_zero_buf)[:size]
+
+
+def _iter_file_blocks(fd, block_size, io_limit, extents=None):
+    """
+    Yield the content of file `fd` in blocks of at most `block_size` bytes.
+    Data extents are read with `pread()` and throttled by `io_limit` bytes per
+    second. Holes are yielded from a shared zero buffer without I/O or throttling.
+
+    `extents` limits reading to a part of the file. By default it is all of
+    `_get_extents(fd)`, and then what is appended to the file while it is
+    read, until `pread()` returns nothing. A file for which `_is_stream()` is
+    true is read with `read()` until EOF.
+
+    `io_limit` is a number, or an object such as `AdaptiveThrottle`, whose
+    `wait(nbytes)` is called after every read and returns the seconds slept.
+    """
+    sequential = False
+
+    if extents is None:
+        st = os.fstat(fd)
+        if _is_stream(st):
+            sequential = True
+            extents = [(0, None, True)]
+        else:
+            extents = _get_extents(fd)
+            # length None: up to the end of file when it is read
+            end = extents[-1][0] + extents[-1][1] if len(extents) > 0 else 0
+            extents.append((end, None, True))
+
+    throttle = getattr(io_limit, "wait", None)
+
+    for offset, length, is_data in extents:
+        end = offset + length if length is not None else None
+
+        while end is None or offset < end:
+            size = block_size if end is None else min(block_size, end - offset)
+
+            if not is_data:
+                yield _zeros(size)
+                offset += size
+                continue
+
+            t0 = time.time()
+
+            if sequential:
+                buf = os.read(fd, size)
+            else:
+                buf = os.pread(fd, size, offset)
+
+            if len(buf) == 0:
+                # end of file, or file is truncated
+                return
+
+            if throttle is not None:
+                time_sleep = throttle(len(buf))
+            else:
+                t1 = time.time()
+
+                time_sleep = float(len(buf)) / io_limit - (t1 - t0)
+                if time_sleep > 0:
+                    time.sleep(time_sleep)
+
+            if instrument.listeners:
+                instrument.record("bytes", len(buf))
+                instrument.record("blocks", 1)
+                instrument.record("throttle_time", max(time_sleep, 0))
+
+            yield buf
+            offset += len(buf)
+
+
+class _Crc32(object):
+    def __init__(self):
+        self.crc = 0
+
+    def update(self, buf):
+        # zlib.crc32() releases the GIL for large buffers, binascii.crc32() does not.
+        self.crc = zlib.crc32(buf, self.crc)
+
+    def hexdigest(self):
+        return "%08x" % (self.crc & 0xFFFFFFFF)
+
+
+def _hashlib_algorithm(name):
+    def _new():
+        import hashlib
+
+        return getattr(hashlib, name)()
+
+    return _new
+
+
+_checksum_algorithms = {
+    "sha1": _hashlib_algorithm("sha1"),
+    "md5": _hashlib_algorithm("md5"),
+    "crc32": _Crc32,
+    "sha256": _hashlib_algorithm("sha256"),
+    "sha512": _hashlib_algorithm("sha512"),
+    "blake2b": _hashlib_algorithm("blake2b"),
+    "sha3_256": _hashlib_algorithm("sha3_256"),
+    "sha3_512": _hashlib_algorithm("sha3_512"),
+}
+
+
+def register_checksum(name, factory):
+    """
+    Register a checksum algorithm so that it can be used by `calc_checksums`.
+
+    Args:
+
+        name(str):
+            is the name of the algorithm, as the key in the result of `calc_checksums`.
+
+        factory(callable):
+            is called without argument to create a new hasher.
+            The hasher must provide `update(buf)` and `hexdigest()`, like the
+            objects created by `hashlib`.
+    """
+    _checksum_algorithms[name] = factory
+
+
+@instrumented("calc_checksums", _first_arg)
+def calc_checksums(
+    path,
+    sha1=False,
+    md5=False,
+    crc32=False,
+    sha256=False,
+    block_size=READ_BLOCK,
+    io_limit=READ_BLOCK,
+    algorithms=(),
+    parallel=False,
+):
+    """
+    Calculate checksums of the content of file `path`.
+
+    Holes in a sparse file are detected with `SEEK_DATA`/`SEEK_HOLE` and are
+    hashed from a shared zero buffer, without reading them from disk.
+
+    Args:
+
+        path:
+            is the path of the file.
+
+        sha1, md5, crc32, sha256(bool):
+            specify which checksums to calculate.
+
+        block_size(int):
+            is the max number of bytes to read and hash at a time.
+
+        io_limit(int):
+            is the max number of bytes to read per second.
+            A negative value means no limit.
+            It can also be an `AdaptiveThrottle`, to adjust the limit by how
+            busy the device is.
+
+        algorithms(list):
+            names of more algorithms to calculate, such as `sha512`, `blake2b`,
+            `sha3_256`, `sha3_512` or one added with `register_checksum`.
+
+        parallel(bool):
+            hash each block with all of the algorithms concurrently in threads,
+            while the next block is being read.
+            It speeds up calculating several expensive checksums at the same time.
+
+    Returns:
+        dict: of checksums in hex string.
+        Keys are `sha1`, `md5`, `crc32`, `sha256` and names in `algorithms`.
+        A checksum not calculated is `None`.
+    """
+    checksums = {"sha1": None, "md5": None, "crc32": None, "sha256": None}
+
+    names = [n for n, enabled in (("sha1", sha1), ("md5", md5), ("crc32", crc32), ("sha256", sha256)) if enabled]
+    for n in algorithms:
+        if n not in _checksum_algorithms:
+            raise FSUtilError("unknown checksum algorithm: {n}".format(n=n))
+
+        checksums[n] = None
+        if n not in names:
+            names.append(n)
+
+    if len(names) == 0:
+        return checksums
+
+    if block_size <= 0:
+        raise FSUtilError("block_size must be positive integer")
+
+    if io_limit == 0:
+        raise FSUtilError("io_limit shoud not be zero")
+
+    hashers = [_checksum_algorithms[n]() for n in names]
+
+    with open(path, "rb") as f_path:
+        blocks = _iter_file_blocks(f_path.fileno(), block_size, io_limit)
+
+        if parallel and len(hashers) > 1:
+            _update_parallel(hashers, blocks)
+        else:
+            for buf in blocks:
+                for h in hashers:
+                    h.update(buf)
+
+    for n, h in zip(names, hashers):
+        checksums[n] = h.hexdigest()
+
+    return checksums
+
+
+def _update_parallel(hashers, blocks):
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(len(hashers)) as pool:
+        futures = []
+
+        # Pulling the next block from `blocks` reads it while the previous
+        # block is still being hashed.
+        for buf in blocks:
+            for fu in futures:
+                fu.result()
+
+            futures = [pool.submit(h.update, buf) for h in hashers]
+
+        for fu in futures:
+            fu.result()
+
+
+RANGE_SIZE = 256 * 1024 * 1024
+
+
+@instrumented("calc_range_checksums", _first_arg)
+def calc_range_checksums(
+    path,
+    algorithm="sha256",
+    range_size=RANGE_SIZE,
+    block_size=READ_BLOCK,
+    io_limit=-1,
+    workers=4,
+):
+    """
+    Calculate a checksum of every fixed size range of file `path`, and a tree
+    hash of them, to hash a huge file with several cores and several reads in
+    flight, which `calc_checksums` can not.
+
+    Ranges are hashed by `workers` threads, each reading its range with
+    `pread()`. Holes are not read, the same as `calc_checksums`.
+
+    The tree hash is a binary Merkle tree over the raw range digests:
+    a leaf is `H(b"\\x00" + range digest)`, every two adjacent nodes are
+    hashed to one, `H(b"\\x01" + left + right)`, a last odd one is moved up
+    as it is, until one is left. An empty file has `H(b"")` as the top node.
+    The tree hash is `H(b"\\x02" + size + range_size + top node)`, with sizes
+    as 8 byte big endian integers, thus it can only be compared with one
+    calculated with the same `range_size`.
+
+    Args:
+
+        path:
+            is the path of the file.
+
+        algorithm(str):
+            is the checksum algorithm, one of the algorithms of `calc_checksums`.
+
+        range_size(int):
+            is the number of bytes of each range to hash.
+            The last range may be shorter.
+
+        block_size(int):
+            is the max number of bytes to read and hash at a time.
+
+        io_limit(int):
+            is the max number of bytes to read per second, by all of the workers.
+            A negative value means no limit.
+            It can also be an `AdaptiveThrottle`, which is shared by the workers.
+
+        workers(int):
+            number of ranges to hash concurrently.
+
+    Returns:
+        dict: in the following format::
+
+            {
+                'algorithm':  'sha256',
+                'range_size': 268435456,
+                'ranges':     [(offset, length, checksum in hex), ...],
+                'digest':     the tree hash in hex,
+            }
+    """
+    if algorithm not in _checksum_algorithms:
+        raise FSUtilError("unknown checksum algorithm: {n}".format(n=algorithm))
+
+    if range_size <= 0 or block_size <= 0:
+        raise FSUtilError("range_size and block_size must be positive integer")
+
+    if io_limit == 0:
+        raise FSUtilError("io_limit shoud not be zero")
+
+    with open(path, "rb") as f:
+        fd = f.fileno()
+
+        if _is_stream(os.fstat(fd)):
+            # the size is unknown until it is read, ranges are hashed as they are read
+            jobs, digests = _hash_stream_ranges(fd, algorithm, range_size, block_size, io_limit)
+            size = sum(x[1] for x in jobs)
+
+            return {
+                "algorithm": algorithm,
+                "range_size": range_size,
+                "ranges": [(offset, length, d) for (offset, length), d in zip(jobs, digests)],
+                "digest": _tree_hash(algorithm, digests, size, range_size),
+            }
+
+        workers = max(workers, 1)
+        if isinstance(io_limit, (int, float)) and io_limit > 0:
+            # every worker takes its share of the limit
+            io_limit = float(io_limit) / workers
+
+        extents = _get_extents(fd)
+        size = sum(x[1] for x in extents)
+        jobs = [(offset, min(range_size, size - offset)) for offset in range(0, size, range_size)]
+
+        def _hash_range(job):
+            offset, length = job
+            h = _checksum_algorithms[algorithm]()
+            for buf in _iter_file_blocks(fd, block_size, io_limit, _clip_extents(extents, offset, length)):
+                h.update(buf)
+            return h.hexdigest()
+
+        if workers == 1 or len(jobs) <= 1:
+            digests = [_hash_range(j) for j in jobs]
+        else:
+            from concurrent.futures import ThreadPoolExecutor
+
+            with ThreadPoolExecutor(min(workers, len(jobs))) as pool:
+                digests = list(pool.map(_hash_range, jobs))
+
+    if instrument.listeners:
+        # blocks are read in worker threads, in which no event is recorded
+        instrument.record("bytes", sum(x[1] for x in extents if x[2]))
+
+    return {
+        "algorithm": algorithm,
+        "range_size": range_size,
+        "ranges": [(offset, length, d) for (offset, length), d in zip(jobs, digests)],
+        "digest": _tree_hash(algorithm, digests, size, range_size),
+    }
+
+
+def _hash_stream_ranges(fd, algorithm, range_size, block_size, io_limit):
+    jobs = []
+    digests = []
+
+    h = None
+    offset = 0
+    for buf in _iter_file_blocks(fd, block_size, io_limit):
+        buf = memoryview(buf)
+        while len(buf) > 0:
+            if h is None:
+                h = _checksum_algorithms[algorithm]()
+                start = offset
+
+            n = min(len(buf), start + range_size - offset)
+            h.update(buf[:n])
+            buf = buf[n:]
+            offset += n
+
+            if offset - start == range_size:
+                jobs.append((start, range_size))
+                digests.append(h.hexdigest())
+                h = None
+
+    if h is not None:
+        jobs.append((start, offset - start))
+        digests.append(h.hexdigest())
+
+    return jobs, digests
+
+
+def _clip_extents(extents, offset, length):
+    end = offset + length
+    rst = []
+    for ext_offset, ext_length, is_data in extents:
+        start = max(ext_offset, offset)
+        stop = min(ext_offset + ext_length, end)
+        if start < stop:
+            rst.append((start, stop - start, is_data))
+
+    return rst
+
+
+def _tree_hash(algorithm, hex_digests, size, range_size):
+    def _h(buf):
+        h = _checksum_algorithms[algorithm]()
+        h.update(buf)
+        return bytes.fromhex(h.hexdigest())
+
+    # leaves and inner nodes are hashed with different prefixes, so that a
+    # leaf can not be taken as an inner node of another tree, or vice versa.
+    level = [_h(b"\x00" + bytes.fromhex(d)) for d in hex_digests]
+
+    if len(level) == 0:
+        level = [_h(b"")]
+
+    while len(level) > 1:
+        upper = [_h(b"\x01" + level[i] + level[i + 1]) for i in range(0, len(level) - 1, 2)]
+
+        if len(level) % 2 == 1:
+            upper.append(level[-1])
+
+        level = upper
+
+    return _h(b"\x02" + size.to_bytes(8, "big") + range_size.to_bytes(8, "big") + level[0]).hex()
+
+
+COMPARE_BLOCK = 1024 * 1024
+
+
+@instrumented("compare_files", _first_arg)
+def compare_files(a, b, block_size=COMPARE_BLOCK, workers=4, ranges=False):
+    """
+    Compare the content of two files, such as a file and its replica.
+
+    Files of different sizes, or two paths of the same inode, are compared
+    without reading them. Otherwise blocks are read with `pread()` by
+    `workers` threads, in order of offset, and reading stops at the first
+    block that differs.
+
+    Args:
+
+        a, b:
+            are the paths of the files.
+
+        block_size(int):
+            is the number of bytes to read from each file and compare at a time.
+
+        workers(int):
+            number of blocks to compare concurrently.
+
+        ranges(bool):
+            read both files entirely and return where they differ, instead
+            of whether they are the same.
+
+    Returns:
+        bool: `True` if the content is the same.
+        Or, if `ranges` is `True`, a list of `(offset, length)` of the byte
+        ranges that differ, in units of `block_size`, adjacent ones merged.
+        The part of the longer file past the end of the shorter one is the
+        last range. An empty list means the content is the same.
+    """
+    if block_size <= 0:
+        raise FSUtilError("block_size must be positive integer")
+
+    fa = os.open(a, os.O_RDONLY | os.O_CLOEXEC)
+    try:
+        fb = os.open(b, os.O_RDONLY | os.O_CLOEXEC)
+        try:
+            diffs = _compare_fds(fa, fb, block_size, workers, ranges)
+        finally:
+            os.close(fb)
+    finally:
+        os.close(fa)
+
+    if ranges:
+        return diffs
+
+    return len(diffs) == 0
+
+
+def _compare_fds(fa, fb, block_size, workers, ranges):
+    st_a = os.fstat(fa)
+    st_b = os.fstat(fb)
+
+    if (st_a.st_dev, st_a.st_ino) == (st_b.st_dev, st_b.st_ino):
+        return []
+
+    if _is_stream(st_a) or _is_stream(st_b):
+        return _compare_streams(fa, fb, block_size, ranges)
+
+    size = min(st_a.st_size, st_b.st_size)
+    longer = max(st_a.st_size, st_b.st_size)
+
+    if longer > size and not ranges:
+        return [(size, longer - size)]
+
+    diffs = []
+
+    def _add(offset, length):
+        _add_range(diffs, offset, length)
+
+    blocks = _iter_compared_blocks(fa, fb, size, block_size, workers)
+    try:
+        for offset, length, same in blocks:
+            if instrument.listeners:
+                instrument.record("bytes", length * 2)
+                instrument.record("blocks", 2)
+
+            if not same:
+                _add(offset, length)
+                if not ranges:
+                    return diffs
+    finally:
+        # stop the workers before the files are closed
+        blocks.close()
+
+    if longer > size:
+        _add(size, longer - size)
+
+    return diffs
+
+
+def _add_range(diffs, offset, length):
+    # merge with the last range if they are adjacent
+    if len(diffs) > 0 and sum(diffs[-1]) == offset:
+        offset, length = diffs[-1][0], diffs.pop()[1] + length
+    diffs.append((offset, length))
+
+
+def _iter_exact_blocks(blocks, block_size):
+    # a pipe returns what is available, blocks of the two files are aligned
+    buf = bytearray()
+    for b in blocks:
+        buf += b
+        while len(buf) >= block_size:
+            yield bytes(buf[:block_size])
+            del buf[:block_size]
+
+    if len(buf) > 0:
+        yield bytes(buf)
+
+
+def _compare_streams(fa, fb, block_size, ranges):
+    """
+    Compare two files sequentially, at least one of which has no known size,
+    such as a pipe or a procfs file.
+    """
+    blocks_a = _iter_exact_blocks(_iter_file_blocks(fa, block_size, -1), block_size)
+    blocks_b = _iter_exact_blocks(_iter_file_blocks(fb, block_size, -1), block_size)
+
+    diffs = []
+    offset = 0
+    while True:
+        a = next(blocks_a, b"")
+        b = next(blocks_b, b"")
+        if len(a) == 0 and len(b) == 0:
+            return diffs
+
+        n = min(len(a), len(b))
+        if a[:n] != b[:n]:
+            _add_range(diffs, offset, n)
+        if len(a) != len(b):
+            # one of them ends
+            _add_range(diffs, offset + n, max(len(a), len(b)) - n)
+
+        if len(diffs) > 0 and not ranges:
+            return diffs
+
+        offset += max(len(a), len(b))
+
+
+def _compare_block(fa, fb, offset, length):
+    return os.pread(fa, length, offset) == os.pread(fb, length, offset)
+
+
+def _iter_compared_blocks(fa, fb, size, block_size, workers):
+    """
+    Yield `(offset, length, same)` of every block in `[0, size)`, in order.
+
+    At most `workers * 2` blocks are being compared or done but not yet
+    yielded. If the caller stops early, blocks not started are cancelled.
+    """
+    blocks = ((offset, min(block_size, size - offset)) for offset in range(0, size, block_size))
+
+    if workers <= 1:
+        for offset, length in blocks:
+            yield offset, length, _compare_block(fa, fb, offset, length)
+        return
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(workers) as pool:
+        pending = collections.deque()
+        try:
+            for offset, length in blocks:
+                pending.append((offset, length, pool.submit(_compare_block, fa, fb, offset, length)))
+                if len(pending) >= workers * 2:
+                    offset, length, fu = pending.popleft()
+                    yield offset, length, fu.result()
+
+            while len(pending) > 0:
+                offset, length, fu = pending.popleft()
+                yield offset, length, fu.result()
+        finally:
+            for _, _, fu in pending:
+                fu.cancel()
+
+
+class TreeDigestCache(_LRUCache):
+    """
+    LRU cache of intermediate digests for `tree_digest`.
+
+    For every directory it keeps the stat of the directory and of its entries,
+    the digests of its files and the digest of the directory.
+    A file is hashed again only if its stat changes, and a directory digest is
+    reused if neither its entries nor its sub directory digests change.
+    A cache is used with only one digest algorithm.
+
+    The digest of a file changed within `racy_ns` is not kept, nor the digest
+    of the directory containing it.
+
+    Args:
+
+        max_entries(int):
+            the max total number of directories and files kept.
+            The least recently used directories are evicted when it is exceeded.
+    """
+
+    def __init__(self, max_entries=1024 * 1024):
+        super().__init__(max_entries)
+
+    @property
+    def n_entries(self):
+        return self.cost
+
+    def invalidate(self, path):
+        """
+        Drop cached digests of the directory `path` and of the directory containing `path`.
+        """
+        path = os.path.abspath(path)
+        self._invalidate(path, os.path.dirname(path))
+
+
+def tree_digest(*paths, algorithm="sha256", cache=None, workers=4, executor=None):
+    """
+    Calculate a Merkle digest of a directory tree.
+
+    The digest of a directory is calculated from its sorted entries, by entry
+    name, type, permission mode and the digest of the entry:
+    the content digest of a file by `calc_checksums`, the tree digest of a sub
+    directory, or the digest of the target of a symbolic link.
+    Symbolic links are not followed.
+
+    Args:
+
+        paths:
+            is the path of the directory.
+            If it is a file, the content digest of the file is returned.
+
+        algorithm(str):
+            is the name of a checksum algorithm supported by `calc_checksums`.
+
+        cache(TreeDigestCache):
+            keeps digests between calls, so that calculating the digest again
+            of a mostly unchanged tree hashes only the changed files.
+
+        workers(int):
+            is the number of threads to hash files with.
+
+        executor(concurrent.futures.Executor):
+            to hash files in, instead of `workers` threads, such as a
+            `DeviceScheduler` for a tree over several mount points.
+
+    Returns:
+        str: the digest in hex string.
+    """
+    path = os.path.abspath(os.path.join(*paths))
+
+    if algorithm not in _checksum_algorithms:
+        raise FSUtilError("unknown checksum algorithm: {n}".format(n=algorithm))
+
+    if not stat.S_ISDIR(os.lstat(path).st_mode):
+        return _file_digest(path, algorithm)
+
+    if cache is None:
+        cache = TreeDigestCache()
+
+    # to hash: (file digests dict of a dir node, file name, path)
+    pending = []
+    root = _scan_tree(path, algorithm, cache, pending)
+
+    def _hash(pool):
+        digests = pool.map(_file_digest, [x[2] for x in pending], [algorithm] * len(pending))
+
+        for (files, name, _), digest in zip(pending, digests):
+            files[name] = (files[name][0], digest)
+
+    if executor is not None:
+        _hash(executor)
+    else:
+        from concurrent.futures import ThreadPoolExecutor
+
+        with ThreadPoolExecutor(workers) as pool:
+            _hash(pool)
+
+    return _sum_tree(root, algorithm, cache)
+
+
+def _file_digest(path, algorithm):
+    return calc_checksums(path, algorithms=[algorithm], io_limit=-1)[algorithm]
+
+
+def _stat_key(st):
+    return (st.st_mode, st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+def _scan_tree(path, algorithm, cache, pending):
+    st = os.lstat(path)
+    # keyed by the absolute path
+    cached = cache._get(path)
+
+    entries = []
+    files = {}
+    subdirs = {}
+
+    with os.scandir(path) as it:
+        for ent in it:
+            ent_st = ent.stat(follow_symlinks=False)
+            key = _stat_key(ent_st)
+            entries.append((ent.name, key))
+
+            if stat.S_ISDIR(ent_st.st_mode):
+                subdirs[ent.name] = _scan_tree(ent.path, algorithm, cache, pending)
+                continue
+
+            digest = None
+            if cached is not None:
+                c = cached["files"].get(ent.name)
+                if c is not None and c[0] == key:
+                    digest = c[1]
+
+            if digest is None:
+                if stat.S_ISREG(ent_st.st_mode):
+                    pending.append((files, ent.name, ent.path))
+                elif stat.S_ISLNK(ent_st.st_mode):
+                    h = _checksum_algorithms[algorithm]()
+                    h.update(os.fsencode(os.readlink(ent.path)))
+                    digest = h.hexdigest()
+                else:
+                    # fifo, socket or device has no content
+                    digest = ""
+
+            files[ent.name] = (key, digest)
+
+    entries.sort()
+
+    return {
+        "path": path,
+        "key": (st.st_dev, st.st_ino, st.st_mtime_ns, tuple(entries)),
+        "files": files,
+        "subdirs": subdirs,
+    }
+
+
+def _sum_tree(node, algorithm, cache):
+    subdir_digests = {}
+    for name, sub in node["subdirs"].items():
+        subdir_digests[name] = _sum_tree(sub, algorithm, cache)
+
+    cached = cache._get(node["path"])
+    if (
+        cached is not None
+        and cached["digest"] is not None
+        and cached["key"] == node["key"]
+        and cached["subdirs"] == subdir_digests
+    ):
+        return cached["digest"]
+
+    h = _checksum_algorithms[algorithm]()
+
+    for name, (mode, _, _, _) in node["key"][3]:
+        if stat.S_ISDIR(mode):
+            typ, digest = "d", subdir_digests[name]
+        else:
+            typ, digest = _entry_type(mode), node["files"][name][1]
+
+        h.update("{typ} {mode:o} {digest} ".format(typ=typ, mode=stat.S_IMODE(mode), digest=digest).encode("utf-8"))
+        h.update(os.fsencode(name) + b"\0")
+
+    digest = h.hexdigest()
+
+    # a digest of a file changed recently and of the dir containing it is not reused.
+    files = {name: c for name, c in node["files"].items() if not cache._is_racy(c[0][3])}
+    racy = len(files) < len(node["files"]) or cache._is_racy(node["key"][2])
+
+    cache._put(
+        node["path"],
+        node["path"],
+        {
+            "key": node["key"],
+            "digest": None if racy else digest,
+            "files": files,
+            "subdirs": subdir_digests,
+        },
+        len(files) + 1,
+    )
+
+    return digest
+
+
+def _entry_type(mode):
+    if stat.S_ISREG(mode):
+        return "f"
+    if stat.S_ISLNK(mode):
+        return "l"
+    return "o"
 
 
 def _to_dict(_namedtuple):
@@ -0,0 +1,390 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Watch file system changes with Linux inotify, through ctypes.
+
+Usage::
+
+    w = Watcher('/data', recursive=True)
+    w.attach(tree_digest_cache)
+
+    for ev in w.events():
+        print(ev.path, ev.mask)
+
+A cache attached to a watcher has its entries invalidated by the events read
+from the watcher, instead of being checked or expired by time.
+"""
+
+import errno
+import os
+import struct
+import time
+
+from ._libc import check as _check
+from ._libc import load_libc
+
+IN_ACCESS = 0x00000001
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_CLOSE_NOWRITE = 0x00000010
+IN_OPEN = 0x00000020
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_UNMOUNT = 0x00002000
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+# events that change the content, the metadata or the entries of a dir.
+IN_CHANGES = (
+    IN_MODIFY
+    | IN_ATTRIB
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+)
+
+_event_header = struct.Struct("iIII")
+
+
+def _declare(libc, ctypes):
+    libc.inotify_init1.argtypes = [ctypes.c_int]
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+
+
+def _get_libc():
+    return load_libc(_declare)
+
+
+class WatchEvent(object):
+    """
+    A change of a path.
+
+    Attributes:
+        path(str):  the path changed, or `None` for an overflow event.
+        mask(int):  bits of `IN_*` of all coalesced changes of the path.
+    """
+
+    __slots__ = ("path", "mask")
+
+    def __init__(self, path, mask):
+        self.path = path
+        self.mask = mask
+
+    @property
+    def is_dir(self):
+        return bool(self.mask & IN_ISDIR)
+
+    @property
+    def overflow(self):
+        """
+        `True` if events are lost because the kernel queue overflows.
+        The caller should rescan everything it watches.
+        """
+        return bool(self.mask & IN_Q_OVERFLOW)
+
+    def __repr__(self):
+        return "WatchEvent(path={p!r}, mask={m:#x})".format(p=self.path, m=self.mask)
+
+
+class Watcher(object):
+    """
+    Watch changes of dirs with inotify.
+
+    Events of one path that arrive within `coalesce` seconds are merged into
+    one `WatchEvent`. If the kernel queue overflows, an event with
+    `overflow=True` is returned and attached caches are cleared.
+
+    Args:
+
+        paths:
+            dirs or files to watch.
+
+        recursive(bool):
+            watch all sub dirs too, including the sub dirs created later.
+
+        mask(int):
+            bits of `IN_*` events to watch.
+
+        coalesce(float):
+            seconds to wait for more events after the first one.
+    """
+
+    def __init__(self, *paths, recursive=True, mask=IN_CHANGES, coalesce=0.05):
+        self.recursive = recursive
+        self.mask = mask
+        self.coalesce = coalesce
+
+        self.caches = []
+
+        # watch descriptor to path and path to watch descriptor
+        self.paths = {}
+        self.wds = {}
+
+        self.fd = _check(_get_libc().inotify_init1(IN_NONBLOCK | IN_CLOEXEC))
+
+        for p in paths:
+            self.add(p)
+
+    def add(self, path):
+        """
+        Watch `path`, and its sub dirs if `recursive` is `True`.
+        """
+        path = os.path.abspath(path)
+
+        self._add_watch(path)
+
+        if self.recursive and os.path.isdir(path):
+            for root, dirs, _ in os.walk(path):
+                for d in dirs:
+                    sub = os.path.join(root, d)
+                    if not os.path.islink(sub):
+                        self._add_watch(sub)
+
+    def _add_watch(self, path):
+        mask = self.mask | IN_DONT_FOLLOW
+        if self.recursive:
+            mask |= IN_CREATE | IN_MOVED_TO | IN_MOVED_FROM | IN_DELETE_SELF
+
+        try:
+            wd = _check(_get_libc().inotify_add_watch(self.fd, os.fsencode(path), mask), path)
+        except FileNotFoundError:
+            # removed before it is watched
+            return
+
+        old = self.paths.get(wd)
+        if old is not None:
+            self.wds.pop(old, None)
+
+        self.paths[wd] = path
+        self.wds[path] = wd
+
+    def remove(self, path):
+        """
+        Stop watching `path` and all paths under it.
+        """
+        path = os.path.abspath(path)
+        prefix = path.rstrip("/") + "/"
+
+        for p in [p for p in self.wds if p == path or p.startswith(prefix)]:
+            wd = self.wds.pop(p)
+            del self.paths[wd]
+            # EINVAL if the watch is already removed by the kernel
+            _get_libc().inotify_rm_watch(self.fd, wd)
+
+    def attach(self, cache):
+        """
+        Invalidate entries of `cache` with the events read from this watcher.
+
+        Args:
+
+            cache:
+                must provide `invalidate(path)`, called for every changed path,
+                and `clear()`, called if events are lost.
+                Such as `TreeDigestCache` or `ListingCache`.
+        """
+        if cache not in self.caches:
+            self.caches.append(cache)
+
+    def detach(self, cache):
+        if cache in self.caches:
+            self.caches.remove(cache)
+
+    def read(self, timeout=None):
+        """
+        Wait for and return a list of coalesced events.
+
+        Args:
+
+            timeout(float):
+                seconds to wait for the first event. `None` to wait forever.
+
+        Returns:
+            list: of `WatchEvent`, empty if no event arrives before `timeout`.
+        """
+        import select
+
+        poller = select.poll()
+        poller.register(self.fd, select.POLLIN)
+
+        ms = None if timeout is None else int(timeout * 1000)
+        if len(poller.poll(ms)) == 0:
+            return []
+
+        raw = self._read_raw()
+
+        # wait for the burst to end, but no longer than 20 coalesce windows
+        deadline = time.monotonic() + self.coalesce * 20
+        while self.coalesce > 0 and time.monotonic() < deadline:
+            if len(poller.poll(int(self.coalesce * 1000))) == 0:
+                break
+            raw.extend(self._read_raw())
+
+        return self._handle(raw)
+
+    def _read_raw(self):
+        raw = []
+
+        while True:
+            try:
+                buf = os.read(self.fd, 64 * 1024)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+
+            offset = 0
+            while offset < len(buf):
+                wd, mask, _, size = _event_header.unpack_from(buf, offset)
+                offset += _event_header.size
+
+                name = buf[offset : offset + size].rstrip(b"\0")
+                offset += size
+
+                raw.append((wd, mask, os.fsdecode(name)))
+
+        return raw
+
+    def _handle(self, raw):
+        merged = {}
+
+        for wd, mask, name in raw:
+            if mask & IN_Q_OVERFLOW:
+                for cache in self.caches:
+                    cache.clear()
+                return [WatchEvent(None, IN_Q_OVERFLOW)]
+
+            base = self.paths.get(wd)
+            if base is None:
+                continue
+
+            path = os.path.join(base, name) if name else base
+
+            if mask & IN_IGNORED:
+                # watch removed by kernel, because the path is removed or unmounted
+                if self.paths.get(wd) == path:
+                    del self.paths[wd]
+                    self.wds.pop(path, None)
+                continue
+
+            if self.recursive and mask & IN_ISDIR and name:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self.add(path)
+                elif mask & IN_MOVED_FROM:
+                    self.remove(path)
+
+            if path in merged:
+                merged[path].mask |= mask
+            else:
+                merged[path] = WatchEvent(path, mask)
+
+        events = list(merged.values())
+
+        for cache in self.caches:
+            for ev in events:
+                cache.invalidate(ev.path)
+
+        return events
+
+    def events(self, timeout=None):
+        """
+        Yield coalesced `WatchEvent` until the watcher is closed.
+
+        Args:
+
+            timeout(float):
+                stop if no event arrives in `timeout` seconds. `None` to wait forever.
+        """
+        while self.fd is not None:
+            evs = self.read(timeout)
+            if len(evs) == 0:
+                return
+
+            yield from evs
+
+    async def stream(self):
+        """
+        Asynchronously yield coalesced `WatchEvent` until the watcher is closed.
+        Events are read without blocking the event loop, and are coalesced
+        the same way as `read()`.
+
+        Usage::
+
+            async for ev in watcher.stream():
+                ...
+        """
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        batches = asyncio.Queue()
+
+        raw = []
+        # timer of the current coalesce window, deadline of the burst and
+        # number of raw events when the window started
+        burst = {"timer": None, "deadline": 0, "n": 0}
+
+        def _flush():
+            # wait for the burst to end, but no longer than 20 coalesce windows
+            if len(raw) > burst["n"] and loop.time() < burst["deadline"]:
+                burst["n"] = len(raw)
+                burst["timer"] = loop.call_later(self.coalesce, _flush)
+                return
+
+            burst["timer"] = None
+            batch = raw[:]
+            del raw[:]
+            batches.put_nowait(self._handle(batch))
+
+        def _on_readable():
+            if self.fd is None:
+                return
+
+            got = self._read_raw()
+            if len(got) == 0:
+                return
+
+            raw.extend(got)
+            if burst["timer"] is None:
+                burst["n"] = len(raw)
+                burst["deadline"] = loop.time() + self.coalesce * 20
+                burst["timer"] = loop.call_later(self.coalesce, _flush)
+
+        fd = self.fd
+        loop.add_reader(fd, _on_readable)
+        try:
+            while self.fd is not None:
+                for ev in await batches.get():
+                    yield ev
+        finally:
+            loop.remove_reader(fd)
+            if burst["timer"] is not None:
+                burst["timer"].cancel()
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+            self.paths = {}
+            self.wds = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Instrumentation of k3fs operations.
+
+A listener added with `add_event_listener` is called with an event dict when
+an instrumented operation finishes:
+
+    {
+        'op':            operation name, such as 'fread' or 'calc_checksums',
+        'path':          the path operated on, or None,
+        'bytes':         number of bytes read or written,
+        'blocks':        number of blocks read or written,
+        'time':          wall time in second,
+        'throttle_time': time in second slept by `io_limit` throttling,
+        'fsync_time':    time in second spent in fsync,
+        'error':         the exception raised, or None,
+    }
+
+Operations called by another instrumented operation in the same thread are
+counted in the event of the outermost one.
+When no listener is added, instrumentation costs one list check per call.
+"""
+
+import functools
+import threading
+import time
+
+listeners = []
+
+_local = threading.local()
+
+
+def add_event_listener(listener):
+    """
+    Add a callable to receive an event dict of every k3fs operation.
+
+    Args:
+
+        listener(callable):
+            is called with one argument: the event dict.
+            It is called in the thread that runs the operation, thus it should be quick.
+    """
+    if listener not in listeners:
+        listeners.append(listener)
+
+
+def remove_event_listener(listener):
+    """
+    Remove a listener added by `add_event_listener`.
+    """
+    if listener in listeners:
+        listeners.remove(listener)
+
+
+def record(key, value):
+    """
+    Add `value` to field `key` of the event of the current operation.
+    """
+    ev = getattr(_local, "event", None)
+    if ev is not None:
+        ev[key] += value
+
+
+def instrumented(op, path_of=None):
+    """
+    Make a decorator to emit an event every time the decorated function is called.
+
+    Args:
+
+        op(str):
+            is the operation name.
+
+        path_of(callable):
+            gets the path from the positional arguments of the call.
+    """
+
+    def _deco(func):
+        @functools.wraps(func)
+        def _wrapper(*args, **kwargs):
+            if not listeners or getattr(_local, "event", None) is not None:
+                return func(*args, **kwargs)
+
+            ev = {
+                "op": op,
+                "path": None,
+                "bytes": 0,
+                "blocks": 0,
+                "time": 0.0,
+                "throttle_time": 0.0,
+                "fsync_time": 0.0,
+                "error": None,
+            }
+            if path_of is not None:
+                try:
+                    ev["path"] = path_of(args)
+                except (TypeError, ValueError, IndexError):
+                    pass
+
+            _local.event = ev
+            t0 = time.monotonic()
+            try:
+                return func(*args, **kwargs)
+            except BaseException as e:
+                ev["error"] = e
+                raise
+            finally:
+                ev["time"] = time.monotonic() - t0
+                _local.event = None
+                _emit(ev)
+
+        return _wrapper
+
+    return _deco
+
+
+def _emit(ev):
+    for listener in list(listeners):
+        try:
+            listener(ev)
+        except Exception:
+            import logging
+
+            logging.getLogger(__name__).exception("k3fs event listener %r failed with event: %r", listener, ev)
+
+
+class Metrics(object):
+    """
+    A listener that aggregates events into per-operation counters and latency histograms.
+
+    Usage::
+
+        m = Metrics()
+        add_event_listener(m)
+        ...
+        m.dump()
+    """
+
+    # upper bounds in second of latency buckets, from 1 microsecond to about 17 minutes.
+    buckets = tuple(2.0**i / 1000000 for i in range(31))
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ops = {}
+
+    def __call__(self, ev):
+        t = ev["time"]
+
+        with self.lock:
+            st = self.ops.get(ev["op"])
+            if st is None:
+                st = {
+                    "count": 0,
+                    "errors": 0,
+                    "bytes": 0,
+                    "blocks": 0,
+                    "time": 0.0,
+                    "throttle_time": 0.0,
+                    "fsync_time": 0.0,
+                    "max_time": 0.0,
+                    "histogram": [0] * (len(self.buckets) + 1),
+                }
+                self.ops[ev["op"]] = st
+
+            st["count"] += 1
+            if ev["error"] is not None:
+                st["errors"] += 1
+            st["bytes"] += ev["bytes"]
+            st["blocks"] += ev["blocks"]
+            st["time"] += t
+            st["throttle_time"] += ev["throttle_time"]
+            st["fsync_time"] += ev["fsync_time"]
+            st["max_time"] = max(st["max_time"], t)
+
+            i = 0
+            while i < len(self.buckets) and t > self.buckets[i]:
+                i += 1
+            st["histogram"][i] += 1
+
+    def dump(self):
+        """
+        Return the aggregated metrics.
+
+        Returns:
+            dict: indexed by operation name, of `count`, `errors`, `bytes`,
+            `blocks`, `time`, `throttle_time`, `fsync_time`, `max_time` and
+            `histogram`. `histogram` is a dict of latency bucket upper bound in
+            second to the number of operations in it, with only non-empty buckets.
+            The last bucket is `inf`.
+        """
+        bounds = [*self.buckets, float("inf")]
+
+        with self.lock:
+            rst = {}
+            for op, st in self.ops.items():
+                st = dict(st)
+                st["histogram"] = {b: n for b, n in zip(bounds, st["histogram"]) if n > 0}
+                rst[op] = st
+
+        return rst
+
+    def reset(self):
+        with self.lock:
+            self.ops = {}
@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Parse `/proc/self/mountinfo` of Linux into compact mount records.
+
+The parsed table is cached. Linux reports a change of the mount table by
+`poll()` on an open mountinfo file, thus the cache is checked with one
+`poll()` and parsed again only when mounts change.
+"""
+
+import os
+import re
+import threading
+
+MOUNTINFO = "/proc/self/mountinfo"
+FILESYSTEMS = "/proc/filesystems"
+
+_octal_escape = re.compile(r"\\([0-7]{3})")
+
+
+class MountInfo(object):
+    """
+    A mount record in `/proc/self/mountinfo`.
+
+    Attributes:
+        mount_id(int):      unique id of the mount.
+        parent_id(int):     id of the parent mount.
+        major(int):         major device number of the file system.
+        minor(int):         minor device number of the file system.
+        root(str):          the dir in the file system that is mounted, `/` or a sub dir for a bind mount.
+        mountpoint(str):    where it is mounted.
+        opts(str):          per-mount options, such as `rw,relatime`.
+        optional(tuple):    optional fields, such as `('shared:1',)`.
+        fstype(str):        file system type, such as `ext4`.
+        device(str):        mount source, such as `/dev/sda1`. `''` if there is none.
+        super_opts(str):    per-super-block options.
+    """
+
+    __slots__ = (
+        "mount_id",
+        "parent_id",
+        "major",
+        "minor",
+        "root",
+        "mountpoint",
+        "opts",
+        "optional",
+        "fstype",
+        "device",
+        "super_opts",
+    )
+
+    @property
+    def dev(self):
+        """
+        Device number of the file system, the same as `st_dev` of a file on it.
+        """
+        return os.makedev(self.major, self.minor)
+
+    def all_opts(self):
+        """
+        Options as in `/proc/mounts`: per-mount options then per-super-block options.
+        """
+        # super_opts starts with "rw" or "ro", which is already in opts.
+        sb = self.super_opts.split(",", 1)
+        if len(sb) == 1:
+            return self.opts
+        return self.opts + "," + sb[1]
+
+    def to_dict(self):
+        """
+        Return a dict with the same keys as the record of `psutil.disk_partitions()`:
+        `device`, `mountpoint`, `fstype` and `opts`.
+        """
+        return {
+            "device": self.device,
+            "mountpoint": self.mountpoint,
+            "fstype": self.fstype,
+            "opts": self.all_opts(),
+        }
+
+    def __repr__(self):
+        return "MountInfo({fields})".format(fields=", ".join("%s=%r" % (k, getattr(self, k)) for k in self.__slots__))
+
+
+class MountTable(object):
+    """
+    Mount records, in the order of `/proc/self/mountinfo`, with indexes.
+
+    Attributes:
+        mounts(list):           of `MountInfo`.
+        by_mountpoint(dict):    mount point path to `MountInfo`. If several
+                                file systems are mounted on one path, it is
+                                the last one, which is visible.
+        by_dev(dict):           device number to a list of `MountInfo`.
+        physical_fstypes(set):  file system types that require a device, from `/proc/filesystems`.
+    """
+
+    __slots__ = ("mounts", "by_mountpoint", "by_dev", "physical_fstypes")
+
+    def __init__(self, mounts, physical_fstypes=None):
+        self.mounts = mounts
+        self.by_mountpoint = {}
+        self.by_dev = {}
+        self.physical_fstypes = physical_fstypes
+
+        for m in mounts:
+            self.by_mountpoint[m.mountpoint] = m
+            self.by_dev.setdefault(m.dev, []).append(m)
+
+    def is_physical(self, m):
+        """
+        Check if a mount is a disk file system, not one such as `tmpfs` or `proc`.
+        It is the same rule as `psutil.disk_partitions(all=False)`.
+        """
+        if self.physical_fstypes is None:
+            self.physical_fstypes = read_physical_fstypes()
+
+        return m.device != "" and m.fstype in self.physical_fstypes
+
+    def get_mount(self, path):
+        """
+        Return the `MountInfo` of the mount point `path` resides on, with symbolic links resolved.
+        """
+        path = os.path.realpath(path)
+
+        while path != "/" and path not in self.by_mountpoint:
+            path = os.path.dirname(path)
+
+        return self.by_mountpoint.get(path)
+
+
+def _unescape(s):
+    # space, tab, newline and backslash are escaped in octal, such as "\040".
+    if "\\" not in s:
+        return s
+    return _octal_escape.sub(lambda m: chr(int(m.group(1), 8)), s)
+
+
+def parse_mountinfo(content):
+    """
+    Parse the content of a mountinfo file.
+
+    Args:
+
+        content(str):
+            is the content of `/proc/<pid>/mountinfo`.
+
+    Returns:
+        list: of `MountInfo`.
+    """
+    mounts = []
+
+    for line in content.splitlines():
+        fields = line.split()
+        if len(fields) < 10:
+            continue
+
+        # 36 35 98:0 /mnt1 /mnt/parent rw,noatime master:1 - ext3 /dev/root rw,errors=continue
+        sep = fields.index("-", 6)
+
+        m = MountInfo()
+        m.mount_id = int(fields[0])
+        m.parent_id = int(fields[1])
+        major, minor = fields[2].split(":")
+        m.major = int(major)
+        m.minor = int(minor)
+        m.root = _unescape(fields[3])
+        m.mountpoint = _unescape(fields[4])
+        m.opts = fields[5]
+        m.optional = tuple(fields[6:sep])
+        m.fstype = fields[sep + 1]
+
+        device = _unescape(fields[sep + 2])
+        if device == "none":
+            device = ""
+        elif device in ("/dev/root", "rootfs"):
+            device = _find_block_device(m.major, m.minor) or device
+        m.device = device
+
+        m.super_opts = fields[sep + 3] if len(fields) > sep + 3 else ""
+
+        mounts.append(m)
+
+    return mounts
+
+
+def _find_block_device(major, minor):
+    # "/dev/root" is an alias of the root device given by kernel command line.
+    try:
+        with open("/sys/dev/block/{major}:{minor}/uevent".format(major=major, minor=minor)) as f:
+            for line in f:
+                if line.startswith("DEVNAME="):
+                    return "/dev/" + line.strip().split("=", 1)[1]
+    except OSError:
+        pass
+
+    return None
+
+
+def read_physical_fstypes(path=FILESYSTEMS):
+    """
+    Return the set of file system types that require a device, from `/proc/filesystems`.
+    """
+    fstypes = set()
+    with open(path) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) == 1:
+                fstypes.add(fields[0])
+            elif len(fields) == 2 and fields[1] == "zfs":
+                # zfs is "nodev" but it is a disk file system.
+                fstypes.add("zfs")
+
+    return fstypes
+
+
+def read_mount_table(path=MOUNTINFO):
+    """
+    Read and parse a mountinfo file, without cache.
+
+    Returns:
+        MountTable
+    """
+    with open(path) as f:
+        return MountTable(parse_mountinfo(f.read()))
+
+
+class _Cache(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.path = None
+        self.fd = None
+        self.poller = None
+        self.table = None
+
+    def get(self, path):
+        import select
+
+        with self.lock:
+            if self.path != path:
+                self.reset()
+
+            if self.table is not None and not self.changed():
+                return self.table
+
+            if self.fd is None:
+                self.fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+                self.path = path
+                self.poller = select.poll()
+                self.poller.register(self.fd, select.POLLPRI)
+
+            self.table = MountTable(parse_mountinfo(self.read()))
+            return self.table
+
+    def changed(self):
+        import select
+
+        for _, ev in self.poller.poll(0):
+            if ev & (select.POLLPRI | select.POLLERR):
+                return True
+
+        return False
+
+    def read(self):
+        os.lseek(self.fd, 0, os.SEEK_SET)
+
+        bufs = []
+        while True:
+            buf = os.read(self.fd, 64 * 1024)
+            if len(buf) == 0:
+                break
+            bufs.append(buf)
+
+        return b"".join(bufs).decode("utf-8", "surrogateescape")
+
+    def reset(self):
+        if self.fd is not None:
+            os.close(self.fd)
+
+        self.path = None
+        self.fd = None
+        self.poller = None
+        self.table = None
+
+
+_cache = _Cache()
+
+
+def get_mount_table():
+    """
+    Return the `MountTable` of this process.
+
+    The table is parsed again only when the mount table of the system changes.
+    It must not be modified by caller.
+    """
+    return _cache.get(MOUNTINFO)
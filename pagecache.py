@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Control the page cache of files: prefetch them, evict them and query how much
+of them is cached.
+
+Usage::
+
+    names = ls_files('/data/index')
+    prefetch(names, base='/data/index', budget=8 * 1024**3)
+
+    get_cache_residency('/data/index/00001')
+    # {'total': 1048576, 'resident': 524288, 'percent': 0.5}
+
+    evict(names, base='/data/index')
+"""
+
+import errno
+import os
+
+from ._libc import check as _check
+from ._libc import load_libc
+from .fs import _fdatasync
+from .fs import _handle_error
+
+PROT_READ = 0x1
+MAP_SHARED = 0x01
+
+SYNC_FILE_RANGE_WAIT_BEFORE = 1
+SYNC_FILE_RANGE_WRITE = 2
+SYNC_FILE_RANGE_WAIT_AFTER = 4
+
+# max bytes of a file to map at a time to query residency
+MINCORE_WINDOW = 1024**3
+
+# the lowest bit of a byte of mincore() result tells if the page is resident
+_resident_bit = bytes(b & 1 for b in range(256))
+
+
+def _declare(libc, ctypes):
+    libc.mmap.argtypes = [
+        ctypes.c_void_p,
+        ctypes.c_size_t,
+        ctypes.c_int,
+        ctypes.c_int,
+        ctypes.c_int,
+        ctypes.c_long,
+    ]
+    libc.mmap.restype = ctypes.c_void_p
+    libc.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+    libc.mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_char_p]
+
+    if hasattr(libc, "sync_file_range"):
+        libc.sync_file_range.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_uint]
+
+
+def _get_libc():
+    return load_libc(_declare)
+
+
+def _sync_file_range(fd, offset, nbytes, flags):
+    """
+    Call Linux `sync_file_range()`, which Python does not provide.
+    `OSError` with `ENOSYS` is raised where it is not supported.
+    """
+    func = getattr(_get_libc(), "sync_file_range", None)
+    if func is None:
+        raise OSError(errno.ENOSYS, os.strerror(errno.ENOSYS))
+
+    _check(func(fd, offset, nbytes, flags))
+
+
+def _iter_ranges(paths, base):
+    for p in paths:
+        if isinstance(p, str):
+            offset, length = 0, None
+        else:
+            p, offset, length = p
+
+        if base is not None:
+            p = os.path.join(base, p)
+
+        yield p, offset, length
+
+
+def _willneed(path, offset, length):
+    fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+    try:
+        os.posix_fadvise(fd, offset, length, os.POSIX_FADV_WILLNEED)
+    finally:
+        os.close(fd)
+
+
+def _dontneed(path, offset, length, sync=False):
+    fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+    try:
+        if sync:
+            _fdatasync(fd)
+        os.posix_fadvise(fd, offset, length, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def _run(func, jobs, workers, onerror, executor=None):
+    """
+    Call `func(path, offset, length)` for every job, in `workers` threads, or
+    in `executor` if it is given.
+    """
+
+    def _call(path, offset, length):
+        try:
+            func(path, offset, length)
+        except OSError:
+            _handle_error(onerror, func, path)
+
+    if executor is not None:
+        for f in [executor.submit(_call, *job) for job in jobs]:
+            f.result()
+        return
+
+    if workers <= 1 or len(jobs) <= 1:
+        for job in jobs:
+            _call(*job)
+        return
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(min(workers, len(jobs))) as pool:
+        for f in [pool.submit(_call, *job) for job in jobs]:
+            f.result()
+
+
+def prefetch(paths, base=None, budget=None, workers=4, onerror="raise", executor=None):
+    """
+    Ask the kernel to read files into the page cache, with
+    `posix_fadvise(POSIX_FADV_WILLNEED)`. The reads are started in the
+    background and this function does not wait for them to finish.
+
+    Args:
+
+        paths:
+            an iterable of file paths, or of `(path, offset, length)` to
+            prefetch a byte range. `length=None` means to the end of file.
+
+        base(str):
+            a dir that relative paths in `paths` are joined to, such as the
+            dir listed by `ls_files`.
+
+        budget(int):
+            max total bytes to prefetch. Paths are prefetched in order, and
+            the range that crosses the budget is cut short. `None` for no limit.
+
+        workers(int):
+            number of files to advise concurrently. Advising a file may block
+            while the kernel submits its reads.
+
+        onerror(str or callable):
+            - "raise": raise the error of a path, such as a missing file.
+            - "ignore": skip the path.
+            - A callable: it is called with `(func, path, exc_info)`, the same
+              as `remove`.
+
+        executor(concurrent.futures.Executor):
+            to run the advising of files in, instead of `workers` threads,
+            such as a `DeviceScheduler` to spread files over devices.
+
+    Returns:
+        int: number of bytes advised.
+    """
+    total = 0
+    jobs = []
+
+    for path, offset, length in _iter_ranges(paths, base):
+        if budget is not None and total >= budget:
+            break
+
+        try:
+            size = os.stat(path).st_size
+        except OSError:
+            _handle_error(onerror, os.stat, path)
+            continue
+
+        end = size if length is None else min(size, offset + length)
+        length = max(end - offset, 0)
+
+        if budget is not None:
+            length = min(length, budget - total)
+
+        if length == 0:
+            continue
+
+        total += length
+        jobs.append((path, offset, length))
+
+    _run(_willneed, jobs, workers, onerror, executor)
+
+    return total
+
+
+def evict(paths, base=None, sync=False, workers=4, onerror="raise", executor=None):
+    """
+    Drop the cached pages of files from the page cache, with
+    `posix_fadvise(POSIX_FADV_DONTNEED)`.
+
+    Dirty pages are not dropped, unless they are written back first with `sync`.
+
+    Args:
+
+        paths:
+            an iterable of file paths, or of `(path, offset, length)`, the same as `prefetch`.
+
+        base(str):
+            a dir that relative paths in `paths` are joined to.
+
+        sync(bool):
+            `fdatasync()` a file before dropping its pages.
+
+        workers(int):
+            number of files to evict concurrently.
+
+        onerror(str or callable):
+            how to handle the error of a path, the same as `prefetch`.
+
+        executor(concurrent.futures.Executor):
+            to run the evicting of files in, the same as `prefetch`.
+    """
+    jobs = []
+    for path, offset, length in _iter_ranges(paths, base):
+        # length 0 means to the end of file for posix_fadvise()
+        jobs.append((path, offset, length or 0))
+
+    if sync:
+        _run(_dontneed_sync, jobs, workers, onerror, executor)
+    else:
+        _run(_dontneed, jobs, workers, onerror, executor)
+
+
+def _dontneed_sync(path, offset, length):
+    _dontneed(path, offset, length, sync=True)
+
+
+def get_cache_residency(*paths):
+    """
+    Report how much of a file is in the page cache, with `mmap()` and `mincore()`.
+    Pages are not read by querying.
+
+    Args:
+
+        paths:
+            is the path of the file.
+
+    Returns:
+        dict: in the following format::
+
+            {
+                'total':    file size in byte,
+                'resident': bytes in the page cache, counted in pages,
+                'percent':  float(resident) / total, 0.0 for an empty file,
+            }
+    """
+    import ctypes
+
+    path = os.path.join(*paths)
+    libc = _get_libc()
+    page_size = os.sysconf("SC_PAGE_SIZE")
+    map_failed = ctypes.c_void_p(-1).value
+
+    fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+    try:
+        size = os.fstat(fd).st_size
+        resident = 0
+
+        for offset in range(0, size, MINCORE_WINDOW):
+            length = min(MINCORE_WINDOW, size - offset)
+
+            addr = libc.mmap(None, length, PROT_READ, MAP_SHARED, fd, offset)
+            if addr is None or addr == map_failed:
+                _check(-1, path)
+
+            try:
+                n_pages = (length + page_size - 1) // page_size
+                vec = ctypes.create_string_buffer(n_pages)
+                _check(libc.mincore(addr, length, vec), path)
+            finally:
+                libc.munmap(addr, length)
+
+            resident += n_pages - vec.raw.translate(_resident_bit).count(0)
+    finally:
+        os.close(fd)
+
+    resident = min(resident * page_size, size)
+
+    return {
+        "total": size,
+        "resident": resident,
+        "percent": float(resident) / size if size > 0 else 0.0,
+    }
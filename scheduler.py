@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+An executor that runs file system jobs with a limited concurrency on every
+device, and takes jobs of all devices in turn, so that jobs over many disks
+keep all of them busy, instead of piling up on one of them.
+
+Usage::
+
+    with DeviceScheduler(per_device=2, max_workers=48) as ex:
+        sums = list(ex.map(calc_checksums, paths))
+
+    tree_digest('/data', executor=DeviceScheduler())
+
+A job is assigned to the device of the path in its first positional argument.
+"""
+
+import collections
+import os
+import threading
+from concurrent.futures import Executor, Future
+
+
+def _st_dev(path):
+    """
+    The `st_dev` of a path, or of its closest existing parent, such as for a
+    path to create. `None` if it can not be found.
+    """
+    path = os.path.abspath(path)
+
+    while True:
+        try:
+            return os.stat(path).st_dev
+        except FileNotFoundError:
+            parent = os.path.dirname(path)
+            if parent == path:
+                return None
+            path = parent
+        except OSError:
+            return None
+
+
+class DeviceScheduler(Executor):
+    """
+    A `concurrent.futures.Executor` that groups jobs by device.
+
+    At most `per_device` jobs of a device run at the same time. A free worker
+    takes the next job of the device after the one it took last, thus devices
+    are served round-robin, no matter in what order the jobs are submitted.
+
+    Args:
+
+        per_device(int):
+            max number of jobs of one device to run concurrently.
+
+        max_workers(int):
+            max number of threads, thus of jobs running on all devices.
+            By default `per_device * 16`.
+
+        device_of(callable):
+            gets the device key of a path. By default the `st_dev` of the
+            path or of its closest existing parent. `get_device` can be used
+            to group by device name instead.
+            Jobs whose first argument is not a path share the key `None`.
+    """
+
+    def __init__(self, per_device=2, max_workers=None, device_of=None):
+        if per_device <= 0:
+            raise ValueError("per_device must be positive integer")
+
+        if max_workers is None:
+            max_workers = per_device * 16
+
+        if max_workers <= 0:
+            raise ValueError("max_workers must be positive integer")
+
+        self.per_device = per_device
+        self.max_workers = max_workers
+        self.device_of = device_of or _st_dev
+
+        self.cond = threading.Condition()
+
+        # device -> deque of (future, fn, args, kwargs), only devices with pending jobs,
+        # in the order in which they are served.
+        self.queues = collections.OrderedDict()
+        self.running = collections.Counter()
+
+        self.threads = []
+        # number of workers running a job
+        self.busy = 0
+        self.closed = False
+
+    def submit(self, fn, /, *args, **kwargs):
+        device = None
+        if len(args) > 0 and isinstance(args[0], (str, bytes, os.PathLike)):
+            device = self.device_of(args[0])
+
+        fu = Future()
+
+        with self.cond:
+            if self.closed:
+                raise RuntimeError("cannot schedule new futures after shutdown")
+
+            if device not in self.queues:
+                self.queues[device] = collections.deque()
+            self.queues[device].append((fu, fn, args, kwargs))
+
+            if len(self.queues[device]) + self.running[device] > self.per_device:
+                # the device is saturated, a worker finishing a job of it takes this one
+                return fu
+
+            # A waiting worker, or one just started or notified, takes any runnable job.
+            # Workers waiting on a saturated device do not count as free for other devices.
+            free = len(self.threads) - self.busy
+            if free < self._n_runnable() and len(self.threads) < self.max_workers:
+                th = threading.Thread(target=self._work, name="k3fs-scheduler-%d" % len(self.threads), daemon=True)
+                th.start()
+                self.threads.append(th)
+            else:
+                self.cond.notify()
+
+        return fu
+
+    def _n_runnable(self):
+        # called with self.cond held
+        n = 0
+        for device, queue in self.queues.items():
+            n += min(len(queue), self.per_device - self.running[device])
+        return n
+
+    def _next(self):
+        # called with self.cond held
+        for device, queue in self.queues.items():
+            if self.running[device] >= self.per_device:
+                continue
+
+            job = queue.popleft()
+            if len(queue) == 0:
+                del self.queues[device]
+            else:
+                # let the other devices go first next time
+                self.queues.move_to_end(device)
+
+            self.running[device] += 1
+            self.busy += 1
+            return device, job
+
+        return None
+
+    def _work(self):
+        while True:
+            with self.cond:
+                while True:
+                    nxt = self._next()
+                    if nxt is not None:
+                        break
+
+                    if self.closed and len(self.queues) == 0:
+                        return
+
+                    self.cond.wait()
+
+            device, (fu, fn, args, kwargs) = nxt
+
+            if fu.set_running_or_notify_cancel():
+                try:
+                    rst = fn(*args, **kwargs)
+                except BaseException as e:
+                    fu.set_exception(e)
+                else:
+                    fu.set_result(rst)
+
+            del fu, fn, args, kwargs
+
+            with self.cond:
+                self.running[device] -= 1
+                if self.running[device] == 0:
+                    del self.running[device]
+                self.busy -= 1
+
+                # a slot of the device is free
+                self.cond.notify()
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        with self.cond:
+            self.closed = True
+
+            if cancel_futures:
+                for queue in self.queues.values():
+                    for fu, _, _, _ in queue:
+                        fu.cancel()
+
+                self.queues.clear()
+
+            self.cond.notify_all()
+
+        if wait:
+            for th in self.threads:
+                th.join()
@@ -0,0 +1,395 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Snapshots of a directory tree in compact binary files, and a diff of two
+snapshots, to find what changed in a tree between two scans.
+
+Usage::
+
+    take_snapshot('/data', '/var/lib/foo/data-20260101.snap', algorithm='sha1')
+    ...
+    take_snapshot('/data', '/var/lib/foo/data-20260102.snap', algorithm='sha1',
+                  reuse='/var/lib/foo/data-20260101.snap')
+
+    for change, old, new in diff_snapshots('/var/lib/foo/data-20260101.snap',
+                                           '/var/lib/foo/data-20260102.snap'):
+        print(change, (old or new).path)
+
+A snapshot has an entry of every file, dir, symbolic link and other file
+under the root, sorted by path, one path component after another. Both a
+snapshot and a diff are read and written as streams, a tree or a snapshot
+of any size takes memory of a dir listing, not of the entire tree.
+
+File format::
+
+    header: b"K3FSSNP1", algorithm name length(u8), algorithm name
+    entry:  prefix length(u16), suffix length(u16), type(1 byte),
+            size(i64), mtime_ns(i64), ino(u64), digest length(u8),
+            suffix of path, digest
+
+Integers are little endian. The path of an entry is relative to the root.
+It shares `prefix length` bytes with the path of the previous entry, and the
+rest of it is `suffix`.
+"""
+
+import collections
+import os
+import stat
+import struct
+
+from . import fs
+from .fs import _handle_error
+from .instrument import instrumented
+
+MAGIC = b"K3FSSNP1"
+
+_header = struct.Struct("<8sB")
+_entry = struct.Struct("<HHcqqQB")
+
+# bytes of entries to write at a time
+WRITE_BUFFER = 64 * 1024
+
+SnapshotEntry = collections.namedtuple("SnapshotEntry", "path type size mtime_ns ino digest")
+SnapshotEntry.__doc__ = """
+An entry of a snapshot.
+
+`path` is relative to the root. `type` is `"f"` for a file, `"d"` for a dir,
+`"l"` for a symbolic link or `"o"` for others. `digest` is the digest in hex
+of the content of a file or of the target of a symbolic link, or `None`.
+"""
+
+
+def _entry_type(mode):
+    if stat.S_ISDIR(mode):
+        return b"d"
+    return fs._entry_type(mode).encode()
+
+
+def _key(rel):
+    # entries are sorted by components, so that all of a dir goes before its
+    # next sibling, which is the order a walk with sorted listings yields
+    return rel.split(b"/")
+
+
+def _walk(root, rel, dev, onerror):
+    """
+    Yield `(relative path, path, stat)` of every entry under `root/rel`, in
+    the order of `_key`. Paths are `bytes`.
+    """
+    path = os.path.join(root, rel) if rel else root
+
+    try:
+        with os.scandir(path) as it:
+            ents = sorted(it, key=lambda e: e.name)
+    except OSError:
+        _handle_error(onerror, os.scandir, os.fsdecode(path))
+        return
+
+    for ent in ents:
+        ent_rel = rel + b"/" + ent.name if rel else ent.name
+
+        try:
+            st = ent.stat(follow_symlinks=False)
+        except OSError:
+            _handle_error(onerror, os.lstat, os.fsdecode(ent.path))
+            continue
+
+        yield ent_rel, ent.path, st
+
+        if stat.S_ISDIR(st.st_mode) and (dev is None or st.st_dev == dev):
+            yield from _walk(root, ent_rel, dev, onerror)
+
+
+def _link_digest(path, algorithm):
+    # the same as tree_digest()
+    h = fs._checksum_algorithms[algorithm]()
+    h.update(os.readlink(path))
+    return bytes.fromhex(h.hexdigest())
+
+
+def _file_digest(path, algorithm):
+    return bytes.fromhex(fs._file_digest(path, algorithm))
+
+
+def _iter_scanned(root, algorithm, reuse, workers, one_file_system, onerror):
+    """
+    Yield `(relative path, type, stat, digest)` of every entry under `root`.
+    Files are hashed by `workers` threads, and at most `workers * 4` entries
+    wait for their digest.
+    """
+    dev = os.stat(root).st_dev if one_file_system else None
+    scanned = _walk(root, b"", dev, onerror)
+
+    old = None
+    olds = None
+    if reuse is not None and algorithm is not None:
+        olds = _iter_raw(reuse)
+        if next(olds) == algorithm:
+            old = next(olds, None)
+
+    pool = None
+    if algorithm is not None and workers > 1:
+        from concurrent.futures import ThreadPoolExecutor
+
+        pool = ThreadPoolExecutor(workers)
+
+    pending = collections.deque()
+
+    def _pop():
+        rel, typ, st, path, digest = pending.popleft()
+
+        if hasattr(digest, "result"):
+            try:
+                digest = digest.result()
+            except OSError:
+                # such as the file is removed after it is listed
+                _handle_error(onerror, fs.calc_checksums, os.fsdecode(path))
+                return None
+
+        return rel, typ, st, digest
+
+    try:
+        for rel, path, st in scanned:
+            typ = _entry_type(st.st_mode)
+            digest = b""
+
+            if algorithm is not None and typ == b"f":
+                key = _key(rel)
+                while old is not None and _key(old[0]) < key:
+                    old = next(olds, None)
+
+                if (
+                    old is not None
+                    and old[0] == rel
+                    and old[1:5] == (typ, st.st_size, st.st_mtime_ns, st.st_ino)
+                    and old[5] != b""
+                ):
+                    digest = old[5]
+                elif pool is not None:
+                    digest = pool.submit(_file_digest, path, algorithm)
+                else:
+                    try:
+                        digest = _file_digest(path, algorithm)
+                    except OSError:
+                        _handle_error(onerror, fs.calc_checksums, os.fsdecode(path))
+                        continue
+
+            elif algorithm is not None and typ == b"l":
+                try:
+                    digest = _link_digest(path, algorithm)
+                except OSError:
+                    _handle_error(onerror, os.readlink, os.fsdecode(path))
+                    continue
+
+            pending.append((rel, typ, st, path, digest))
+
+            if len(pending) >= workers * 4:
+                rec = _pop()
+                if rec is not None:
+                    yield rec
+
+        while len(pending) > 0:
+            rec = _pop()
+            if rec is not None:
+                yield rec
+    finally:
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=True)
+        if olds is not None:
+            olds.close()
+
+
+@instrumented("take_snapshot", fs._first_arg)
+def take_snapshot(root, output, algorithm=None, reuse=None, workers=4, one_file_system=False, onerror="raise"):
+    """
+    Scan a directory tree and write a snapshot of it to a file.
+
+    Symbolic links are not followed. The snapshot is written to a temporary
+    file and renamed to `output`, thus `output` is always a complete snapshot.
+
+    Args:
+
+        root(str):
+            is the path of the dir to scan.
+
+        output(str):
+            is the path of the snapshot file to write.
+
+        algorithm(str):
+            is the name of a checksum algorithm supported by `calc_checksums`,
+            to keep the digest of the content of every file in the snapshot.
+            `None` to not calculate digests.
+
+        reuse(str):
+            is the path of an earlier snapshot of the same tree, with the same
+            algorithm. The digest of a file is copied from it, instead of
+            hashing the file again, if the file has the same size, mtime and
+            inode number.
+
+        workers(int):
+            number of threads to hash files with.
+
+        one_file_system(bool):
+            do not scan dirs on another file system than `root`. The mount
+            point dir itself is in the snapshot.
+
+        onerror(str or callable):
+            how to handle the error of a path, such as a file removed during
+            the scan, the same as `prefetch`. An entry with an error is not in
+            the snapshot.
+
+    Returns:
+        int: number of entries in the snapshot.
+    """
+    if algorithm is not None and algorithm not in fs._checksum_algorithms:
+        raise fs.FSUtilError("unknown checksum algorithm: {n}".format(n=algorithm))
+
+    root_b = os.fsencode(root)
+    name = (algorithm or "").encode()
+
+    count = [0]
+
+    def _chunks():
+        buf = bytearray(_header.pack(MAGIC, len(name)) + name)
+        prev = b""
+
+        for rel, typ, st, digest in _iter_scanned(root_b, algorithm, reuse, workers, one_file_system, onerror):
+            prefix = len(os.path.commonprefix([prev, rel]))
+            suffix = rel[prefix:]
+
+            buf += _entry.pack(prefix, len(suffix), typ, st.st_size, st.st_mtime_ns, st.st_ino, len(digest))
+            buf += suffix
+            buf += digest
+
+            prev = rel
+            count[0] += 1
+
+            if len(buf) >= WRITE_BUFFER:
+                yield bytes(buf)
+                del buf[:]
+
+        yield bytes(buf)
+
+    fs.fwrite(output, _chunks(), atomic=True)
+
+    return count[0]
+
+
+def _iter_raw(path):
+    """
+    Yield the algorithm name of a snapshot first, then
+    `(relative path in bytes, type, size, mtime_ns, ino, digest in bytes)` of
+    every entry. The file is closed when the generator is closed.
+    """
+    with open(path, "rb") as f:
+        head = f.read(_header.size)
+        if len(head) < _header.size or head[:8] != MAGIC:
+            raise fs.FSUtilError("not a snapshot: {p}".format(p=path))
+
+        name = f.read(_header.unpack(head)[1])
+        yield name.decode() or None
+
+        prev = b""
+        while True:
+            head = f.read(_entry.size)
+            if len(head) == 0:
+                return
+
+            if len(head) < _entry.size:
+                raise fs.FSUtilError("snapshot is truncated: {p}".format(p=path))
+
+            prefix, n_suffix, typ, size, mtime_ns, ino, n_digest = _entry.unpack(head)
+
+            rest = f.read(n_suffix + n_digest)
+            if len(rest) < n_suffix + n_digest:
+                raise fs.FSUtilError("snapshot is truncated: {p}".format(p=path))
+
+            rel = prev[:prefix] + rest[:n_suffix]
+            prev = rel
+
+            yield rel, typ, size, mtime_ns, ino, rest[n_suffix:]
+
+
+def _to_entry(raw):
+    rel, typ, size, mtime_ns, ino, digest = raw
+    return SnapshotEntry(os.fsdecode(rel), typ.decode(), size, mtime_ns, ino, digest.hex() or None)
+
+
+def iter_snapshot(path):
+    """
+    Read a snapshot written by `take_snapshot`, one entry at a time.
+
+    Args:
+
+        path(str):
+            is the path of the snapshot file.
+
+    Returns:
+        generator: of `SnapshotEntry`, in the order of path.
+    """
+    entries = _iter_raw(path)
+    try:
+        next(entries)
+        for raw in entries:
+            yield _to_entry(raw)
+    finally:
+        entries.close()
+
+
+def diff_snapshots(old, new):
+    """
+    Compare two snapshots of a tree, by merging them entry by entry.
+    Neither of them is loaded into memory.
+
+    An entry is modified if its type, size, mtime or inode number changes, or
+    if both snapshots have digests and the digest changes. A dir is modified
+    if an entry is added to or removed from it, since its mtime changes.
+
+    Args:
+
+        old(str):
+            is the path of the earlier snapshot.
+
+        new(str):
+            is the path of the later snapshot.
+
+    Returns:
+        generator: of `(change, old entry, new entry)` in the order of path.
+        `change` is `"added"`, `"removed"` or `"modified"`. The old entry of
+        an added path and the new entry of a removed path are `None`.
+    """
+    olds = _iter_raw(old)
+    news = _iter_raw(new)
+    try:
+        next(olds)
+        next(news)
+        yield from _merge(olds, news)
+    finally:
+        olds.close()
+        news.close()
+
+
+def _merge(olds, news):
+    a = next(olds, None)
+    b = next(news, None)
+
+    while a is not None or b is not None:
+        if b is None or (a is not None and _key(a[0]) < _key(b[0])):
+            yield "removed", _to_entry(a), None
+            a = next(olds, None)
+
+        elif a is None or _key(b[0]) < _key(a[0]):
+            yield "added", None, _to_entry(b)
+            b = next(news, None)
+
+        else:
+            changed = a[1:5] != b[1:5]
+            if a[5] != b"" and b[5] != b"" and a[5] != b[5]:
+                changed = True
+
+            if changed:
+                yield "modified", _to_entry(a), _to_entry(b)
+
+            a = next(olds, None)
+            b = next(news, None)
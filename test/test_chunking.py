@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import hashlib
+import os
+import random
+import time
+import unittest
+
+import k3fs
+import k3ut
+from k3fs import chunking
+
+dd = k3ut.dd
+
+base = "/tmp/pykit-ut-k3fs-chunking"
+
+K = 1024
+
+
+def chunk_all(chunker, data, step):
+    chunks = []
+    for i in range(0, len(data), step):
+        chunks.extend(chunker.update(data[i : i + step]))
+    chunks.extend(chunker.finish())
+    return chunks
+
+
+class TestChunking(unittest.TestCase):
+    def setUp(self):
+        k3fs.remove(base, onerror="ignore")
+        k3fs.makedirs(base)
+
+    def tearDown(self):
+        k3fs.remove(base, onerror="ignore")
+
+    def test_chunker(self):
+        data = random.Random(1).randbytes(512 * K)
+
+        chunks = chunk_all(k3fs.Chunker(avg_size=4 * K, vectorize=False), data, 100 * K)
+        dd(len(chunks))
+
+        offset = 0
+        for off, length, digest in chunks:
+            self.assertEqual(offset, off)
+            self.assertEqual(hashlib.sha256(data[off : off + length]).hexdigest(), digest)
+            self.assertLessEqual(length, 16 * K)
+            offset += length
+        self.assertEqual(len(data), offset)
+
+        sizes = [c[1] for c in chunks[:-1]]
+        self.assertGreaterEqual(min(sizes), K)
+        avg = sum(sizes) / len(sizes)
+        self.assertTrue(3 * K < avg < 6 * K, avg)
+
+        dd("independent of how bytes are fed")
+        self.assertEqual(chunks, chunk_all(k3fs.Chunker(avg_size=4 * K, vectorize=False), data, 7 * K + 3))
+
+        if chunking._numpy() is None:
+            dd("numpy is not installed")
+        else:
+            for step in (1000, 64 * K + 1, len(data)):
+                self.assertEqual(chunks, chunk_all(k3fs.Chunker(avg_size=4 * K, vectorize=True), data, step))
+
+            small = data[: 20 * K]
+            for step in (1, 31, 33):
+                self.assertEqual(
+                    chunk_all(k3fs.Chunker(avg_size=64, vectorize=False), small, 1000),
+                    chunk_all(k3fs.Chunker(avg_size=64, vectorize=True), small, step),
+                )
+
+        dd("an insert changes only the chunks around it")
+        changed = data[: 200 * K] + b"x" + data[200 * K :]
+        chunks2 = chunk_all(k3fs.Chunker(avg_size=4 * K, vectorize=False), changed, 100 * K)
+
+        digests = set(c[2] for c in chunks)
+        differs = [c for c in chunks2 if c[2] not in digests]
+        dd(differs)
+        self.assertLessEqual(len(differs), 2)
+        self.assertTrue(any(c[0] <= 200 * K < c[0] + c[1] for c in differs))
+
+        dd("max size")
+        chunks = chunk_all(k3fs.Chunker(avg_size=4 * K, max_size=5 * K, algorithm="crc32"), b"\0" * 12 * K, 3000)
+        self.assertEqual([0, 5 * K, 10 * K], [c[0] for c in chunks])
+        self.assertEqual([5 * K, 5 * K, 2 * K], [c[1] for c in chunks])
+
+        self.assertEqual([], k3fs.Chunker().finish())
+
+    def test_invalid(self):
+        for kwargs in (
+            {"avg_size": 3000},
+            {"avg_size": 4},
+            {"avg_size": 4096, "min_size": 8192},
+            {"avg_size": 4096, "max_size": 2048},
+            {"algorithm": "foo"},
+        ):
+            self.assertRaises(k3fs.FSUtilError, k3fs.Chunker, **kwargs)
+
+        if chunking._numpy() is None:
+            self.assertRaises(k3fs.FSUtilError, k3fs.Chunker, vectorize=True)
+
+    def test_iter_file_chunks(self):
+        fn = os.path.join(base, "foo")
+        data = random.Random(2).randbytes(256 * K)
+        k3fs.fwrite(fn, data)
+
+        expected = chunk_all(k3fs.Chunker(avg_size=4 * K, vectorize=False), data, len(data))
+        self.assertEqual(expected, list(k3fs.iter_file_chunks(fn, avg_size=4 * K, block_size=10000)))
+
+        dd("sparse file")
+        sparse = os.path.join(base, "sparse")
+        with open(sparse, "wb") as f:
+            f.seek(1024 * K)
+            f.write(data)
+
+        chunks = list(k3fs.iter_file_chunks(sparse, avg_size=4 * K, io_limit=-1))
+        self.assertEqual(chunk_all(k3fs.Chunker(avg_size=4 * K), b"\0" * 1024 * K + data, 64 * K), chunks)
+
+        dd("io_limit")
+        t0 = time.monotonic()
+        list(k3fs.iter_file_chunks(fn, avg_size=4 * K, block_size=64 * K, io_limit=512 * K))
+        self.assertGreaterEqual(time.monotonic() - t0, 0.4)
+
+        self.assertRaises(k3fs.FSUtilError, list, k3fs.iter_file_chunks(fn, io_limit=0))
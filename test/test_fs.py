@@ -1,7 +1,13 @@
 #!/usr/bin/env python
 # coding: utf-8
 
+import binascii
+import errno
+import hashlib
 import os
+import stat
+import struct
+import threading
 import time
 import unittest
 
@@ -23,6 +29,22 @@ class TestFS(unittest.TestCase):
     def test_exceptions(self):
         dd("present: ", k3fs.FSUtilError)
         dd("present: ", k3fs.NotMountPoint)
+        dd("present: ", k3fs.LockTimeout)
+        dd("present: ", k3fs.InsufficientSpace)
+
+    def test_import_lazily(self):
+        rc, out, err = k3proc.shell_script(
+            pyt + " -c \"import sys, k3fs; k3fs.fwrite('/tmp/pykit-ut-k3fs-import', 'x'); print(sorted(sys.modules))\"",
+        )
+        dd("modules imported:", rc, out, err)
+        self.assertEqual(0, rc)
+
+        for mod in ("psutil", "k3confloader", "hashlib", "concurrent.futures", "importlib.metadata", "numpy", "ctypes"):
+            self.assertNotIn("'" + mod + "'", out)
+
+        force_remove("/tmp/pykit-ut-k3fs-import")
+
+        self.assertEqual(str, type(k3fs.__version__))
 
     def test_get_all_mountpoint(self):
         mps = k3fs.get_all_mountpoint()
@@ -247,6 +269,71 @@ class TestFS(unittest.TestCase):
 
         k3fs.remove("test_dir")
 
+    def test_listing_cache(self):
+        base = "/tmp/pykit-ut-k3fs-listing-cache"
+        k3fs.remove(base, onerror="ignore")
+
+        k3fs.makedirs(base, "dir1")
+        k3fs.makedirs(base, "dir2")
+        k3fs.fwrite(base, "foo1", "x")
+        k3fs.fwrite(base, "foo2", "x")
+        k3fs.fwrite(base, "bar", "x")
+        os.symlink("foo1", os.path.join(base, "link"))
+
+        cache = k3fs.ListingCache()
+
+        dd("recently changed dir is not cached")
+        self.assertEqual(["bar", "foo1", "foo2", "link"], k3fs.ls_files(base, cache=cache))
+        self.assertEqual(["bar", "foo1", "foo2", "link"], k3fs.ls_files(base, cache=cache))
+        self.assertEqual({"hits": 0, "misses": 2, "evictions": 0}, cache.stats)
+
+        past = time.time() - 10
+        os.utime(base, (past, past))
+
+        self.assertEqual(["foo1", "foo2"], k3fs.ls_files(base, pattern="^foo", cache=cache))
+        self.assertEqual(["bar"], k3fs.ls_files(base, pattern="^b", cache=cache))
+        self.assertEqual(["dir1", "dir2"], k3fs.ls_dirs(base, cache=cache))
+        self.assertEqual({"hits": 2, "misses": 3, "evictions": 0}, cache.stats)
+
+        dd("changed dir is listed again")
+        k3fs.fwrite(base, "foo3", "x")
+        os.utime(base, (past + 1, past + 1))
+
+        self.assertEqual(["foo1", "foo2", "foo3"], k3fs.ls_files(base, pattern="^foo", cache=cache))
+        self.assertEqual(4, cache.stats["misses"])
+
+        dd("invalidate")
+        cache.invalidate(os.path.join(base, "foo3"))
+        self.assertEqual(["foo1", "foo2", "foo3"], k3fs.ls_files(base, pattern="^foo", cache=cache))
+        self.assertEqual(5, cache.stats["misses"])
+
+        dd("evict least recently used")
+        for d in ("e1", "e2", "e3"):
+            k3fs.makedirs(base, "dir1", d)
+            k3fs.fwrite(base, "dir1", d, "a", "x")
+            k3fs.fwrite(base, "dir1", d, "b", "x")
+            os.utime(os.path.join(base, "dir1", d), (past, past))
+
+        cache = k3fs.ListingCache(max_entries=5)
+        k3fs.ls_files(base, "dir1", "e1", cache=cache)
+        k3fs.ls_files(base, "dir1", "e2", cache=cache)
+        self.assertEqual(0, cache.stats["evictions"])
+
+        k3fs.ls_files(base, "dir1", "e3", cache=cache)
+        self.assertEqual(1, cache.stats["evictions"])
+        self.assertEqual(4, cache.n_entries)
+
+        self.assertEqual(["a", "b"], k3fs.ls_files(base, "dir1", "e2", cache=cache))
+        self.assertEqual(1, cache.stats["hits"])
+        self.assertEqual(["a", "b"], k3fs.ls_files(base, "dir1", "e1", cache=cache))
+        self.assertEqual(1, cache.stats["hits"])
+
+        dd("listing larger than max_entries is not cached")
+        self.assertEqual(["dir1", "dir2"], k3fs.ls_dirs(base, cache=cache))
+        self.assertEqual(4, cache.n_entries)
+
+        k3fs.remove(base)
+
     def test_makedirs_with_config(self):
         fn = "/tmp/pykit-ut-k3fs-foo"
         force_remove(fn)
@@ -292,6 +379,81 @@ class TestFS(unittest.TestCase):
 
         force_remove(fn)
 
+    def test_read_cache(self):
+        base = "/tmp/pykit-ut-k3fs-read-cache"
+        k3fs.remove(base, onerror="ignore")
+        k3fs.makedirs(base)
+
+        def write(name, cont):
+            k3fs.fwrite(base, name, cont, fsync=False)
+            # not changed within the last second
+            past = time.time() - 10
+            os.utime(os.path.join(base, name), (past, past))
+
+        write("a", "It  바로\r\nfoo\n")
+        a = os.path.join(base, "a")
+
+        cache = k3fs.ReadCache()
+
+        b1 = k3fs.fread(a, mode="b", cache=cache)
+        self.assertEqual(k3fs.fread(a, mode="b"), b1)
+        self.assertEqual({"hits": 0, "misses": 1, "evictions": 0}, cache.stats)
+
+        b2 = k3fs.fread(a, mode="b", cache=cache)
+        self.assertIs(b1, b2)
+        self.assertEqual(1, cache.stats["hits"])
+
+        dd("str is decoded once and is the same as without cache")
+        s1 = k3fs.fread(base, "a", cache=cache)
+        self.assertEqual(k3fs.fread(a), s1)
+        self.assertEqual("It  바로\nfoo\n", s1)
+        self.assertIs(s1, k3fs.fread(a, cache=cache))
+        self.assertEqual({"hits": 3, "misses": 1, "evictions": 0}, cache.stats)
+
+        dd("changed file is read again")
+        write("a", "bar")
+        self.assertEqual("bar", k3fs.fread(a, cache=cache))
+        self.assertEqual(2, cache.stats["misses"])
+        self.assertEqual(b"bar", k3fs.fread(a, mode="b", cache=cache))
+        self.assertEqual(4, cache.stats["hits"])
+
+        dd("a file changed recently is not cached")
+        k3fs.fwrite(base, "recent", "x", fsync=False)
+        for _ in range(2):
+            self.assertEqual("x", k3fs.fread(base, "recent", cache=cache))
+        self.assertEqual(4, cache.stats["misses"])
+
+        dd("invalidate and clear")
+        cache.invalidate(a)
+        k3fs.fread(a, cache=cache)
+        self.assertEqual(5, cache.stats["misses"])
+
+        cache.clear()
+        self.assertEqual(0, cache.n_bytes)
+        k3fs.fread(a, cache=cache)
+        self.assertEqual(6, cache.stats["misses"])
+
+        dd("byte budget")
+        cache = k3fs.ReadCache(max_bytes=30 * 1024, max_file_size=20 * 1024)
+        for name in ("x", "y", "z", "huge"):
+            write(name, b"x" * (25 * 1024 if name == "huge" else 10 * 1024))
+
+        for name in ("x", "y", "z", "x", "huge", "huge"):
+            k3fs.fread(base, name, mode="b", cache=cache)
+
+        dd(cache.stats)
+        self.assertEqual({"hits": 0, "misses": 6, "evictions": 2}, cache.stats)
+        self.assertLessEqual(cache.n_bytes, 30 * 1024)
+
+        # x is evicted by z, then y by x, the huge one is not kept
+        k3fs.fread(base, "x", mode="b", cache=cache)
+        self.assertEqual(1, cache.stats["hits"])
+
+        self.assertRaises(k3fs.FSUtilError, k3fs.fread, a, codec="gzip", cache=cache)
+        self.assertRaises(FileNotFoundError, k3fs.fread, base, "inexistent", cache=cache)
+
+        k3fs.remove(base)
+
     def test_write_file_with_config(self):
         fn = "/tmp/pykit-ut-k3fs-foo"
         force_remove(fn)
@@ -376,6 +538,418 @@ class TestFS(unittest.TestCase):
         os.fsync = os_fsync
         force_remove(fn)
 
+    def test_write_file_preallocate(self):
+        fn = "/tmp/pykit-ut-k3fs-preallocate"
+        force_remove(fn)
+
+        for cont in (b"x" * 8 * 1024**2, "\u4f60\u597d" * 1000, "", b""):
+            for atomic in (False, True):
+                k3fs.fwrite(fn, cont, preallocate=True, atomic=atomic, fsync=False)
+                self.assertEqual(cont, k3fs.fread(fn, mode="b" if isinstance(cont, bytes) else ""))
+
+        k3fs.fwrite(fn, b"x" * 8 * 1024**2, preallocate=True)
+        extents = k3fs.get_file_extents(fn)
+        dd("extents:", extents)
+        self.assertEqual([(0, 8 * 1024**2, True)], extents)
+
+        dd("no space to preallocate")
+        total = k3fs.get_path_usage("/tmp")["total"]
+        cont = _Huge(total * 2)
+        self.assertRaises(k3fs.InsufficientSpace, k3fs.fwrite, fn + "-huge", cont, preallocate=True, atomic=True)
+        self.assertEqual([], k3fs.ls_files("/tmp", pattern="^pykit-ut-k3fs-preallocate-huge"))
+
+        force_remove(fn)
+        force_remove(fn + "-huge")
+
+    def test_write_file_write_behind(self):
+        M = 1024**2
+
+        fn = "/tmp/pykit-ut-k3fs-write-behind"
+        force_remove(fn)
+
+        calls = []
+        orig_range = k3fs.pagecache._sync_file_range
+        orig_fsync = os.fsync
+        orig_fdatasync = os.fdatasync
+
+        def _sync_file_range(fd, offset, nbytes, flags):
+            calls.append((offset, nbytes, flags))
+            return orig_range(fd, offset, nbytes, flags)
+
+        def _fsync(fd):
+            calls.append("fsync")
+            return orig_fsync(fd)
+
+        def _fdatasync(fd):
+            calls.append("fdatasync")
+            return orig_fdatasync(fd)
+
+        k3fs.pagecache._sync_file_range = _sync_file_range
+        os.fsync = _fsync
+        os.fdatasync = _fdatasync
+        try:
+            write = k3fs.pagecache.SYNC_FILE_RANGE_WRITE
+            wait = k3fs.pagecache.SYNC_FILE_RANGE_WAIT_BEFORE | write | k3fs.pagecache.SYNC_FILE_RANGE_WAIT_AFTER
+
+            cont = os.urandom(3 * M + 10)
+            k3fs.fwrite(fn, cont, write_behind=M, fsync="fdatasync")
+            self.assertEqual(0, k3fs.get_cache_residency(fn)["resident"])
+            self.assertEqual(cont, k3fs.fread(fn, mode="b"))
+
+            self.assertEqual(
+                [
+                    (0, M, write),
+                    (M, M, write),
+                    (0, M, wait),
+                    (2 * M, M, write),
+                    (M, M, wait),
+                    "fdatasync",
+                ],
+                calls,
+            )
+
+            dd("str and iterable content")
+            for cont in ("It  바로 " * M, [b"x" * 1000] * 3000, ("바" * 1000 for _ in range(1000))):
+                del calls[:]
+                k3fs.fwrite(fn, cont, write_behind=M)
+                self.assertEqual("fsync", calls[-1])
+                self.assertIn((0, M, wait), calls)
+
+                if isinstance(cont, str):
+                    self.assertEqual(cont, k3fs.fread(fn))
+            self.assertEqual("바" * 1000 * 1000, k3fs.fread(fn))
+
+            dd("without sync, nothing is dropped after writing")
+            del calls[:]
+            k3fs.fwrite(fn, b"x" * 3 * M, write_behind=M, fsync=False)
+            self.assertEqual([(0, M, write), (M, M, write), (0, M, wait), (2 * M, M, write), (M, M, wait)], calls)
+            self.assertEqual(M, k3fs.get_cache_residency(fn)["resident"])
+
+            dd("fall back to fdatasync")
+
+            def _enosys(fd, offset, nbytes, flags):
+                calls.append("sync_file_range")
+                raise OSError(errno.ENOSYS, "not supported")
+
+            k3fs.pagecache._sync_file_range = _enosys
+            del calls[:]
+            k3fs.fwrite(fn, b"y" * 3 * M, write_behind=M, atomic=True)
+            self.assertEqual(["sync_file_range", "fdatasync", "fdatasync", "fsync"], calls)
+            self.assertEqual(b"y" * 3 * M, k3fs.fread(fn, mode="b"))
+
+            dd("fall back to fsync and keep pages without fdatasync and posix_fadvise, such as macOS")
+            orig_fadvise = os.posix_fadvise
+            del os.fdatasync
+            del os.posix_fadvise
+            try:
+                del calls[:]
+                k3fs.fwrite(fn, b"z" * 3 * M, write_behind=M, fsync="fdatasync")
+                self.assertEqual(["sync_file_range", "fsync", "fsync", "fsync"], calls)
+                self.assertEqual(b"z" * 3 * M, k3fs.fread(fn, mode="b"))
+            finally:
+                os.posix_fadvise = orig_fadvise
+        finally:
+            k3fs.pagecache._sync_file_range = orig_range
+            os.fsync = orig_fsync
+            os.fdatasync = orig_fdatasync
+
+        self.assertRaises(k3fs.FSUtilError, k3fs.fwrite, fn, "x", fsync="foo")
+        self.assertRaises(k3fs.FSUtilError, k3fs.fwrite, fn, "x", fsync="")
+
+        dd("any other value is a flag")
+        for fsync in (None, 0, 1):
+            k3fs.fwrite(fn, "x", fsync=fsync)
+            self.assertEqual("x", k3fs.fread(fn))
+        self.assertRaises(k3fs.FSUtilError, k3fs.fwrite, fn, "x", write_behind=0)
+
+        force_remove(fn)
+
+    def test_write_file_max_usage(self):
+        fn = "/tmp/pykit-ut-k3fs-max-usage"
+        force_remove(fn)
+
+        usage = k3fs.get_path_usage("/tmp")
+        max_usage = (usage["used"] + 4 * 1024**2) / usage["total"]
+
+        self.assertRaises(k3fs.InsufficientSpace, k3fs.fwrite, fn, "x" * 8 * 1024**2, max_usage=max_usage)
+        self.assertFalse(os.path.exists(fn))
+
+        k3fs.fwrite(fn, "x" * 1024, max_usage=max_usage)
+        k3fs.fwrite(fn, "x" * 8 * 1024**2, max_usage=1)
+        self.assertEqual({}, k3fs.fs._reserved)
+
+        dd("content being written by another thread is counted")
+        k3fs.fwrite(fn, "x")
+        usage = k3fs.get_path_usage("/tmp")
+        max_usage = (usage["used"] + 4 * 1024**2) / usage["total"]
+
+        dev = k3fs.fs._reserve(fn, 8 * 1024**2, 1)
+        try:
+            self.assertRaises(k3fs.InsufficientSpace, k3fs.fwrite, fn, "x" * 1024, max_usage=max_usage)
+        finally:
+            k3fs.fs._release(dev, 8 * 1024**2)
+
+        k3fs.fwrite(fn, "x" * 1024, max_usage=max_usage)
+        self.assertEqual({}, k3fs.fs._reserved)
+
+        force_remove(fn)
+
+    def test_read_write_codec(self):
+        import bz2
+        import gzip
+        import lzma
+
+        fn = "/tmp/pykit-ut-k3fs-codec"
+        force_remove(fn)
+
+        cont = "".join("line %d\n" % i for i in range(50000))
+        decompress = {"gzip": gzip.decompress, "bz2": bz2.decompress, "lzma": lzma.decompress}
+
+        for codec in ("gzip", "bz2", "lzma"):
+            for codec_thread in (False, True):
+                dd(codec, codec_thread)
+                k3fs.fwrite(fn, cont, codec=codec, codec_thread=codec_thread, atomic=True)
+
+                self.assertLess(os.path.getsize(fn), len(cont) / 2)
+                self.assertEqual(cont.encode(), decompress[codec](k3fs.fread(fn, mode="b")))
+
+                self.assertEqual(cont, k3fs.fread(fn, codec=codec, codec_thread=codec_thread))
+                self.assertEqual(cont.encode(), k3fs.fread(fn, mode="b", codec=codec))
+
+                chunks = list(k3fs.fread_chunks(fn, codec=codec, block_size=256, codec_thread=codec_thread))
+                if codec != "bz2":
+                    # bz2 outputs nothing until an entire compressed block is read
+                    self.assertGreater(len(chunks), 1)
+                self.assertEqual(cont.encode(), b"".join(chunks))
+
+        dd("decompressed chunks are bounded, however well the content is compressed")
+        zeros = bytes(1024 * 1024)
+        for codec in ("gzip", "bz2", "lzma"):
+            k3fs.fwrite(fn, [zeros] * 32, codec=codec, fsync=False)
+            self.assertLess(os.path.getsize(fn), 1024 * 1024 / 32)
+
+            n = 0
+            for chunk in k3fs.fread_chunks(fn, codec=codec, block_size=64 * 1024):
+                self.assertLessEqual(len(chunk), 64 * 1024)
+                n += len(chunk)
+            self.assertEqual(32 * 1024 * 1024, n)
+
+        dd("iterable content")
+        k3fs.fwrite(fn, (("%d," % i) if i % 2 else b"x" for i in range(1000)), codec="gzip")
+        self.assertEqual(
+            "".join(("%d," % i) if i % 2 else "x" for i in range(1000)),
+            k3fs.fread(fn, codec="gzip"),
+        )
+
+        k3fs.fwrite(fn, ["foo", b"bar"])
+        self.assertEqual("foobar", k3fs.fread(fn))
+
+        dd("concatenated streams")
+        with open(fn, "wb") as f:
+            f.write(gzip.compress(b"foo") + gzip.compress(b"bar"))
+        self.assertEqual("foobar", k3fs.fread(fn, codec="gzip"))
+
+        dd("truncated")
+        with open(fn, "wb") as f:
+            f.write(gzip.compress(cont.encode())[:-100])
+        self.assertRaises(k3fs.FSUtilError, k3fs.fread, fn, codec="gzip")
+
+        dd("error of content is raised and no temp file is left")
+
+        def _content():
+            yield "foo"
+            raise ValueError("foo")
+
+        for codec_thread in (False, True):
+            self.assertRaises(
+                ValueError, k3fs.fwrite, fn, _content(), codec="gzip", codec_thread=codec_thread, atomic=True
+            )
+            self.assertEqual(["pykit-ut-k3fs-codec"], k3fs.ls_files("/tmp", pattern="^pykit-ut-k3fs-codec"))
+
+        dd("register a codec")
+        import zlib
+
+        k3fs.register_codec("zlib", zlib.compressobj, zlib.decompressobj)
+        self.addCleanup(k3fs.fs._codecs.pop, "zlib")
+        k3fs.fwrite(fn, cont, codec="zlib")
+        self.assertEqual(cont.encode(), zlib.decompress(k3fs.fread(fn, mode="b")))
+        self.assertEqual(cont, k3fs.fread(fn, codec="zlib"))
+
+        self.assertRaises(k3fs.FSUtilError, k3fs.fwrite, fn, cont, codec="foo")
+        self.assertRaises(k3fs.FSUtilError, k3fs.fread, fn, codec="foo")
+        self.assertRaises(k3fs.FSUtilError, k3fs.fwrite, fn, cont, codec="gzip", preallocate=True)
+        self.assertRaises(k3fs.FSUtilError, k3fs.fwrite, fn, [cont], preallocate=True)
+
+        force_remove(fn)
+
+    def test_appender(self):
+        base = "/tmp/pykit-ut-k3fs-appender"
+        k3fs.remove(base, onerror="ignore")
+        k3fs.makedirs(base)
+        fn = os.path.join(base, "journal")
+
+        writevs = []
+        syncs = []
+        os_writev = os.writev
+        os_fdatasync = os.fdatasync
+
+        def _writev(fd, bufs):
+            writevs.append(len(bufs))
+            return os_writev(fd, bufs)
+
+        def _fdatasync(fd):
+            syncs.append(fd)
+            return os_fdatasync(fd)
+
+        os.writev = _writev
+        os.fdatasync = _fdatasync
+        try:
+            dd("records are written in batches of flush_size")
+            with k3fs.Appender(fn, flush_size=100, flush_interval=None) as a:
+                for i in range(100):
+                    a.write("%04d\n" % i)
+                    if i % 2 == 0:
+                        a.write(b"----\n")
+
+                self.assertEqual(7, len(writevs))
+                self.assertEqual([], syncs)
+
+            self.assertEqual(8, len(writevs))
+            self.assertEqual([], syncs)
+
+            lines = k3fs.fread(fn).splitlines()
+            self.assertEqual(150, len(lines))
+            self.assertEqual(["0000", "----", "0001", "0002", "----"], lines[:5])
+
+            dd("sync after every flush in batch mode")
+            del writevs[:]
+            with k3fs.Appender(fn, flush_size=100, flush_interval=None, sync="batch") as a:
+                for i in range(40):
+                    a.write("%04d\n" % i)
+            self.assertEqual(2, len(writevs))
+            self.assertEqual(2, len(syncs))
+
+            dd("sync at most once per sync_interval in interval mode")
+            del writevs[:]
+            del syncs[:]
+            with k3fs.Appender(fn, flush_size=10, flush_interval=None, sync="interval", sync_interval=100) as a:
+                for i in range(40):
+                    a.write("%04d\n" % i)
+                self.assertEqual(20, len(writevs))
+                self.assertEqual(0, len(syncs))
+            self.assertEqual(1, len(syncs))
+
+            dd("flushed and synced in background")
+            del syncs[:]
+            a = k3fs.Appender(fn, flush_interval=0.1, sync="interval", sync_interval=0.2)
+            a.write("foo\n")
+            time.sleep(0.15)
+            self.assertTrue(k3fs.fread(fn).endswith("foo\n"))
+            time.sleep(0.3)
+            self.assertEqual(1, len(syncs))
+            a.close()
+            self.assertEqual(1, len(syncs), "no dirty data to sync")
+            self.assertFalse(a.flusher.is_alive())
+
+            self.assertRaises(k3fs.FSUtilError, a.write, "foo")
+
+            dd("fall back to fsync without fdatasync, such as macOS")
+            del os.fdatasync
+            with k3fs.Appender(fn, flush_size=100, flush_interval=None, sync="batch") as a:
+                a.write("bar\n")
+            self.assertTrue(k3fs.fread(fn).endswith("bar\n"))
+        finally:
+            os.writev = os_writev
+            os.fdatasync = os_fdatasync
+
+        self.assertRaises(k3fs.FSUtilError, k3fs.Appender, fn, sync="foo")
+
+        dd("rotate by size")
+        k3fs.remove(base)
+        k3fs.makedirs(base)
+
+        with k3fs.Appender(fn, flush_size=10, flush_interval=None, rotate_size=100) as a:
+            for i in range(100):
+                a.write("%04d\n" % i)
+
+        rotated = sorted(k3fs.ls_files(base, pattern=r"^journal\."))
+        dd(rotated)
+        self.assertEqual(4, len(rotated))
+
+        content = "".join(k3fs.fread(base, f) for f in rotated) + k3fs.fread(fn)
+        self.assertEqual("".join("%04d\n" % i for i in range(100)), content)
+        for f in rotated:
+            self.assertEqual(100, os.path.getsize(os.path.join(base, f)))
+
+        k3fs.remove(base)
+
+    def test_fappend(self):
+        fn = "/tmp/pykit-ut-k3fs-fappend"
+        force_remove(fn)
+
+        k3fs.fappend(fn, "foo")
+        k3fs.fappend(fn, b"bar", fsync=True)
+        self.assertEqual("foobar", k3fs.fread(fn))
+
+        force_remove(fn)
+
+    def test_fupdate(self):
+        fn = "/tmp/pykit-ut-k3fs-fupdate"
+        force_remove(fn)
+        force_remove(fn + ".lock")
+
+        dd("inexistent file")
+        self.assertEqual("0", k3fs.fupdate(fn, lambda c: "0" if c is None else c))
+        self.assertEqual("0", k3fs.fread(fn))
+
+        dd("None leaves the file unchanged")
+        ino = os.stat(fn).st_ino
+        self.assertIsNone(k3fs.fupdate(fn, lambda c: None))
+        self.assertEqual(ino, os.stat(fn).st_ino)
+
+        dd("bytes")
+        self.assertEqual(b"0x", k3fs.fupdate(fn, lambda c: c + b"x", mode="b"))
+        k3fs.fwrite(fn, "0")
+
+        dd("no update is lost by concurrent writers")
+
+        def _incr(n):
+            for _ in range(n):
+                k3fs.fupdate(fn, lambda c: str(int(c) + 1), fsync=False)
+
+        ths = [k3thread.daemon(_incr, args=(20,)) for _ in range(20)]
+        for th in ths:
+            th.join()
+
+        self.assertEqual("400", k3fs.fread(fn))
+
+        dd("timeout")
+        with k3fs.FileLock(fn):
+            t0 = time.monotonic()
+            self.assertRaises(k3fs.LockTimeout, k3fs.fupdate, fn, lambda c: "1", timeout=0.2)
+            self.assertGreaterEqual(time.monotonic() - t0, 0.2)
+
+            self.assertRaises(k3fs.LockTimeout, k3fs.FileLock(fn, shared=True, timeout=0).acquire)
+
+        self.assertEqual("400", k3fs.fread(fn))
+
+        dd("shared lock")
+        with k3fs.FileLock(fn, shared=True):
+            with k3fs.FileLock(fn, shared=True, timeout=0):
+                pass
+
+            self.assertRaises(k3fs.LockTimeout, k3fs.fupdate, fn, lambda c: "1", timeout=0.1)
+
+        dd("waiter gets the lock when it is released")
+        lock = k3fs.FileLock(fn)
+        lock.acquire()
+        th = k3thread.daemon(lambda: (time.sleep(0.2), lock.release()))
+        self.assertEqual("1", k3fs.fupdate(fn, lambda c: "1", timeout=2))
+        th.join()
+
+        force_remove(fn)
+        force_remove(fn + ".lock")
+
     def test_remove_normal_file(self):
         f = "pykit-ut-k3fs-remove-file-normal"
         fn = "/tmp/" + f
@@ -475,6 +1049,117 @@ class TestFS(unittest.TestCase):
         k3fs.remove(dirname)
         self.assertFalse(os.path.exists(dirname))
 
+    def test_remove_symlink_to_dir(self):
+        dirname = "/tmp/pykit-ut-k3fs-remove-dir"
+        target = "/tmp/pykit-ut-k3fs-remove-target"
+        force_remove(dirname)
+        force_remove(target)
+
+        k3fs.makedirs(target)
+        k3fs.fwrite(target, "foo", "bar")
+        k3fs.makedirs(dirname)
+        os.symlink(target, os.path.join(dirname, "link"))
+
+        k3fs.remove(dirname, "link")
+        self.assertFalse(os.path.lexists(os.path.join(dirname, "link")))
+        self.assertEqual("bar", k3fs.fread(target, "foo"))
+
+        dd("not followed in a recursive remove")
+        os.symlink(target, os.path.join(dirname, "link"))
+
+        k3fs.remove(dirname)
+        self.assertFalse(os.path.exists(dirname))
+        self.assertEqual("bar", k3fs.fread(target, "foo"))
+
+        k3fs.remove(target)
+
+    def test_remove_gently(self):
+        M = 1024**2
+
+        dirname = "/tmp/pykit-ut-k3fs-remove-gently"
+        force_remove(dirname)
+        k3fs.makedirs(dirname, "sub")
+
+        def create(*paths, size):
+            with open(os.path.join(dirname, *paths), "wb") as f:
+                f.write(b"x" * M)
+                f.truncate(size)
+
+        truncated = []
+        orig = os.ftruncate
+
+        def _ftruncate(fd, size):
+            truncated.append(size)
+            return orig(fd, size)
+
+        os.ftruncate = _ftruncate
+        try:
+            create("big", size=40 * M)
+
+            t0 = time.time()
+            k3fs.remove(dirname, "big", truncate_step=8 * M, free_limit=64 * M)
+            spent = time.time() - t0
+            dd("spent:", spent)
+
+            self.assertFalse(os.path.exists(os.path.join(dirname, "big")))
+            self.assertEqual([32 * M, 24 * M, 16 * M, 8 * M], truncated)
+            self.assertGreaterEqual(spent, 0.45)
+
+            dd("a hard link keeps the content")
+            del truncated[:]
+            create("big", size=40 * M)
+            os.link(os.path.join(dirname, "big"), os.path.join(dirname, "sub", "big"))
+
+            k3fs.remove(dirname, "big", truncate_step=8 * M)
+            self.assertEqual([], truncated)
+            self.assertEqual(40 * M, os.path.getsize(os.path.join(dirname, "sub", "big")))
+
+            dd("in a recursive remove, small files are removed at once")
+            create("sub", "small", size=M)
+
+            k3fs.remove(dirname, truncate_step=16 * M)
+            self.assertEqual([24 * M, 8 * M], truncated)
+            self.assertFalse(os.path.exists(dirname))
+
+            dd("free_limit alone truncates in TRUNCATE_STEP")
+            k3fs.makedirs(dirname)
+            create("big", size=k3fs.fs.TRUNCATE_STEP + M)
+
+            del truncated[:]
+            k3fs.remove(dirname, free_limit=1024**4)
+            self.assertEqual([M], truncated)
+
+            dd("a file that can not be removed is not truncated")
+            k3fs.makedirs(dirname)
+            create("big", size=40 * M)
+            del truncated[:]
+
+            orig_remove = os.remove
+
+            def _remove(path):
+                raise PermissionError(errno.EPERM, "Operation not permitted", path)
+
+            errors = []
+            os.remove = _remove
+            try:
+                for onerror in ("raise", "ignore", lambda *args: errors.append(args[0])):
+                    if onerror == "raise":
+                        self.assertRaises(
+                            PermissionError, k3fs.remove, dirname, "big", onerror=onerror, truncate_step=8 * M
+                        )
+                    else:
+                        k3fs.remove(dirname, "big", onerror=onerror, truncate_step=8 * M)
+            finally:
+                os.remove = orig_remove
+
+            self.assertEqual([_remove], errors)
+            self.assertEqual([], truncated)
+            self.assertEqual(40 * M, os.path.getsize(os.path.join(dirname, "big")))
+
+            k3fs.remove(dirname)
+        finally:
+            os.ftruncate = orig
+
     def test_remove_error(self):
         dirname = "/tmp/pykit-ut-k3fs-remove-on-error"
         if os.path.isdir(dirname):
@@ -679,6 +1364,501 @@ class TestFS(unittest.TestCase):
 
         force_remove(fn)
 
+    def test_stat_many(self):
+        base = "/tmp/pykit-ut-k3fs-stat-many"
+        k3fs.remove(base, onerror="ignore")
+        k3fs.makedirs(base)
+
+        paths = []
+        for i in range(3000):
+            if i % 100 == 7:
+                paths.append(os.path.join(base, "inexistent%d" % i))
+            else:
+                paths.append(os.path.join(base, "f%d" % i))
+                k3fs.fwrite(paths[-1], "x" * (i % 50), fsync=False)
+
+        os.symlink(paths[0], os.path.join(base, "link"))
+        paths.append(os.path.join(base, "link"))
+        paths.append(base)
+        paths.append("nul\0path")
+
+        for workers in (1, 4):
+            dd("workers:", workers)
+            cols = k3fs.stat_many(iter(paths), workers=workers)
+            self.assertEqual(len(paths), len(cols))
+
+            failed = [i for i in range(3000) if i % 100 == 7] + [len(paths) - 1]
+            self.assertEqual(failed, cols.failed())
+            self.assertEqual(errno.ENOENT, cols.errno[7])
+            self.assertEqual(errno.EINVAL, cols.errno[len(paths) - 1])
+            self.assertIsNone(cols.get(7))
+            self.assertEqual(0, cols.size[7])
+
+            for i in (0, 1, 2999, len(paths) - 3, len(paths) - 2):
+                st = os.stat(paths[i])
+                self.assertEqual(
+                    {
+                        "size": st.st_size,
+                        "mtime_ns": st.st_mtime_ns,
+                        "ino": st.st_ino,
+                        "dev": st.st_dev,
+                        "mode": st.st_mode,
+                        "nlink": st.st_nlink,
+                        "blocks": st.st_blocks,
+                    },
+                    cols.get(i),
+                )
+
+            self.assertEqual(sum(i % 50 for i in range(3000) if i % 100 != 7), sum(cols.size[:3000]))
+
+        dd("do not follow symlinks")
+        cols = k3fs.stat_many(paths[-3:-1], follow_symlinks=False)
+        self.assertTrue(stat.S_ISLNK(cols.mode[0]))
+        self.assertTrue(stat.S_ISDIR(cols.mode[1]))
+
+        self.assertEqual(0, len(k3fs.stat_many([])))
+
+        k3fs.remove(base)
+
+    def test_get_file_extents(self):
+        M = 1024**2
+
+        fn = "/tmp/pykit-ut-k3fs-extents"
+        force_remove(fn)
+
+        k3fs.fwrite(fn, "")
+        self.assertEqual([], k3fs.get_file_extents(fn))
+
+        with open(fn, "wb") as f:
+            f.write(b"a" * 10)
+            f.seek(M * 4)
+            f.write(b"b" * 10)
+            f.truncate(M * 8)
+
+        extents = k3fs.get_file_extents("/tmp", "pykit-ut-k3fs-extents")
+        dd("extents:", extents)
+
+        # extents are contiguous and cover the whole file
+        offset = 0
+        for start, length, is_data in extents:
+            self.assertEqual(offset, start)
+            self.assertGreater(length, 0)
+            offset += length
+        self.assertEqual(M * 8, offset)
+
+        self.assertTrue(extents[0][2])
+        self.assertFalse(extents[-1][2], "tail is a hole")
+
+        force_remove(fn)
+
+    def test_calc_checksums_sparse(self):
+        M = 1024**2
+
+        fn = "/tmp/pykit-ut-k3fs-calc_checksums-sparse"
+        force_remove(fn)
+
+        with open(fn, "wb") as f:
+            f.seek(M * 3 + 7)
+            f.write(b"foo")
+            f.seek(M * 16)
+            f.write(b"bar")
+            f.truncate(M * 32 + 5)
+
+        with open(fn, "rb") as f:
+            cont = f.read()
+
+        expected = {
+            "sha1": hashlib.sha1(cont).hexdigest(),
+            "md5": hashlib.md5(cont).hexdigest(),
+            "crc32": "%08x" % (binascii.crc32(cont) & 0xFFFFFFFF),
+            "sha256": hashlib.sha256(cont).hexdigest(),
+        }
+
+        for block_size in (M, M * 5, M * 64):
+            t0 = time.time()
+            checksums = k3fs.calc_checksums(
+                fn, sha1=True, md5=True, crc32=True, sha256=True, block_size=block_size, io_limit=M
+            )
+            spend_time = time.time() - t0
+
+            self.assertEqual(expected, checksums)
+
+            # holes are not read thus not throttled
+            self.assertLess(spend_time, 2)
+
+        force_remove(fn)
+
+    def test_calc_checksums_stream(self):
+        dd("a procfs file reports size 0")
+        fn = "/proc/self/cmdline"
+        with open(fn, "rb") as f:
+            cont = f.read()
+        self.assertEqual(0, os.stat(fn).st_size)
+
+        self.assertEqual(hashlib.sha1(cont).hexdigest(), k3fs.calc_checksums(fn, sha1=True)["sha1"])
+        self.assertEqual(cont, b"".join(k3fs.fread_chunks(fn, block_size=7)))
+        self.assertTrue(k3fs.compare_files(fn, fn))
+
+        rst = k3fs.calc_range_checksums(fn, algorithm="sha1", range_size=16, block_size=7)
+        self.assertEqual(
+            [
+                (off, len(cont[off : off + 16]), hashlib.sha1(cont[off : off + 16]).hexdigest())
+                for off in range(0, len(cont), 16)
+            ],
+            rst["ranges"],
+        )
+
+        other = "/tmp/pykit-ut-k3fs-calc-checksums-stream"
+        k3fs.fwrite(other, cont + b"x")
+        self.assertEqual([(len(cont), 1)], k3fs.compare_files(fn, other, ranges=True))
+        k3fs.fwrite(other, cont)
+        self.assertTrue(k3fs.compare_files(fn, other))
+        force_remove(other)
+
+        dd("a pipe")
+        cont = os.urandom(3 * 1024**2 + 5)
+
+        def _pipe():
+            r, w = os.pipe()
+
+            def _write():
+                with os.fdopen(w, "wb") as f:
+                    f.write(cont)
+
+            th = threading.Thread(target=_write, daemon=True)
+            th.start()
+            return r, th
+
+        r, th = _pipe()
+        try:
+            rst = k3fs.calc_checksums("/dev/fd/%d" % r, sha1=True, md5=True, block_size=100 * 1024)
+        finally:
+            th.join()
+            os.close(r)
+
+        self.assertEqual(hashlib.sha1(cont).hexdigest(), rst["sha1"])
+        self.assertEqual(hashlib.md5(cont).hexdigest(), rst["md5"])
+
+        r, th = _pipe()
+        try:
+            chunks = list(k3fs.iter_file_chunks("/dev/fd/%d" % r, avg_size=64 * 1024, algorithm="sha1"))
+        finally:
+            th.join()
+            os.close(r)
+        self.assertEqual(len(cont), sum(c[1] for c in chunks))
+
+    def test_calc_checksums_algorithms(self):
+        M = 1024**2
+
+        fn = "/tmp/pykit-ut-k3fs-calc_checksums-algorithms"
+        force_remove(fn)
+
+        cont = "It  바로 とても 氣!" * M
+        k3fs.fwrite(fn, cont)
+        cont = cont.encode("utf-8")
+
+        class Size(object):
+            def __init__(self):
+                self.n = 0
+
+            def update(self, buf):
+                self.n += len(buf)
+
+            def hexdigest(self):
+                return "%x" % self.n
+
+        k3fs.register_checksum("size", Size)
+        self.addCleanup(k3fs.fs._checksum_algorithms.pop, "size")
+
+        expected = {
+            "sha1": hashlib.sha1(cont).hexdigest(),
+            "md5": None,
+            "crc32": "%08x" % (binascii.crc32(cont) & 0xFFFFFFFF),
+            "sha256": None,
+            "sha512": hashlib.sha512(cont).hexdigest(),
+            "blake2b": hashlib.blake2b(cont).hexdigest(),
+            "sha3_256": hashlib.sha3_256(cont).hexdigest(),
+            "size": "%x" % len(cont),
+        }
+
+        for parallel in (False, True):
+            dd("parallel:", parallel)
+
+            checksums = k3fs.calc_checksums(
+                fn,
+                sha1=True,
+                crc32=True,
+                algorithms=["sha512", "blake2b", "sha3_256", "size", "sha1"],
+                block_size=M * 3,
+                io_limit=-1,
+                parallel=parallel,
+            )
+            self.assertEqual(expected, checksums)
+
+        self.assertRaises(k3fs.FSUtilError, k3fs.calc_checksums, fn, algorithms=["foo"])
+
+        force_remove(fn)
+
+    def test_calc_range_checksums(self):
+        K = 1024
+
+        fn = "/tmp/pykit-ut-k3fs-calc-range-checksums"
+        force_remove(fn)
+
+        def tree(digests, size, range_size):
+            level = [hashlib.sha256(b"\x00" + bytes.fromhex(d)).digest() for d in digests]
+            if len(level) == 0:
+                level = [hashlib.sha256().digest()]
+            while len(level) > 1:
+                upper = [
+                    hashlib.sha256(b"\x01" + level[i] + level[i + 1]).digest() for i in range(0, len(level) - 1, 2)
+                ]
+                if len(level) % 2 == 1:
+                    upper.append(level[-1])
+                level = upper
+            return hashlib.sha256(b"\x02" + struct.pack(">QQ", size, range_size) + level[0]).hexdigest()
+
+        dd("dense file and sparse file")
+        cont = os.urandom(1000 * K)
+        k3fs.fwrite(fn, cont)
+
+        sparse = fn + "-sparse"
+        with open(sparse, "wb") as f:
+            f.seek(300 * K)
+            f.write(cont[300 * K : 600 * K])
+            f.truncate(1000 * K)
+        sparse_cont = bytes(300 * K) + cont[300 * K : 600 * K] + bytes(400 * K)
+
+        for path, c in ((fn, cont), (sparse, sparse_cont)):
+            ranges = [(off, min(256 * K, len(c) - off)) for off in range(0, len(c), 256 * K)]
+            digests = [hashlib.sha256(c[off : off + n]).hexdigest() for off, n in ranges]
+
+            for workers in (1, 3):
+                dd(path, "workers:", workers)
+                rst = k3fs.calc_range_checksums(path, range_size=256 * K, block_size=100 * K, workers=workers)
+
+                self.assertEqual("sha256", rst["algorithm"])
+                self.assertEqual(256 * K, rst["range_size"])
+                self.assertEqual([(off, n, d) for (off, n), d in zip(ranges, digests)], rst["ranges"])
+                self.assertEqual(tree(digests, len(c), 256 * K), rst["digest"])
+
+        dd("a range or none")
+        rst = k3fs.calc_range_checksums(fn, algorithm="crc32", range_size=1000 * K)
+        self.assertEqual([(0, 1000 * K, k3fs.calc_checksums(fn, crc32=True)["crc32"])], rst["ranges"])
+        self.assertNotEqual(rst["ranges"][0][2], rst["digest"])
+
+        k3fs.fwrite(fn, "")
+        rst = k3fs.calc_range_checksums(fn)
+        self.assertEqual([], rst["ranges"])
+        self.assertEqual(tree([], 0, 256 * 1024 * 1024), rst["digest"])
+
+        dd("a file of the digests of 2 ranges is not taken as an inner node")
+        k3fs.fwrite(fn, cont[: 512 * K])
+        rst = k3fs.calc_range_checksums(fn, range_size=256 * K)
+        k3fs.fwrite(sparse, b"\x01" + b"".join(bytes.fromhex(r[2]) for r in rst["ranges"]))
+        forged = k3fs.calc_range_checksums(sparse, range_size=256 * K)
+        self.assertEqual(1, len(forged["ranges"]))
+        self.assertNotEqual(rst["digest"], forged["digest"])
+
+        dd("the same content with another range_size or size")
+        self.assertNotEqual(rst["digest"], k3fs.calc_range_checksums(fn, range_size=512 * K)["digest"])
+        k3fs.fwrite(sparse, cont[: 256 * K])
+        self.assertNotEqual(
+            k3fs.calc_range_checksums(sparse, range_size=256 * K)["digest"],
+            tree([rst["ranges"][0][2]], 512 * K, 256 * K),
+        )
+
+        dd("io_limit is shared by workers")
+        k3fs.fwrite(fn, cont)
+        t0 = time.time()
+        k3fs.calc_range_checksums(fn, range_size=250 * K, block_size=50 * K, io_limit=2000 * K, workers=4)
+        self.assertGreaterEqual(time.time() - t0, 0.4)
+
+        self.assertRaises(k3fs.FSUtilError, k3fs.calc_range_checksums, fn, algorithm="foo")
+        self.assertRaises(k3fs.FSUtilError, k3fs.calc_range_checksums, fn, range_size=0)
+        self.assertRaises(k3fs.FSUtilError, k3fs.calc_range_checksums, fn, io_limit=0)
+
+        force_remove(fn)
+        force_remove(sparse)
+
+    def test_compare_files(self):
+        K = 1024
+
+        base = "/tmp/pykit-ut-k3fs-compare-files"
+        k3fs.remove(base, onerror="ignore")
+        k3fs.makedirs(base)
+
+        a = os.path.join(base, "a")
+        b = os.path.join(base, "b")
+
+        cont = os.urandom(1024 * K)
+        k3fs.fwrite(a, cont)
+        k3fs.fwrite(b, cont)
+
+        events = []
+        k3fs.add_event_listener(events.append)
+        try:
+            for workers in (1, 4):
+                dd("workers:", workers)
+
+                self.assertTrue(k3fs.compare_files(a, b, block_size=100 * K, workers=workers))
+                self.assertEqual([], k3fs.compare_files(a, b, block_size=100 * K, workers=workers, ranges=True))
+
+                dd("differs in the first block, the rest is not read")
+                k3fs.fwrite(b, b"x" + cont[1:])
+
+                del events[:]
+                self.assertFalse(k3fs.compare_files(a, b, block_size=16 * K, workers=workers))
+                self.assertEqual("compare_files", events[0]["op"])
+                self.assertLessEqual(events[0]["bytes"], 2 * 16 * K * workers * 2)
+
+                dd("ranges of differences")
+                k3fs.fwrite(b, b"x" + cont[1 : 250 * K] + b"y" * 2 * K + cont[252 * K :] + b"z")
+                self.assertEqual(
+                    [(0, 100 * K), (200 * K, 100 * K), (1024 * K, 1)],
+                    k3fs.compare_files(a, b, block_size=100 * K, workers=workers, ranges=True),
+                )
+
+                dd("adjacent ranges are merged")
+                k3fs.fwrite(b, cont[: 99 * K] + b"x" * 2 * K + cont[101 * K :])
+                self.assertEqual(
+                    [(0, 200 * K)],
+                    k3fs.compare_files(a, b, block_size=100 * K, workers=workers, ranges=True),
+                )
+
+                k3fs.fwrite(b, cont)
+        finally:
+            k3fs.remove_event_listener(events.append)
+
+        dd("different size is not read")
+        k3fs.fwrite(b, cont[:-1])
+        del events[:]
+        k3fs.add_event_listener(events.append)
+        try:
+            self.assertFalse(k3fs.compare_files(a, b))
+        finally:
+            k3fs.remove_event_listener(events.append)
+        self.assertEqual(0, events[0]["bytes"])
+
+        self.assertEqual([(1024 * K - 1, 1)], k3fs.compare_files(b, a, block_size=100 * K, ranges=True))
+
+        dd("the same inode")
+        os.link(a, os.path.join(base, "c"))
+        self.assertTrue(k3fs.compare_files(a, os.path.join(base, "c")))
+        self.assertTrue(k3fs.compare_files(a, a))
+
+        dd("empty files")
+        k3fs.fwrite(a, "")
+        k3fs.fwrite(b, "")
+        self.assertTrue(k3fs.compare_files(a, b))
+
+        self.assertRaises(FileNotFoundError, k3fs.compare_files, a, os.path.join(base, "d"))
+        self.assertRaises(k3fs.FSUtilError, k3fs.compare_files, a, b, block_size=0)
+
+        k3fs.remove(base)
+
+    def test_tree_digest(self):
+        base = "/tmp/pykit-ut-k3fs-tree-digest"
+        k3fs.remove(base, onerror="ignore")
+
+        for d in ("a", "b"):
+            k3fs.makedirs(base, d, "sub", "subsub")
+            k3fs.makedirs(base, d, "empty")
+            k3fs.fwrite(base, d, "foo", "foo")
+            k3fs.fwrite(base, d, "sub", "bar", "bar")
+            k3fs.fwrite(base, d, "sub", "subsub", "baz", "baz")
+            os.symlink("foo", os.path.join(base, d, "link"))
+
+        a = os.path.join(base, "a")
+        b = os.path.join(base, "b")
+
+        digest = k3fs.tree_digest(a)
+        self.assertEqual(64, len(digest))
+        self.assertEqual(digest, k3fs.tree_digest(base, "b"))
+        self.assertNotEqual(digest, k3fs.tree_digest(a, algorithm="sha1"))
+
+        with k3fs.DeviceScheduler() as ex:
+            self.assertEqual(digest, k3fs.tree_digest(a, executor=ex))
+
+        # digest of a file is its content digest
+        self.assertEqual(hashlib.sha256(b"foo").hexdigest(), k3fs.tree_digest(a, "foo"))
+
+        hashed = []
+        file_digest = k3fs.fs._file_digest
+
+        def _file_digest(path, algorithm):
+            hashed.append(path)
+            return file_digest(path, algorithm)
+
+        k3fs.fs._file_digest = _file_digest
+        try:
+            dd("files just written are hashed every time")
+            cache = k3fs.TreeDigestCache()
+            self.assertEqual(digest, k3fs.tree_digest(b, cache=cache))
+            self.assertEqual(3, len(hashed))
+            self.assertEqual(digest, k3fs.tree_digest(b, cache=cache))
+            self.assertEqual(6, len(hashed))
+
+            del hashed[:]
+            cache.racy_ns = 0
+            self.assertEqual(digest, k3fs.tree_digest(b, cache=cache))
+            self.assertEqual(3, len(hashed))
+
+            dd("unchanged tree hashes nothing")
+            del hashed[:]
+            self.assertEqual(digest, k3fs.tree_digest(b, cache=cache))
+            self.assertEqual([], hashed)
+
+            dd("changed file is hashed again")
+            k3fs.fwrite(b, "sub", "subsub", "baz", "bazbaz")
+            changed = k3fs.tree_digest(b, cache=cache)
+            self.assertNotEqual(digest, changed)
+            self.assertEqual([os.path.join(b, "sub", "subsub", "baz")], hashed)
+
+            k3fs.fwrite(b, "sub", "subsub", "baz", "baz")
+            self.assertEqual(digest, k3fs.tree_digest(b, cache=cache))
+
+            dd("least recently used dirs are evicted")
+            cache = k3fs.TreeDigestCache(max_entries=4)
+            cache.racy_ns = 0
+            del hashed[:]
+            self.assertEqual(digest, k3fs.tree_digest(b, cache=cache))
+            self.assertLessEqual(cache.n_entries, 4)
+            # the root dir is used last
+            self.assertEqual(b, list(cache.records)[-1])
+            self.assertLess(len(cache.records), 5)
+
+            del hashed[:]
+            self.assertEqual(digest, k3fs.tree_digest(b, cache=cache))
+            self.assertEqual(2, len(hashed))
+        finally:
+            k3fs.fs._file_digest = file_digest
+
+        dd("mode, name and entry changes")
+        os.chmod(os.path.join(b, "foo"), 0o600)
+        self.assertNotEqual(digest, k3fs.tree_digest(b))
+        os.chmod(os.path.join(b, "foo"), os.stat(os.path.join(a, "foo")).st_mode)
+        self.assertEqual(digest, k3fs.tree_digest(b))
+
+        os.rename(os.path.join(b, "empty"), os.path.join(b, "empty2"))
+        self.assertNotEqual(digest, k3fs.tree_digest(b))
+        os.rmdir(os.path.join(b, "empty2"))
+        self.assertNotEqual(digest, k3fs.tree_digest(b))
+
+        k3fs.remove(base)
+
+
+class _Huge(bytes):
+    # pretends to be a large content without allocating it
+
+    def __new__(cls, size):
+        rst = super().__new__(cls, b"x")
+        rst.size = size
+        return rst
+
+    def __len__(self):
+        return self.size
+
 
 def force_remove(fn):
     try:
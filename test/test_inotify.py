@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import asyncio
+import os
+import threading
+import unittest
+
+import k3fs
+import k3ut
+from k3fs import inotify
+
+dd = k3ut.dd
+
+base = "/tmp/pykit-ut-k3fs-inotify"
+
+
+class TestInotify(unittest.TestCase):
+    def setUp(self):
+        k3fs.remove(base, onerror="ignore")
+        k3fs.makedirs(base, "a", "b")
+
+    def tearDown(self):
+        k3fs.remove(base, onerror="ignore")
+
+    def test_events(self):
+        with k3fs.Watcher(base) as w:
+            self.assertEqual([], w.read(timeout=0.1))
+
+            dd("file in a sub dir, written several times is coalesced")
+            for i in range(10):
+                k3fs.fwrite(base, "a", "b", "foo", str(i), fsync=False)
+
+            evs = w.read(timeout=1)
+            dd(evs)
+            self.assertEqual([os.path.join(base, "a", "b", "foo")], [ev.path for ev in evs])
+            self.assertTrue(evs[0].mask & inotify.IN_CREATE)
+            self.assertTrue(evs[0].mask & inotify.IN_CLOSE_WRITE)
+            self.assertFalse(evs[0].is_dir)
+
+            dd("new sub dir is watched")
+            k3fs.makedirs(base, "c")
+            evs = w.read(timeout=1)
+            self.assertEqual([os.path.join(base, "c")], [ev.path for ev in evs])
+            self.assertTrue(evs[0].is_dir)
+
+            k3fs.fwrite(base, "c", "bar", "x")
+            evs = w.read(timeout=1)
+            self.assertEqual([os.path.join(base, "c", "bar")], [ev.path for ev in evs])
+
+            dd("moved dir is watched at the new path")
+            os.rename(os.path.join(base, "c"), os.path.join(base, "d"))
+            evs = w.read(timeout=1)
+            self.assertEqual({os.path.join(base, "c"), os.path.join(base, "d")}, {ev.path for ev in evs})
+
+            k3fs.remove(base, "d", "bar")
+            evs = w.read(timeout=1)
+            self.assertEqual([os.path.join(base, "d", "bar")], [ev.path for ev in evs])
+            self.assertTrue(evs[0].mask & inotify.IN_DELETE)
+
+            evs = list(w.events(timeout=0.1))
+            self.assertEqual([], evs)
+
+    def test_not_recursive(self):
+        with k3fs.Watcher(base, recursive=False) as w:
+            k3fs.fwrite(base, "a", "foo", "x")
+            self.assertEqual([], w.read(timeout=0.2))
+
+            k3fs.fwrite(base, "foo", "x")
+            self.assertEqual([os.path.join(base, "foo")], [ev.path for ev in w.read(timeout=1)])
+
+    def test_overflow(self):
+        with open("/proc/sys/fs/inotify/max_queued_events") as f:
+            max_queued = int(f.read())
+
+        if max_queued > 100000:
+            dd("queue is too large to overflow in a test")
+            return
+
+        cache = k3fs.TreeDigestCache()
+        cache._put("foo", "foo", {}, 1)
+
+        with k3fs.Watcher(base, coalesce=0) as w:
+            w.attach(cache)
+
+            for i in range(max_queued // 2 + 100):
+                fn = os.path.join(base, "f%d" % i)
+                with open(fn, "w"):
+                    pass
+
+            evs = w.read(timeout=1)
+            self.assertEqual(1, len(evs))
+            self.assertTrue(evs[0].overflow)
+            self.assertIsNone(evs[0].path)
+            self.assertEqual({}, cache.records)
+
+    def test_attach(self):
+        cache = k3fs.TreeDigestCache()
+        digest = k3fs.tree_digest(base, cache=cache)
+
+        a = os.path.join(base, "a")
+        b = os.path.join(base, "a", "b")
+        self.assertEqual({base, a, b}, set(cache.records))
+
+        with k3fs.Watcher(base) as w:
+            w.attach(cache)
+
+            k3fs.fwrite(b, "foo", "x")
+            w.read(timeout=1)
+
+            self.assertEqual({base, a}, set(cache.records))
+            self.assertNotEqual(digest, k3fs.tree_digest(base, cache=cache))
+
+            w.detach(cache)
+            k3fs.fwrite(b, "foo", "y")
+            w.read(timeout=1)
+            self.assertEqual({base, a, b}, set(cache.records))
+
+    def test_stream(self):
+        fn = os.path.join(base, "a", "foo")
+
+        async def _watch():
+            with k3fs.Watcher(base) as w:
+                th = threading.Timer(0.1, k3fs.fwrite, args=(fn, "x"))
+                th.start()
+
+                async for ev in w.stream():
+                    th.join()
+                    return ev
+
+        ev = asyncio.run(asyncio.wait_for(_watch(), 5))
+        self.assertEqual(fn, ev.path)
+
+    def test_stream_does_not_block_loop(self):
+        fn = os.path.join(base, "a", "foo")
+        stop = threading.Event()
+
+        def _write():
+            # a burst of more than 1 second, as long as 20 coalesce windows
+            for i in range(100):
+                k3fs.fwrite(fn, str(i), fsync=False)
+                if stop.wait(0.01):
+                    return
+
+        async def _tick(gaps):
+            t = asyncio.get_running_loop().time()
+            while True:
+                await asyncio.sleep(0.01)
+                now = asyncio.get_running_loop().time()
+                gaps.append(now - t)
+                t = now
+
+        async def _watch():
+            gaps = []
+            ticker = asyncio.ensure_future(_tick(gaps))
+
+            with k3fs.Watcher(base, coalesce=0.05) as w:
+                th = threading.Thread(target=_write)
+                th.start()
+
+                evs = []
+                async for ev in w.stream():
+                    evs.append(ev)
+                    if ev.mask & k3fs.inotify.IN_CLOSE_WRITE:
+                        break
+
+            stop.set()
+            th.join()
+            # let the ticker see the last gap
+            await asyncio.sleep(0.05)
+            ticker.cancel()
+            return evs, gaps
+
+        evs, gaps = asyncio.run(asyncio.wait_for(_watch(), 5))
+        dd("events:", evs)
+        dd("max gap:", max(gaps))
+
+        self.assertEqual(fn, evs[-1].path)
+        self.assertLess(max(gaps), 0.2)
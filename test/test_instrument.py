@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import os
+import unittest
+
+import k3fs
+import k3ut
+
+dd = k3ut.dd
+
+
+class TestInstrument(unittest.TestCase):
+    def setUp(self):
+        self.events = []
+        k3fs.add_event_listener(self.events.append)
+
+    def tearDown(self):
+        k3fs.remove_event_listener(self.events.append)
+
+    def test_events(self):
+        M = 1024**2
+        base = "/tmp/pykit-ut-k3fs-instrument"
+        k3fs.remove(base, onerror="ignore")
+        del self.events[:]
+
+        k3fs.makedirs(base, "a")
+        k3fs.fwrite(base, "a", "foo", "x" * M * 3, atomic=True)
+        k3fs.fread(base, "a", "foo")
+        k3fs.calc_checksums(os.path.join(base, "a", "foo"), sha1=True, block_size=M, io_limit=M * 30)
+        k3fs.get_mountpoint(base)
+        k3fs.remove(base)
+
+        dd(self.events)
+
+        ops = [ev["op"] for ev in self.events]
+        self.assertEqual(["makedirs", "fwrite", "fread", "calc_checksums", "get_mountpoint", "remove"], ops)
+
+        for ev in self.events:
+            self.assertIsNone(ev["error"])
+            self.assertGreater(ev["time"], 0)
+
+        mk, wr, rd, ck, mp, rm = self.events
+
+        self.assertEqual(os.path.join(base, "a"), mk["path"])
+
+        self.assertEqual(os.path.join(base, "a", "foo"), wr["path"])
+        self.assertEqual(M * 3, wr["bytes"])
+        self.assertEqual(1, wr["blocks"])
+        self.assertGreater(wr["fsync_time"], 0)
+
+        self.assertEqual(M * 3, rd["bytes"])
+
+        self.assertEqual(M * 3, ck["bytes"])
+        self.assertEqual(3, ck["blocks"])
+        self.assertGreater(ck["throttle_time"], 0)
+
+        self.assertEqual(base, mp["path"])
+        self.assertEqual(base, rm["path"])
+
+    def test_error(self):
+        del self.events[:]
+
+        self.assertRaises(OSError, k3fs.fread, "/tmp/pykit-ut-k3fs-instrument-inexistent")
+
+        self.assertEqual(1, len(self.events))
+        self.assertIsInstance(self.events[0]["error"], OSError)
+
+    def test_remove_listener(self):
+        k3fs.remove_event_listener(self.events.append)
+        del self.events[:]
+
+        k3fs.get_disk_partitions()
+        self.assertEqual([], self.events)
+
+    def test_metrics(self):
+        m = k3fs.Metrics()
+        k3fs.add_event_listener(m)
+        try:
+            fn = "/tmp/pykit-ut-k3fs-instrument-metrics"
+            for _ in range(3):
+                k3fs.fwrite(fn, "foo", fsync=False)
+                k3fs.fread(fn)
+
+            k3fs.remove(fn)
+            self.assertRaises(OSError, k3fs.remove, fn)
+        finally:
+            k3fs.remove_event_listener(m)
+
+        rst = m.dump()
+        dd(rst)
+
+        self.assertEqual({"fwrite", "fread", "remove"}, set(rst))
+
+        self.assertEqual(3, rst["fwrite"]["count"])
+        self.assertEqual(9, rst["fwrite"]["bytes"])
+        self.assertEqual(0, rst["fwrite"]["fsync_time"])
+        self.assertEqual(3, sum(rst["fwrite"]["histogram"].values()))
+
+        self.assertEqual(2, rst["remove"]["count"])
+        self.assertEqual(1, rst["remove"]["errors"])
+
+        m.reset()
+        self.assertEqual({}, m.dump())
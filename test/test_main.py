@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import hashlib
+import io
+import json
+import os
+import unittest
+
+import k3fs
+import k3proc
+import k3ut
+from k3fs import __main__ as cli
+
+dd = k3ut.dd
+
+base = "/tmp/pykit-ut-k3fs-cli"
+
+
+def run(argv, stdin=""):
+    out = io.StringIO()
+    err = io.StringIO()
+    rc = cli.main(argv, stdin=io.StringIO(stdin), stdout=out, stderr=err)
+    dd("run:", argv, rc, out.getvalue(), err.getvalue())
+    return rc, out.getvalue(), err.getvalue()
+
+
+class TestMain(unittest.TestCase):
+    def setUp(self):
+        k3fs.remove(base, onerror="ignore")
+        k3fs.makedirs(base, "d1")
+        k3fs.makedirs(base, "d2")
+        for i in range(20):
+            k3fs.fwrite(base, "f%02d" % i, "x" * i, fsync=False)
+
+    def tearDown(self):
+        k3fs.remove(base, onerror="ignore")
+
+    def test_checksum(self):
+        paths = [os.path.join(base, "f%02d" % i) for i in range(20)]
+
+        for opts in (["-w", "1"], ["-w", "4"], ["-w", "4", "--per-device", "2"]):
+            rc, out, err = run(["checksum", "-a", "sha1", "-a", "md5", "--json", *opts, "-"], "\n".join(paths))
+            self.assertEqual(0, rc)
+
+            recs = [json.loads(line) for line in out.splitlines()]
+            self.assertEqual(paths, [r["path"] for r in recs], "in the order of input")
+
+            for i, r in enumerate(recs):
+                self.assertEqual(hashlib.sha1(b"x" * i).hexdigest(), r["sha1"])
+                self.assertEqual(hashlib.md5(b"x" * i).hexdigest(), r["md5"])
+
+        dd("text output, NUL separated input")
+        rc, out, err = run(["checksum", "-0", "-", paths[1]], paths[2] + "\0" + paths[3] + "\0")
+        self.assertEqual(0, rc)
+        self.assertEqual(
+            [hashlib.sha1(b"x" * i).hexdigest() + "\t" + paths[i] for i in (2, 3, 1)],
+            out.splitlines(),
+        )
+
+        dd("errors")
+        rc, out, err = run(["checksum", "--json", "--progress", base + "/inexistent", paths[0]])
+        self.assertEqual(1, rc)
+
+        recs = [json.loads(line) for line in out.splitlines()]
+        self.assertEqual(base + "/inexistent", recs[0]["path"])
+        self.assertIn("FileNotFoundError", recs[0]["error"])
+        self.assertEqual(paths[0], recs[1]["path"])
+        self.assertIn("2 done, 1 errors", err)
+
+        rc, out, err = run(["checksum", base + "/inexistent"])
+        self.assertEqual(1, rc)
+        self.assertEqual("", out)
+        self.assertIn("inexistent", err)
+
+    def test_ls_rm(self):
+        rc, out, err = run(["ls", base])
+        self.assertEqual(0, rc)
+        self.assertEqual(22, len(out.splitlines()))
+
+        rc, out, err = run(["ls", "-d", base])
+        self.assertEqual([base + "/d1", base + "/d2"], out.splitlines())
+
+        rc, out, err = run(["ls", "-j", "-f", "--pattern", "1$", base])
+        recs = [json.loads(line) for line in out.splitlines()]
+        self.assertEqual([{"path": base + "/f01", "type": "file"}, {"path": base + "/f11", "type": "file"}], recs)
+
+        rc, out, err = run(
+            ["rm", "-w", "4", "--truncate-step", "4", "--free-limit", "1000000", "-"],
+            "\n".join([r["path"] for r in recs] + [base + "/d1"]),
+        )
+        self.assertEqual(0, rc)
+        self.assertEqual("", out)
+
+        rc, out, err = run(["ls", base, "--pattern", "1"])
+        self.assertEqual([base + "/f10", base + "/f12", base + "/f13"], out.splitlines()[:3])
+        self.assertNotIn(base + "/d1", out.splitlines())
+
+        dd("errors are reported and the other paths are removed")
+        rc, out, err = run(["rm", "-j", base + "/inexistent", base])
+        self.assertEqual(1, rc)
+
+        recs = [json.loads(line) for line in out.splitlines()]
+        self.assertEqual([base + "/inexistent"], [r["path"] for r in recs])
+        self.assertIn("FileNotFoundError", recs[0]["error"])
+        self.assertFalse(os.path.exists(base))
+
+    def test_mounts(self):
+        rc, out, err = run(["usage", "--json"])
+        self.assertEqual(0, rc)
+
+        recs = {}
+        for line in out.splitlines():
+            r = json.loads(line)
+            recs[r["path"]] = r
+
+        self.assertEqual(set(k3fs.get_all_mountpoint()), set(recs))
+        self.assertEqual(["path", "total", "used", "available", "percent"], list(recs["/"]))
+
+        rc, out, err = run(["inodes", base])
+        self.assertEqual(0, rc)
+        self.assertTrue(out.endswith("\t" + base + "\n"))
+
+        dd("all mount points, including pseudo file systems with no blocks or inodes")
+        for cmd in ("usage", "inodes"):
+            rc, out, err = run([cmd, "--all", "--json"])
+            self.assertEqual(0, rc)
+
+            recs = [json.loads(line) for line in out.splitlines()]
+            self.assertEqual(set(k3fs.get_all_mountpoint(all=True)), set(r["path"] for r in recs))
+            for r in recs:
+                self.assertNotIn("error", r)
+                if r["total"] == 0:
+                    self.assertEqual(0.0, r["percent"])
+
+        rc, out, err = run(["mount-of", "-j", base])
+        self.assertEqual({"path": base, "mountpoint": k3fs.get_mountpoint(base)}, json.loads(out))
+
+        rc, out, err = run(["device-of", base])
+        self.assertEqual(k3fs.get_device(base) + "\t" + base + "\n", out)
+
+    def test_python_m(self):
+        rc, out, err = k3proc.command("python", "-m", "k3fs", "mount-of", "/")
+        dd(rc, out, err)
+        self.assertEqual(0, rc)
+        self.assertEqual("/\t/\n", out)
+
+        rc, out, err = k3proc.command("python", "-m", "k3fs", "checksum")
+        self.assertEqual(2, rc)
+        self.assertIn("no path", err)
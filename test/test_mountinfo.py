@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import os
+import subprocess
+import unittest
+
+import k3fs
+import k3ut
+from k3fs import mountinfo
+
+dd = k3ut.dd
+
+content = (
+    "23 28 0:22 / /proc rw,relatime - proc proc rw\n"
+    "28 1 254:0 / / rw,relatime shared:1 master:2 - ext4 /dev/vda rw,discard,errors=remount-ro\n"
+    "40 28 254:0 /srv/a\\040b /mnt/with\\040space rw,noatime - ext4 /dev/vda rw,discard\n"
+    "41 28 0:50 / /mnt/none rw - tmpfs none rw,size=1024k\n"
+    "42 28 0:51 / /mnt/with\\040space ro - tmpfs tmpfs ro\n"
+)
+
+
+class TestMountInfo(unittest.TestCase):
+    def test_parse_mountinfo(self):
+        mounts = mountinfo.parse_mountinfo(content)
+        self.assertEqual(5, len(mounts))
+
+        proc, root, bind, none, over = mounts
+
+        self.assertEqual(23, proc.mount_id)
+        self.assertEqual(28, proc.parent_id)
+        self.assertEqual((0, 22), (proc.major, proc.minor))
+        self.assertEqual("/proc", proc.mountpoint)
+        self.assertEqual((), proc.optional)
+        self.assertEqual("rw,relatime", proc.all_opts())
+
+        self.assertEqual(("shared:1", "master:2"), root.optional)
+        self.assertEqual("ext4", root.fstype)
+        self.assertEqual("/dev/vda", root.device)
+        self.assertEqual("rw,discard,errors=remount-ro", root.super_opts)
+        self.assertEqual(os.makedev(254, 0), root.dev)
+        self.assertEqual(
+            {
+                "device": "/dev/vda",
+                "mountpoint": "/",
+                "fstype": "ext4",
+                "opts": "rw,relatime,discard,errors=remount-ro",
+            },
+            root.to_dict(),
+        )
+
+        self.assertEqual("/srv/a b", bind.root)
+        self.assertEqual("/mnt/with space", bind.mountpoint)
+
+        self.assertEqual("", none.device)
+
+        self.assertFalse(hasattr(root, "__dict__"))
+
+        dd("indexes")
+        table = k3fs.MountTable(mounts, physical_fstypes={"ext4"})
+
+        self.assertIs(over, table.by_mountpoint["/mnt/with space"], "the last one is visible")
+        self.assertEqual([root, bind], table.by_dev[os.makedev(254, 0)])
+
+        self.assertTrue(table.is_physical(root))
+        self.assertFalse(table.is_physical(proc))
+        self.assertFalse(table.is_physical(none))
+
+    def test_get_mount_table(self):
+        table = k3fs.get_mount_table()
+        self.assertIs(table, k3fs.get_mount_table(), "cached if mounts do not change")
+
+        root = table.by_mountpoint["/"]
+        self.assertIn(root, table.by_dev[os.stat("/").st_dev])
+        self.assertIs(root, table.get_mount("/inexistent/foo"))
+
+        self.assertEqual({m.mountpoint for m in table.mounts}, set(table.by_mountpoint))
+
+    def test_same_as_psutil(self):
+        import psutil
+
+        for all in (True, False):
+            expected = {}
+            for pt in psutil.disk_partitions(all=all):
+                expected[pt.mountpoint] = dict(pt._asdict())
+
+            self.assertEqual(expected, k3fs.get_disk_partitions(all=all))
+            self.assertEqual([pt.mountpoint for pt in psutil.disk_partitions(all=all)], k3fs.get_all_mountpoint(all))
+
+    def test_mount_change(self):
+        if os.geteuid() != 0:
+            dd("mount requires root")
+            return
+
+        mp = "/tmp/pykit-ut-k3fs-mountinfo"
+        k3fs.makedirs(mp)
+
+        table = k3fs.get_mount_table()
+        self.assertNotIn(mp, table.by_mountpoint)
+
+        rc = subprocess.call(["mount", "-t", "tmpfs", "tmpfs", mp])
+        if rc != 0:
+            dd("mount is not permitted")
+            return
+
+        try:
+            table = k3fs.get_mount_table()
+            self.assertEqual("tmpfs", table.by_mountpoint[mp].fstype)
+            self.assertEqual(mp, k3fs.get_mountpoint(mp + "/foo"))
+        finally:
+            subprocess.call(["umount", mp])
+
+        self.assertNotIn(mp, k3fs.get_mount_table().by_mountpoint)
+        k3fs.remove(mp)
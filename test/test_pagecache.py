@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import os
+import time
+import unittest
+
+import k3fs
+import k3ut
+
+dd = k3ut.dd
+
+base = "/tmp/pykit-ut-k3fs-pagecache"
+
+M = 1024**2
+
+
+def wait_resident(path, expected, timeout=3):
+    # WILLNEED reads in background
+    deadline = time.monotonic() + timeout
+    while True:
+        rst = k3fs.get_cache_residency(path)
+        if rst["resident"] >= expected or time.monotonic() > deadline:
+            return rst
+        time.sleep(0.05)
+
+
+class TestPageCache(unittest.TestCase):
+    def setUp(self):
+        k3fs.remove(base, onerror="ignore")
+        k3fs.makedirs(base)
+        for name in ("a", "b", "c"):
+            k3fs.fwrite(base, name, b"x" * 4 * M)
+
+        k3fs.evict(k3fs.ls_files(base), base=base, sync=True)
+
+        rst = k3fs.get_cache_residency(base, "a")
+        dd("after evict:", rst)
+        if rst["resident"] > 0:
+            self.skipTest("page cache of " + base + " can not be dropped")
+
+    def tearDown(self):
+        k3fs.remove(base, onerror="ignore")
+
+    def test_residency(self):
+        a = os.path.join(base, "a")
+        self.assertEqual({"total": 4 * M, "resident": 0, "percent": 0.0}, k3fs.get_cache_residency(a))
+
+        with open(a, "rb") as f:
+            f.seek(M)
+            f.read(M)
+
+        rst = k3fs.get_cache_residency(a)
+        dd(rst)
+        self.assertGreaterEqual(rst["resident"], M)
+        self.assertLess(rst["resident"], 4 * M)
+
+        k3fs.fread(a, mode="b")
+        self.assertEqual({"total": 4 * M, "resident": 4 * M, "percent": 1.0}, k3fs.get_cache_residency(a))
+
+        k3fs.fwrite(base, "empty", b"")
+        self.assertEqual({"total": 0, "resident": 0, "percent": 0.0}, k3fs.get_cache_residency(base, "empty"))
+
+        self.assertRaises(FileNotFoundError, k3fs.get_cache_residency, base, "inexistent")
+
+    def test_prefetch_evict(self):
+        a, b, c = [os.path.join(base, x) for x in "abc"]
+
+        self.assertEqual(12 * M, k3fs.prefetch(["a", "b", "c"], base=base))
+        for p in (a, b, c):
+            self.assertEqual(4 * M, wait_resident(p, 4 * M)["resident"])
+
+        k3fs.evict([a, (b, 0, M), (c, 2 * M, None)])
+        self.assertEqual(0, k3fs.get_cache_residency(a)["resident"])
+        self.assertEqual(3 * M, k3fs.get_cache_residency(b)["resident"])
+        self.assertEqual(2 * M, k3fs.get_cache_residency(c)["resident"])
+
+        k3fs.evict([b, c], workers=1)
+
+        dd("range and budget")
+        self.assertEqual(5 * M, k3fs.prefetch([(a, M, 2 * M), b, c], budget=5 * M))
+        self.assertEqual(2 * M, wait_resident(a, 2 * M)["resident"])
+        self.assertEqual(3 * M, wait_resident(b, 3 * M)["resident"])
+        self.assertEqual(0, k3fs.get_cache_residency(c)["resident"])
+
+        self.assertEqual(M, k3fs.prefetch([(a, 3 * M, 100 * M), (a, 10 * M, M)]))
+
+        dd("errors")
+        self.assertRaises(FileNotFoundError, k3fs.prefetch, [a, "inexistent"], base=base)
+        self.assertEqual(4 * M, k3fs.prefetch([a, "inexistent"], base=base, onerror="ignore"))
+        self.assertEqual(4 * M, wait_resident(a, 4 * M)["resident"])
+
+        errors = []
+        k3fs.evict(["inexistent", "a"], base=base, onerror=lambda func, path, exc_info: errors.append(path))
+        self.assertEqual([os.path.join(base, "inexistent")], errors)
+        self.assertEqual(0, k3fs.get_cache_residency(a)["resident"])
+
+        dd("executor")
+        with k3fs.DeviceScheduler(per_device=1) as ex:
+            self.assertEqual(8 * M, k3fs.prefetch(["a", "b"], base=base, executor=ex))
+            self.assertEqual(4 * M, wait_resident(b, 4 * M)["resident"])
+
+            k3fs.evict([a, b], executor=ex)
+            self.assertEqual(0, k3fs.get_cache_residency(b)["resident"])
+
+            self.assertRaises(FileNotFoundError, k3fs.evict, [a, "inexistent"], executor=ex)
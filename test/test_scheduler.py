@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import collections
+import os
+import threading
+import time
+import unittest
+
+import k3fs
+import k3ut
+from k3fs import scheduler
+
+dd = k3ut.dd
+
+
+class TestDeviceScheduler(unittest.TestCase):
+    def test_submit(self):
+        with k3fs.DeviceScheduler() as ex:
+            self.assertEqual(3, ex.submit(lambda a, b=0: a + b, 1, b=2).result())
+            self.assertEqual(["/A", "/B"], list(ex.map(str.upper, ["/a", "/b"])))
+
+            fu = ex.submit(os.stat, "/inexistent/foo")
+            self.assertRaises(FileNotFoundError, fu.result)
+
+        self.assertRaises(RuntimeError, ex.submit, str, "/a")
+
+    def test_per_device(self):
+        lock = threading.Lock()
+        running = collections.Counter()
+        max_running = collections.Counter()
+        max_total = [0]
+
+        def _job(path):
+            dev = path.split("/")[1]
+            with lock:
+                running[dev] += 1
+                max_running[dev] = max(max_running[dev], running[dev])
+                max_total[0] = max(max_total[0], sum(running.values()))
+
+            time.sleep(0.01)
+
+            with lock:
+                running[dev] -= 1
+
+        paths = ["/d%d/f%d" % (i % 4, i) for i in range(80)]
+
+        with k3fs.DeviceScheduler(per_device=2, device_of=lambda p: p.split("/")[1]) as ex:
+            list(ex.map(_job, paths))
+
+        dd(max_running, max_total)
+        self.assertEqual({"d0": 2, "d1": 2, "d2": 2, "d3": 2}, dict(max_running))
+        self.assertEqual(8, max_total[0])
+
+    def test_device_sorted(self):
+        # paths sorted by device, the way `find /data*` lists them
+        lock = threading.Lock()
+        running = [0]
+        max_running = [0]
+
+        def _job(path):
+            with lock:
+                running[0] += 1
+                max_running[0] = max(max_running[0], running[0])
+
+            time.sleep(0.05)
+
+            with lock:
+                running[0] -= 1
+
+        paths = ["/d%02d/f%d" % (d, i) for d in range(24) for i in range(10)]
+
+        t0 = time.monotonic()
+        with k3fs.DeviceScheduler(per_device=2, max_workers=48, device_of=lambda p: p.split("/")[1]) as ex:
+            list(ex.map(_job, paths))
+            n_threads = len(ex.threads)
+
+        spent = time.monotonic() - t0
+
+        dd(n_threads, max_running, spent)
+        self.assertEqual(48, n_threads)
+        self.assertEqual(48, max_running[0])
+        # 5 rounds of 50 ms
+        self.assertLess(spent, 1)
+
+    def test_round_robin(self):
+        done = []
+        gate = threading.Event()
+
+        def _job(path):
+            if path == "/x":
+                gate.wait()
+            done.append(path)
+
+        with k3fs.DeviceScheduler(per_device=1, max_workers=1, device_of=lambda p: p[1]) as ex:
+            # the only worker is blocked until all the others are submitted
+            ex.submit(_job, "/x")
+            for p in ("/a1", "/a2", "/a3", "/b1", "/b2", "/c1"):
+                ex.submit(_job, p)
+
+            gate.set()
+
+        self.assertEqual(["/x", "/a1", "/b1", "/c1", "/a2", "/b2", "/a3"], done)
+
+    def test_shutdown_cancel(self):
+        started = threading.Event()
+        gate = threading.Event()
+
+        def _block():
+            started.set()
+            return gate.wait(10)
+
+        ex = k3fs.DeviceScheduler(per_device=1, max_workers=1)
+        first = ex.submit(_block)
+        started.wait()
+        rest = [ex.submit(str, "/tmp") for _ in range(5)]
+
+        ex.shutdown(wait=False, cancel_futures=True)
+        gate.set()
+        ex.shutdown()
+
+        self.assertTrue(first.result())
+        self.assertTrue(all(f.cancelled() for f in rest))
+
+    def test_st_dev(self):
+        dev = os.stat("/").st_dev
+        self.assertEqual(dev, scheduler._st_dev("/"))
+        self.assertEqual(os.stat("/tmp").st_dev, scheduler._st_dev("/tmp/inexistent/foo"))
+        self.assertIsNotNone(scheduler._st_dev("relative/inexistent"))
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, k3fs.DeviceScheduler, per_device=0)
+        self.assertRaises(ValueError, k3fs.DeviceScheduler, max_workers=0)
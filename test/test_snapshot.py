@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import hashlib
+import os
+import time
+import unittest
+
+import k3fs
+import k3ut
+from k3fs import snapshot
+
+dd = k3ut.dd
+
+base = "/tmp/pykit-ut-k3fs-snapshot"
+root = os.path.join(base, "root")
+
+
+def snap(name):
+    return os.path.join(base, name)
+
+
+def changes(old, new):
+    return [(c, (a or b).path) for c, a, b in k3fs.diff_snapshots(snap(old), snap(new))]
+
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        k3fs.remove(base, onerror="ignore")
+        k3fs.makedirs(root, "a", "b")
+        k3fs.makedirs(root, "a-c")
+        k3fs.fwrite(root, "a", "b", "foo", "foo", fsync=False)
+        k3fs.fwrite(root, "a", "bar", "bar", fsync=False)
+        k3fs.fwrite(root, "a-c", "x", "", fsync=False)
+        k3fs.fwrite(root, "z", "z" * 1000, fsync=False)
+        os.symlink("a/bar", os.path.join(root, "link"))
+
+        # make sure a change of content changes mtime
+        past = time.time() - 100
+        for dirpath, dirnames, filenames in os.walk(root):
+            for n in dirnames + filenames:
+                os.utime(os.path.join(dirpath, n), (past, past), follow_symlinks=False)
+
+    def tearDown(self):
+        k3fs.remove(base, onerror="ignore")
+
+    def test_snapshot(self):
+        n = k3fs.take_snapshot(root, snap("1"), algorithm="sha1")
+        self.assertEqual(8, n)
+
+        entries = list(k3fs.iter_snapshot(snap("1")))
+        dd(entries)
+
+        self.assertEqual(
+            ["a", "a/b", "a/b/foo", "a/bar", "a-c", "a-c/x", "link", "z"],
+            [e.path for e in entries],
+        )
+        self.assertEqual(["d", "d", "f", "f", "d", "f", "l", "f"], [e.type for e in entries])
+
+        by_path = {e.path: e for e in entries}
+        for e in entries:
+            st = os.lstat(os.path.join(root, e.path))
+            self.assertEqual((st.st_size, st.st_mtime_ns, st.st_ino), (e.size, e.mtime_ns, e.ino))
+
+        self.assertEqual(hashlib.sha1(b"foo").hexdigest(), by_path["a/b/foo"].digest)
+        self.assertEqual(hashlib.sha1(b"").hexdigest(), by_path["a-c/x"].digest)
+        self.assertEqual(hashlib.sha1(b"a/bar").hexdigest(), by_path["link"].digest)
+        self.assertIsNone(by_path["a"].digest)
+
+        dd("without digest, in one thread")
+        self.assertEqual(8, k3fs.take_snapshot(root, snap("2"), workers=1))
+        self.assertEqual(
+            [e._replace(digest=None) for e in entries],
+            list(k3fs.iter_snapshot(snap("2"))),
+        )
+        self.assertLess(os.path.getsize(snap("2")), os.path.getsize(snap("1")))
+
+        dd("no change")
+        self.assertEqual([], changes("1", "2"))
+
+        dd("empty dir")
+        k3fs.makedirs(base, "empty")
+        self.assertEqual(0, k3fs.take_snapshot(os.path.join(base, "empty"), snap("3")))
+        self.assertEqual([], list(k3fs.iter_snapshot(snap("3"))))
+
+        self.assertRaises(FileNotFoundError, k3fs.take_snapshot, os.path.join(base, "inexistent"), snap("4"))
+        self.assertFalse(os.path.exists(snap("4")))
+
+        self.assertRaises(k3fs.FSUtilError, k3fs.take_snapshot, root, snap("4"), algorithm="foo")
+
+    def test_diff(self):
+        k3fs.take_snapshot(root, snap("1"), algorithm="sha1")
+
+        k3fs.remove(root, "a", "b")
+        k3fs.fwrite(root, "a-c", "y", "y", fsync=False)
+        k3fs.fwrite(root, "a-c", "x", "x", fsync=False)
+        k3fs.fwrite(root, "0", "0", fsync=False)
+
+        k3fs.take_snapshot(root, snap("2"), algorithm="sha1")
+
+        self.assertEqual(
+            [
+                ("added", "0"),
+                ("modified", "a"),
+                ("removed", "a/b"),
+                ("removed", "a/b/foo"),
+                ("modified", "a-c"),
+                ("modified", "a-c/x"),
+                ("added", "a-c/y"),
+            ],
+            changes("1", "2"),
+        )
+
+        self.assertEqual(
+            [
+                ("removed", "0"),
+                ("modified", "a"),
+                ("added", "a/b"),
+                ("added", "a/b/foo"),
+                ("modified", "a-c"),
+                ("modified", "a-c/x"),
+                ("removed", "a-c/y"),
+            ],
+            changes("2", "1"),
+        )
+
+        c, old, new = list(k3fs.diff_snapshots(snap("1"), snap("2")))[5]
+        self.assertEqual(hashlib.sha1(b"").hexdigest(), old.digest)
+        self.assertEqual(hashlib.sha1(b"x").hexdigest(), new.digest)
+
+        dd("the same size and mtime, a different content")
+        st = os.stat(os.path.join(root, "z"))
+        with open(os.path.join(root, "z"), "r+") as f:
+            f.write("y")
+        os.utime(os.path.join(root, "z"), ns=(st.st_atime_ns, st.st_mtime_ns))
+
+        k3fs.take_snapshot(root, snap("3"), algorithm="sha1")
+        self.assertEqual([("modified", "z")], changes("2", "3"))
+
+        k3fs.take_snapshot(root, snap("4"))
+        self.assertEqual([], changes("2", "4"), "digest is compared only if both have it")
+
+    def test_reuse(self):
+        k3fs.take_snapshot(root, snap("1"), algorithm="sha1")
+
+        k3fs.fwrite(root, "a", "bar", "bar2", fsync=False)
+
+        hashed = []
+        orig = snapshot._file_digest
+
+        def _digest(path, algorithm):
+            hashed.append(os.fsdecode(path))
+            return orig(path, algorithm)
+
+        snapshot._file_digest = _digest
+        try:
+            k3fs.take_snapshot(root, snap("2"), algorithm="sha1", reuse=snap("1"))
+            self.assertEqual([os.path.join(root, "a", "bar")], hashed)
+
+            dd("another algorithm is not reused")
+            del hashed[:]
+            k3fs.take_snapshot(root, snap("3"), algorithm="md5", reuse=snap("2"))
+            self.assertEqual(4, len(hashed))
+        finally:
+            snapshot._file_digest = orig
+
+        entries = {e.path: e for e in k3fs.iter_snapshot(snap("2"))}
+        self.assertEqual(hashlib.sha1(b"foo").hexdigest(), entries["a/b/foo"].digest)
+        self.assertEqual(hashlib.sha1(b"bar2").hexdigest(), entries["a/bar"].digest)
+
+        self.assertEqual([("modified", "a/bar")], changes("1", "2"))
+
+    def test_onerror(self):
+        errors = []
+
+        def _onerror(func, path, exc_info):
+            errors.append(path)
+
+        orig = snapshot._file_digest
+
+        def _digest(path, algorithm):
+            if path.endswith(b"/z"):
+                raise FileNotFoundError(path)
+            return orig(path, algorithm)
+
+        snapshot._file_digest = _digest
+        try:
+            for workers in (1, 4):
+                del errors[:]
+                self.assertEqual(
+                    7, k3fs.take_snapshot(root, snap("1"), algorithm="sha1", workers=workers, onerror=_onerror)
+                )
+                self.assertEqual([os.path.join(root, "z")], errors)
+                self.assertNotIn("z", [e.path for e in k3fs.iter_snapshot(snap("1"))])
+
+            self.assertRaises(FileNotFoundError, k3fs.take_snapshot, root, snap("2"), algorithm="sha1")
+            self.assertFalse(os.path.exists(snap("2")))
+        finally:
+            snapshot._file_digest = orig
+
+    def test_invalid(self):
+        k3fs.fwrite(snap("bad"), b"foo")
+        self.assertRaises(k3fs.FSUtilError, list, k3fs.iter_snapshot(snap("bad")))
+
+        k3fs.take_snapshot(root, snap("1"))
+        cont = k3fs.fread(snap("1"), mode="b")
+        k3fs.fwrite(snap("truncated"), cont[:-3])
+
+        self.assertRaises(k3fs.FSUtilError, list, k3fs.iter_snapshot(snap("truncated")))
+        self.assertRaises(k3fs.FSUtilError, list, k3fs.diff_snapshots(snap("1"), snap("truncated")))
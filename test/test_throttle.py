@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import hashlib
+import os
+import time
+import unittest
+
+import k3fs
+import k3ut
+from k3fs import throttle
+
+dd = k3ut.dd
+
+base = "/tmp/pykit-ut-k3fs-throttle"
+
+M = 1024**2
+
+line_fmt = "   8       0 fake 1 2 3 4 5 6 7 8 {inflight} {ticks} {weighted} 0 0 0 0 0 0\n"
+
+
+class TestAdaptiveThrottle(unittest.TestCase):
+    def setUp(self):
+        k3fs.remove(base, onerror="ignore")
+        k3fs.makedirs(base)
+
+        self.diskstats = os.path.join(base, "diskstats")
+        self.write_stats(0, 0)
+
+        self.orig_diskstats = throttle.DISKSTATS
+        throttle.DISKSTATS = self.diskstats
+
+    def tearDown(self):
+        throttle.DISKSTATS = self.orig_diskstats
+        k3fs.remove(base, onerror="ignore")
+
+    def write_stats(self, ticks, weighted):
+        with open(self.diskstats, "w") as f:
+            f.write("   7       0 loop0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0\n")
+            f.write(line_fmt.format(inflight=0, ticks=ticks, weighted=weighted))
+
+    def sample(self, t, ticks, weighted, consumed):
+        # 1 second passed, in which `consumed` bytes were read
+        self.write_stats(ticks, weighted)
+        t.sampled_at -= 1
+        t.consumed = consumed
+        t._sample(t.sampled_at + 1)
+
+    def test_read_diskstats(self):
+        self.assertEqual((0, 0), throttle.read_diskstats("fake"))
+        self.assertEqual((0, 0), throttle.read_diskstats("/dev/fake"))
+        self.assertIsNone(throttle.read_diskstats("inexistent"))
+        self.assertIsNone(throttle.read_diskstats("fake", path=os.path.join(base, "inexistent")))
+
+        self.write_stats(123, 456)
+        self.assertEqual((123, 456), throttle.read_diskstats("fake"))
+
+        dev = k3fs.get_device("/")
+        dd("real device of /:", dev, throttle.read_diskstats(dev, path=self.orig_diskstats))
+
+    def test_adjust(self):
+        t = k3fs.AdaptiveThrottle(device="/dev/fake", initial_rate=8 * M, min_rate=2 * M, max_rate=32 * M)
+        self.assertEqual("fake", t.device)
+        self.assertEqual(8 * M, t.rate)
+        self.assertIsNone(t.utilization)
+
+        dd("busy: slow down")
+        self.sample(t, 900, 1800, 8 * M)
+        self.assertAlmostEqual(0.9, t.utilization, places=2)
+        self.assertAlmostEqual(1.8, t.queue_depth, places=2)
+        self.assertEqual(int(8 * M * 0.5 / 0.9), int(t.rate))
+
+        dd("at most halved, not lower than min_rate")
+        for _ in range(3):
+            self.sample(t, t.stats[0] + 1000, t.stats[1] + 1000, 8 * M)
+        self.assertEqual(2 * M, t.rate)
+
+        dd("idle: speed up, at most doubled")
+        self.sample(t, t.stats[0] + 10, t.stats[1] + 10, 2 * M)
+        self.assertAlmostEqual(0.01, t.utilization, places=2)
+        self.assertEqual(4 * M, t.rate)
+
+        dd("not raised if the rate was not used")
+        self.sample(t, t.stats[0] + 10, t.stats[1] + 10, M)
+        self.assertEqual(4 * M, t.rate)
+
+        dd("not higher than max_rate")
+        for _ in range(5):
+            self.sample(t, t.stats[0], t.stats[1], 64 * M)
+        self.assertEqual(32 * M, t.rate)
+
+        dd("no stats")
+        t.device = "inexistent"
+        self.sample(t, 0, 0, 64 * M)
+        self.assertIsNone(t.utilization)
+        self.assertEqual(32 * M, t.rate)
+
+    def test_queue_depth(self):
+        t = k3fs.AdaptiveThrottle(device="fake", target_queue_depth=4, initial_rate=8 * M)
+
+        self.sample(t, 300, 6000, 8 * M)
+        self.assertAlmostEqual(6.0, t.queue_depth, places=2)
+        self.assertEqual(int(8 * M * 4 / 6), int(t.rate))
+
+    def test_wait(self):
+        t = k3fs.AdaptiveThrottle(device="fake", initial_rate=4 * M, min_rate=M)
+
+        t0 = time.monotonic()
+        slept = t.wait(M) + t.wait(M)
+        self.assertGreaterEqual(time.monotonic() - t0, 0.45)
+        self.assertAlmostEqual(0.5, slept, delta=0.1)
+
+    def test_achieved_rate(self):
+        t = k3fs.AdaptiveThrottle(device="fake", initial_rate=8 * M, min_rate=M, interval=100)
+
+        dd("time spent on reading is part of the time of a block at the rate")
+        t0 = time.monotonic()
+        for _ in range(8):
+            # a read of 1 MB takes 0.05 second
+            time.sleep(0.05)
+            t.wait(M)
+
+        elapsed = time.monotonic() - t0
+        dd("rate:", 8 * M / elapsed)
+        self.assertAlmostEqual(8 * M, 8 * M / elapsed, delta=0.1 * 8 * M)
+
+        dd("time not used is not saved up for a burst")
+        time.sleep(0.5)
+        t0 = time.monotonic()
+        for _ in range(4):
+            t.wait(M)
+        self.assertGreaterEqual(time.monotonic() - t0, 0.35)
+
+    def test_io_limit(self):
+        fn = os.path.join(base, "foo")
+        cont = os.urandom(2 * M)
+        k3fs.fwrite(fn, cont)
+
+        t = k3fs.AdaptiveThrottle(fn, initial_rate=4 * M, min_rate=M)
+        dd("device:", t.device)
+
+        expected = k3fs.calc_checksums(fn, sha1=True, io_limit=-1)
+
+        t0 = time.monotonic()
+        self.assertEqual(expected, k3fs.calc_checksums(fn, sha1=True, block_size=M // 4, io_limit=t))
+        self.assertGreaterEqual(time.monotonic() - t0, 0.4)
+
+        rst = k3fs.calc_range_checksums(fn, algorithm="sha1", range_size=M, block_size=M // 4, io_limit=t)
+        self.assertEqual(
+            [hashlib.sha1(cont[:M]).hexdigest(), hashlib.sha1(cont[M:]).hexdigest()],
+            [r[2] for r in rst["ranges"]],
+        )
+
+        chunks = list(k3fs.iter_file_chunks(fn, avg_size=64 * 1024, io_limit=t))
+        self.assertEqual(2 * M, sum(c[1] for c in chunks))
+
+    def test_invalid(self):
+        self.assertRaises(k3fs.FSUtilError, k3fs.AdaptiveThrottle, device="fake", target_util=0)
+        self.assertRaises(k3fs.FSUtilError, k3fs.AdaptiveThrottle, device="fake", target_util=1.5)
+        self.assertRaises(k3fs.FSUtilError, k3fs.AdaptiveThrottle, device="fake", initial_rate=M, min_rate=2 * M)
+        self.assertRaises(k3fs.FSUtilError, k3fs.AdaptiveThrottle, device="fake", initial_rate=2 * M, max_rate=M)
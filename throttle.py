@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+An I/O rate limit that adapts to how busy the device is, to run background
+reads, such as a scrub, fast on an idle disk and slow under production load.
+
+Usage::
+
+    throttle = AdaptiveThrottle('/data/foo', target_util=0.5)
+    calc_checksums('/data/foo', sha1=True, io_limit=throttle)
+
+    throttle.rate          # current limit in bytes per second
+    throttle.utilization   # utilization of the device in the last interval
+
+The utilization and the queue depth of the device are sampled from
+`/proc/diskstats` every `interval` seconds. The rate is lowered when the
+device is busier than the target and raised when it is not.
+"""
+
+import os
+import threading
+import time
+
+from . import fs
+
+DISKSTATS = "/proc/diskstats"
+
+
+def read_diskstats(device, path=None):
+    """
+    Read the I/O counters of a block device from `/proc/diskstats`.
+
+    Args:
+
+        device(str):
+            is the name of the device, such as `sda1` or `/dev/sda1`.
+
+        path(str):
+            is the file to read, by default `/proc/diskstats`.
+
+    Returns:
+        tuple: `(io_ticks, weighted_io_ticks)`: milliseconds the device spent
+        doing I/O, and the sum of milliseconds every request spent in queue.
+        `None` if the device has no stats, such as `tmpfs`.
+    """
+    name = os.path.basename(device)
+
+    try:
+        with open(path or DISKSTATS) as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) >= 14 and parts[2] == name:
+                    return int(parts[12]), int(parts[13])
+    except OSError:
+        pass
+
+    return None
+
+
+class AdaptiveThrottle(object):
+    """
+    A read rate limit that is adjusted by the utilization of a device.
+    It can be passed as `io_limit` to `calc_checksums`, `calc_range_checksums`
+    and `iter_file_chunks`, and be shared by several threads and calls, which
+    then read at most `rate` bytes per second in total.
+
+    Every `interval` seconds, the rate is multiplied by
+    `target_util / utilization`, at most doubled or halved at a time and kept
+    in `[min_rate, max_rate]`. It is raised only if the readers used most of
+    it, so that it does not grow while they are slowed down by something else.
+
+    If the device has no stats, such as a `tmpfs` or a device not found, the
+    rate does not change.
+
+    Args:
+
+        paths:
+            a path on the device to watch. The device is found by `get_device`.
+
+        device(str):
+            the device to watch, such as `sda`, instead of finding it by `paths`.
+
+        target_util(float):
+            the utilization of the device to keep under, in `(0, 1]`, the
+            fraction of time the device is busy with I/O.
+
+        target_queue_depth(float):
+            the average number of requests in the queue of the device to keep
+            under. It is a better signal than utilization for a device that
+            serves many requests in parallel, such as NVMe. `None` to ignore it.
+
+        initial_rate(int):
+            the rate to start with, in bytes per second.
+
+        min_rate(int):
+            the rate never goes below it.
+
+        max_rate(int):
+            the rate never goes above it. `None` for no limit.
+
+        interval(float):
+            seconds between two samples of the device stats.
+    """
+
+    def __init__(
+        self,
+        *paths,
+        device=None,
+        target_util=0.5,
+        target_queue_depth=None,
+        initial_rate=fs.READ_BLOCK,
+        min_rate=1024 * 1024,
+        max_rate=None,
+        interval=1.0,
+    ):
+        if not 0 < target_util <= 1:
+            raise fs.FSUtilError("target_util must be in (0, 1], but: {u}".format(u=target_util))
+
+        if not 0 < min_rate <= initial_rate:
+            raise fs.FSUtilError("it requires 0 < min_rate <= initial_rate")
+
+        if max_rate is not None and max_rate < initial_rate:
+            raise fs.FSUtilError("it requires initial_rate <= max_rate")
+
+        if device is None:
+            device = fs.get_device(os.path.join(*paths))
+
+        # /dev/mapper/foo is a link to /dev/dm-0, which is the name in diskstats
+        self.device = os.path.basename(os.path.realpath(device))
+
+        self.target_util = target_util
+        self.target_queue_depth = target_queue_depth
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.interval = interval
+
+        self.rate = initial_rate
+
+        # of the last interval, None before the first one ends or if there is no stats
+        self.utilization = None
+        self.queue_depth = None
+
+        self.lock = threading.Lock()
+
+        # time when the bytes let through so far are all read at `rate`
+        self.free_at = time.monotonic()
+
+        self.consumed = 0
+        self.sampled_at = time.monotonic()
+        self.stats = read_diskstats(self.device)
+
+    def wait(self, nbytes):
+        """
+        Account `nbytes` just read, and sleep long enough to keep the rate.
+
+        Returns:
+            float: seconds slept.
+        """
+        with self.lock:
+            now = time.monotonic()
+
+            self.consumed += nbytes
+            if now - self.sampled_at >= self.interval:
+                self._sample(now)
+
+            # The bytes took time to read, which is at most `cost` of the rate
+            # and is not charged again, the same as a fixed `io_limit`.
+            # More time not used in the past can not be saved up for a burst.
+            cost = float(nbytes) / self.rate
+            self.free_at = max(self.free_at, now - cost) + cost
+            delay = self.free_at - now
+
+        if delay > 0:
+            time.sleep(delay)
+            return delay
+
+        return 0.0
+
+    def _sample(self, now):
+        elapsed = now - self.sampled_at
+        consumed = self.consumed
+
+        self.sampled_at = now
+        self.consumed = 0
+
+        stats = read_diskstats(self.device)
+        prev, self.stats = self.stats, stats
+
+        if stats is None or prev is None:
+            self.utilization = None
+            self.queue_depth = None
+            return
+
+        elapsed_ms = max(elapsed * 1000, 1e-3)
+        self.utilization = min((stats[0] - prev[0]) / elapsed_ms, 1.0)
+        self.queue_depth = (stats[1] - prev[1]) / elapsed_ms
+
+        self._adjust(consumed / max(elapsed, 1e-6))
+
+    def _adjust(self, used_rate):
+        factor = self.target_util / max(self.utilization, 0.01)
+        if self.target_queue_depth is not None:
+            factor = min(factor, self.target_queue_depth / max(self.queue_depth, 0.01))
+
+        factor = min(max(factor, 0.5), 2.0)
+
+        if factor > 1 and used_rate < self.rate / 2:
+            # readers did not use the rate, raising it tells nothing
+            return
+
+        rate = self.rate * factor
+        rate = max(rate, self.min_rate)
+        if self.max_rate is not None:
+            rate = min(rate, self.max_rate)
+
+        self.rate = rate